@@ -8,7 +8,7 @@ import os
 import numpy as np
 from timeit import default_timer as timer
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import subprocess
 
 # metadata
@@ -32,6 +32,33 @@ mag_height = 6.5  # Height needed for NEST deepwell in magnetic deck
 # While True enables wait_time of step definition. False to bypass the wait_time
 use_waits = True
 
+# Start temperature ramps in advance so the block is ready when the step begins
+preheat = True
+# Another plate is queued after this run: keep the block at temperature at the end
+next_plate_queued = False
+# Run independent steps while the modules wait (magnet, incubation, drying)
+fill_waits = True
+# Second plate offset by one phase: it is lysed on the tempdeck while the first one is washed
+interleave_plates = False
+
+# Dry run on the robot to check a new desk: faster motions and shortened waits
+validation_mode = False
+validation_speed = 2  # Pipette motion speed multiplier in validation mode
+validation_wait_factor = 0.1  # Waits and delays are multiplied by this factor
+operator_response = 60  # Seconds a pause is assumed to last in simulation
+move_time = 2  # Seconds of a move of the gantry between two locations in simulation
+# Slots of the tipracks kept in reserve: the robot goes on with them when a rack
+# empties and the operator refills it without stopping the run. [] to disable
+reserve_tip_slots = []
+tip_change_time = 10  # Seconds to drop a tip and pick up a new one, for the tips saved
+# Pick up the tips from the rack closest to the source of the transfer, not in rack order
+nearest_tips = True
+# ul a well of the liquid trash (nest 12 reservoir of SLOT 4) takes before it overflows
+trash_well_volume = 14000
+# Start from the beads, WB and EtOH the last run left in the reservoirs, the operator
+# confirms them and only tops them up. The robot keeps them in reagent_inventory.json
+use_inventory = True
+
 num_cols = math.ceil(NUM_SAMPLES/8)
 pool_area = 8.13*71.1
 diameter_screwcap = 8.1  # Diameter of the screwcap
@@ -50,64 +77,122 @@ def run(ctx: protocol_api.ProtocolContext):
     # Init protocol run
     run = ProtocolRun(ctx)
 
-    run.add_step(
-        description="Transfer Magnetic Beads from SLOT 3 to a Deep Well Plate on SLOT 2 and mix")  # 1
-    # INTERACTION 2
-    run.add_step(
-        description="Add samples in hood \n Replace tipracks, empty trash, set the DeepWellPlate with samples on Temperature Module SLOT 10")  # 2
-
-    run.add_step(description="65C Incubation", wait_time=30)  # 5* 60 minutos 3
-    run.add_step(
-        description="Transfer volume, from Temperature Module to Magnet Module, 485ul")  # 4
-    run.add_step(description="Set Magnetic Module ON for 10 minutes",
-                 wait_time=30)  # 10*60 5
-    run.add_step(
-        description="Discard supernatant, avoiding Magentic Beads, from SLOT 7 to a 195mL Pool on SLOT 4")  # 6
-    run.add_step(description="Set Magnetic Module OFF")  # 7
-
-    # Add WB
-    run.add_step(
-        description="Add 500ul of WB, from SLOT 3, to Magnetic Beads on SLOT 7 ")  # 8
-    run.add_step(description="Set Magnetic Module ON for 2 minutes",
-                 wait_time=30)  # 2*60 9
-    run.add_step(
-        description="Discard Supernatant, avoiding Magnetic Beads, from SLOT 7 to SLOT 4")  # 10
-    run.add_step(description="Set Magnetic Module OFF")  # 11
-
-    run.add_step(
-        description="Add 100mL of EtOH on 195mL 1-well Pool on SLOT 1. Replace tipracks, empty trashes (Pool on SLOT 4 and Trash). Replace DeepWellPlate on Temperature Module, on SLOT 10, for a new one")  # INTERACTION 12
-
-    # Add ETOH First step
-    run.add_step(
-        description="Add 500ul of EtOH to Magnetic Beads on Magnetic Module, from SLOT 1 to SLOT 7")  # 13
-    run.add_step(description="Set Magnetic Module ON for 2 minutes",
-                 wait_time=30)  # 2*60 14
-    run.add_step(
-        description="Discard Supernatant, avoiding Magnetic Beads, from SLOT 7 to SLOT 4")  # 15
-    run.add_step(description="Set Magnetic Module OFF")  # 16
-
-    # Add ETOH Second step
-    run.add_step(
-        description="Add 250ul of EtOH to Magnetic Beads on Magnetic Module, from SLOT 1 to SLOT 7")  # 17
-    run.add_step(description="Set Magnetic Module ON for 2 minutes",
-                 wait_time=30)  # 2*60 18
-    run.add_step(
-        description="Discard Supernatant, avoiding Magnetic Beads, from SLOT 7 to SLOT 4")  # 19
-    run.add_step(description="Let EtOH evaporate until completely dry, for 10 minutes ",
-                 wait_time=30)  # 10 * 60 20
-    run.add_step(description="Set Magnetic Module OFF")  # 21
-
-    run.add_step(
-        description="Add XXXmL of Elution Buffer on 195mL 1-well Pool on SLOT 3. Replace tipracks, empty trashes (Pool on SLOT 4 and Trash). Set a NEW DeepWellPlate to collect final RNA extracts on SLOT 2")  # INTERACTION 22
-
-    run.add_step(
-        description="Add 50uL of Elution Buffer from SLOT 3, to Magnetic Beads on Magnetic Module, SLOT 7, and then trasfer to Temperature Module on SLOT 10.")  # 24
-    run.add_step(description="65C Incubation for 10 minutes",
-                 wait_time=30)  # 10 * 60 # 25
-    run.add_step(description="Move 50ul from temp to magnet 10-7")  # 26
-    run.add_step(description="Magnetic on: 3 minutes",
-                 wait_time=30)  # 3 * 60 27
-    run.add_step(description="Move 50ul Magnet Final destination 7-> 2")  # 28
+    # Plates processed in this run, plate B is offset by one phase
+    plates = ['A', 'B'] if interleave_plates else ['A']
+    steps_per_plate = 28
+
+    # Tips of the p300 multi for [pick_ups] tips in every column
+    def tips(pick_ups):
+        return {'left': pick_ups*num_cols*8}
+
+    # Discards of the 8 channels to the liquid trash, one per column, for [volume] added
+    def waste(volume):
+        return [volume*1.1*8 for _ in range(num_cols)]
+
+    plate_first = {}
+    for plate in plates:
+        # Steps of the plate are numbered from first+1
+        first = len(run.step_list)
+        plate_first[plate] = first
+        run.set_plate(plate if interleave_plates else None)
+        if plate == 'B':
+            # Lysis of plate B runs while plate A is on the magnet
+            run.add_step(
+                description="Transfer Magnetic Beads from SLOT 3 to a Deep Well Plate on SLOT 2 and mix",
+                resources=['slot2', 'slot3'], depends=[4], duration=num_cols*60, tips=tips(1))  # 1
+            # INTERACTION 2
+            run.add_step(
+                description="Add samples in hood to the DeepWellPlate of SLOT 2. Remove the empty DeepWellPlate of plate A from the Temperature Module and set the plate with samples on SLOT 10",
+                resources=['slot2', 'slot10'], duration=operator_response, tip_stop=True)  # 2
+            run.add_step(description="Return the DeepWellPlate of plate B to the Temperature Module SLOT 10 to finish the 65C Incubation. Remove the RNA extracts of plate A from SLOT 2, set a NEW DeepWellPlate on the Magnetic Module SLOT 7 and add WB on SLOT 1. Empty the Trash",
+                         wait_time=30, resources=['tempdeck', 'slot10'],
+                         wait_after='plate_B_loaded', tip_stop=True, plates=1)  # INTERACTION 3
+        else:
+            run.add_step(
+                description="Transfer Magnetic Beads from SLOT 3 to a Deep Well Plate on SLOT 2 and mix",
+                tips=tips(1))  # 1
+            # INTERACTION 2
+            run.add_step(
+                description="Add samples in hood \n Empty trash, set the DeepWellPlate with samples on Temperature Module SLOT 10",
+                tip_stop=True)  # 2
+
+            run.add_step(description="65C Incubation", wait_time=30,
+                         resources=['tempdeck', 'slot10'])  # 5* 60 minutos 3
+        run.add_step(
+            description="Transfer volume, from Temperature Module to Magnet Module, 485ul",
+            tips=tips(1))  # 4
+        run.add_step(description="Set Magnetic Module ON for 10 minutes",
+                     wait_time=30, resources=['magdeck', 'slot7'],
+                     wait_after='magnet_engaged')  # 10*60 5
+        run.add_step(
+            description="Discard supernatant, avoiding Magentic Beads, from SLOT 7 to the liquid trash on SLOT 4",
+            tips=tips(1), waste=waste(485))  # 6
+        run.add_step(description="Set Magnetic Module OFF")  # 7
+
+        # Add WB
+        run.add_step(
+            description="Add 500ul of WB, from SLOT 3, to Magnetic Beads on SLOT 7 ", tips=tips(1))  # 8
+        run.add_step(description="Set Magnetic Module ON for 2 minutes",
+                     wait_time=30, resources=['magdeck', 'slot7'],
+                     wait_after='magnet_engaged')  # 2*60 9
+        run.add_step(
+            description="Discard Supernatant, avoiding Magnetic Beads, from SLOT 7 to SLOT 4", tips=tips(1),
+            waste=waste(485))  # 10
+        run.add_step(description="Set Magnetic Module OFF")  # 11
+
+        # Plate B must be on the tempdeck before the beads are replaced by the Elution Buffer
+        run.add_step(
+            description="Add 100mL of EtOH on 195mL 1-well Pool on SLOT 1. Replace the Magnetic Beads on SLOT 3 with XXXmL of Elution Buffer. Empty the Trash. Replace DeepWellPlate on Temperature Module, on SLOT 10, for a new one",
+            depends=[first+11] + ([steps_per_plate+1, steps_per_plate+2] if plate == 'A' and interleave_plates else []),
+            tip_stop=True, plates=1)  # INTERACTION 12
+
+        # Add ETOH First step
+        run.add_step(
+            description="Add 500ul of EtOH to Magnetic Beads on Magnetic Module, from SLOT 1 to SLOT 7",
+            tips=tips(1))  # 13
+        run.add_step(description="Set Magnetic Module ON for 2 minutes",
+                     wait_time=30, resources=['magdeck', 'slot7'],
+                     wait_after='magnet_engaged')  # 2*60 14
+        run.add_step(
+            description="Discard Supernatant, avoiding Magnetic Beads, from SLOT 7 to SLOT 4", tips=tips(1),
+            waste=waste(485))  # 15
+        run.add_step(description="Set Magnetic Module OFF")  # 16
+
+        # Add ETOH Second step
+        run.add_step(
+            description="Add 250ul of EtOH to Magnetic Beads on Magnetic Module, from SLOT 1 to SLOT 7",
+            tips=tips(1))  # 17
+        run.add_step(description="Set Magnetic Module ON for 2 minutes",
+                     wait_time=30, resources=['magdeck', 'slot7'],
+                     wait_after='magnet_engaged')  # 2*60 18
+        run.add_step(
+            description="Discard Supernatant, avoiding Magnetic Beads, from SLOT 7 to SLOT 4", tips=tips(1),
+            waste=waste(300))  # 19
+        run.add_step(description="Let EtOH evaporate until completely dry, for 10 minutes ",
+                     wait_time=30, resources=['magdeck', 'slot7'],
+                     wait_after='supernatant_removed', tips=tips(1), waste=waste(300))  # 10 * 60 20
+        run.add_step(description="Set Magnetic Module OFF")  # 21
+
+        run.add_step(
+            description="Empty the Trash. Set a NEW DeepWellPlate to collect final RNA extracts on SLOT 2",
+            tip_stop=True, plates=1)  # INTERACTION 22
+
+        # Only needs the Elution Buffer of the pause 12, it can run during the waits
+        run.add_step(
+            description="Add 50uL of Elution Buffer from SLOT 3 to the DeepWellPlate on Temperature Module SLOT 10",
+            resources=['slot3', 'slot10'], duration=num_cols*30,
+            depends=[first+22] if plate == 'A' and interleave_plates else [first+12],
+            tips=tips(1))  # 23
+        run.add_step(
+            description="Resuspend Magnetic Beads on SLOT 7 with the Elution Buffer of SLOT 10 and then transfer to Temperature Module on SLOT 10.",
+            depends=[first+22, first+23], tips=tips(1))  # 24
+        run.add_step(description="65C Incubation for 10 minutes",
+                     wait_time=30, resources=['tempdeck', 'slot10'])  # 10 * 60 # 25
+        run.add_step(description="Move 50ul from temp to magnet 10-7", tips=tips(1))  # 26
+        run.add_step(description="Magnetic on: 3 minutes",
+                     wait_time=30, resources=['magdeck', 'slot7'],
+                     wait_after='magnet_engaged')  # 3 * 60 27
+        run.add_step(description="Move 50ul Magnet Final destination 7-> 2", tips=tips(1))  # 28
 
     # execute avaliaible steps
     run.init_steps(steps)
@@ -136,10 +221,11 @@ def run(ctx: protocol_api.ProtocolContext):
     # Wash Buffer Pool-
     trash_slot = ctx.load_labware(
         'nest_12_reservoir_15ml', 4)
-    trash_wells_multi = trash_slot.rows()[0][:num_cols]
+    # The discards are spread over all the wells of the liquid trash
+    run.set_waste(trash_slot.rows()[0], trash_well_volume)
 
     # # Magnetic module plus NEST_Deep_well_reservoire
-    magdeck = ctx.load_module('magnetic module gen2', 7)
+    magdeck = MagDeckState(run, run.load_module('magnetic module gen2', 7))
     magdeck.disengage()
     mag_slot = magdeck.load_labware(moving_type)
     mag_wells_multi = mag_slot.rows()[0][:num_cols]
@@ -151,10 +237,17 @@ def run(ctx: protocol_api.ProtocolContext):
     wb_wells_multi = wbetoh_slot.rows()[0][:num_cols]
 
     # Temperature module plus NEST_Deep_well_reservoire
-    tempdeck = ctx.load_module('tempdeck', 10)
+    tempdeck = TempDeckState(run, run.load_module('tempdeck', 10))
     temp_slot = tempdeck.load_labware(moving_type)
     temp_wells_multi = temp_slot.rows()[0][:num_cols]
 
+    # Ramps are started in advance from the thermal model of the module
+    if (set_temp_on and preheat):
+        for plate in plates:
+            if plate == 'A':
+                run.schedule_temperature(tempdeck, temperature, step=plate_first[plate]+3)
+            run.schedule_temperature(tempdeck, temperature, step=plate_first[plate]+25)
+
     # Mount pippets and set racks
     # Tipracks200_multi
 
@@ -168,13 +261,35 @@ def run(ctx: protocol_api.ProtocolContext):
                        tips300_9, tips300_6, tips300_11, tips300_8, tips300_5], capacity=200, multi=True)
 
     run.set_pip("left")  # p300 multi
+    run.log_tip_plan()
+    run.log_waste_plan()
+
+    # Elution Buffer replaces the Magnetic Beads on SLOT 3 at the pause of step 12
+    elution_wells_multi = beads_slot.rows()[0][:num_cols]
 
     ############################################################################
-    # STEP 1:
+    # Steps that can run during the waits of the modules
     ############################################################################
-    if (run.next_step()):
-        ############################################################################
-        # Light flash end of program
+    def add_elution():
+        run.set_pip("left")  # p300 multi
+        elution = Reagent(name='Elution',
+                          num_wells=1,  # change with num samples
+                          delay=0,
+                          flow_rate_aspirate=3,  # Original 0.5
+                          flow_rate_dispense=3,  # Original 1
+                          flow_rate_aspirate_mix=15,
+                          flow_rate_dispense_mix=25,
+                          reagent_reservoir_volume=528,
+                          h_cono=4,
+                          v_fondo=4 * math.pi * 4 ** 3 / 3)
+        for source, destination in zip(elution_wells_multi, temp_wells_multi):
+            run.pick_up(near=source)
+            run.move_volume(reagent=elution, source=source,
+                            dest=destination, vol=50, air_gap_vol=3,
+                            pickup_height=0.01, disp_height=-5)
+            run.drop_tip()
+
+    def add_beads():
         run.set_pip("left")  # p300 multi
         volume = 275
         beads = Reagent(name='Magnetic beads',
@@ -185,27 +300,32 @@ def run(ctx: protocol_api.ProtocolContext):
                         num_wells=3,
                         h_cono=1.95,
                         v_fondo=695,
-                        rinse_loops=3)
+                        rinse_loops=3,
+                        tip_recycling='column')  # The plate has no samples yet
 
         air_gap_vol = 5
         disposal_height = -5
         pickup_height = 1
         beads.set_positions(beads_slot.rows()[0][0:3])
+        run.stock_reagent(beads)
+        run.confirm_stock()
 
+        # Every channel aspirates, even over the empty wells of a partial column
+        channels = run.get_current_pip().channels
         for destination in aw_wells_multi:
-            run.pick_up()
             vol = 150
             vol_min = 1000
             pickup_height = beads.calc_height(
-                pool_area, vol*8, extra_volume=vol_min)
+                pool_area, vol*channels, extra_volume=vol_min)
+            run.use_tip(beads, beads.get_current_position(), destination, top=True)
             run.move_volume(reagent=beads, source=beads.get_current_position(),
                             dest=destination, vol=vol, air_gap_vol=air_gap_vol,
                             pickup_height=pickup_height, disp_height=disposal_height,
                             rinse=True, blow_out=True)
-            run.change_tip()
             vol = 125
             pickup_height = beads.calc_height(
-                pool_area, vol*8, extra_volume=vol_min)
+                pool_area, vol*channels, extra_volume=vol_min)
+            run.use_tip(beads, beads.get_current_position(), destination, top=True)
             run.move_volume(reagent=beads, source=beads.get_current_position(),
                             dest=destination, vol=vol, air_gap_vol=air_gap_vol,
                             pickup_height=pickup_height, disp_height=disposal_height,
@@ -214,133 +334,33 @@ def run(ctx: protocol_api.ProtocolContext):
             run.custom_mix(beads, location=destination, vol=150,
                            rounds=3, blow_out=True, mix_height=0)
             run.drop_tip()
-        run.finish_step()
 
-    ############################################################################
-    # STEP 2
-    ############################################################################
-    if (run.next_step()):
+    def load_plate_b():
         run.blink()
-        ctx.pause(
-            'Go to the hood to disable sample,Replace tips, empty trash, move Slot2 -> Slot 10')
-        run.reset_pip_count(run.get_current_pip())
-        run.finish_step()
-
-    ############################################################################
-    # STEP 3: Incubation at 65ºC
-    ############################################################################
-    if (run.next_step()):
+        run.tip_pause('Add samples of plate B in the hood to the DW of SLOT 2. Remove the empty DW of SLOT 10 and set plate B on the Temperature Module SLOT 10')
         if (set_temp_on):
-            tempdeck.set_temperature(temperature)
-        run.finish_step()
-        tempdeck.deactivate()
-
-    ############################################################################
-    # STEP 4: Transfer From temperature to magnet 485ul
-    ############################################################################
-    if (run.next_step()):
-
-        run.set_pip("left")  # p300 multi
-        hot_mix = Reagent(name='MIX_HOT',
-                          num_wells=1,  # change with num samples
-                          delay=0,
-                          flow_rate_aspirate=0.5,  # Original 0.5
-                          flow_rate_dispense=1,  # Original 1
-                          flow_rate_aspirate_mix=15,
-                          flow_rate_dispense_mix=25,
-                          reagent_reservoir_volume=528,
-                          h_cono=4,
-                          v_fondo=4 * math.pi * 4 ** 3 / 3)
-
-        air_gap_vol = 3
-        disposal_height = -5
-        pickup_height = 0.01
-
-        for source, destination in zip(temp_wells_multi, mag_wells_multi):
-            run.pick_up()
-            run.move_volume(reagent=hot_mix, source=source,
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height,
-                            rinse=True, touch_tip=True)
-            run.move_volume(reagent=hot_mix, source=source,
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height,
-                            rinse=True, touch_tip=True)
-            run.move_volume(reagent=hot_mix, source=source,
-                            dest=destination, vol=135, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height,
-                            rinse=True, touch_tip=True)
-            run.drop_tip()
-
-        run.finish_step()
-
-    # Extraer liquido sin tocar los beats. Slot 7 - Piscina Slot 3
-    def move_magnet_to_trash(move_vol_steps=3, liquid_pass='Sobrenadante'):
-        run.set_pip("left")  # p300 multi
-        # Sobre nadante primer paso
-        liquid = Reagent(name=liquid_pass,
-                         num_wells=1,  # change with num samples
-                         delay=0,
-                         flow_rate_aspirate=0.1,  # Original 0.5
-                         flow_rate_dispense=3,  # Original 1
-                         flow_rate_aspirate_mix=15,
-                         flow_rate_dispense_mix=25,
-                         reagent_reservoir_volume=528,
-                         h_cono=4,
-                         v_fondo=4 * math.pi * 4 ** 3 / 3)
-        air_gap_vol = 3
-        pickup_height = 0.01
-        disposal_height = -5
-        # Hay que revisar los offsets para el movimiento este
-        for source, destination in zip(mag_wells_multi, trash_wells_multi):
-            # Replace this
-            run.pick_up()
-            run.move_volume(reagent=liquid, source=source,
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height,
-                            rinse=False, post_dispense=True)
-
-            # Patch for last step of etho 250ul instead of 500
-            if(move_vol_steps == 3):
-                run.move_volume(reagent=liquid, source=source,
-                                dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                                pickup_height=pickup_height, disp_height=disposal_height,
-                                rinse=False, post_dispense=True)
-
-            # We want to empty does not matter if we aspirate more
-            run.move_volume(reagent=liquid, source=source,
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height,
-                            rinse=False, post_dispense=True)
-            run.drop_tip()
-
-    ############################################################################
-    # STEP 5: Magnet on 10 minutos
-    ############################################################################
-    if (run.next_step()):
-        if (set_mag_on):
-            magdeck.engage(height=mag_height)
-        run.finish_step()
-
-    ############################################################################
-    # STEP 6: Extract liquid from magnet to liquid trash
-    ############################################################################
-    if (run.next_step()):
-        move_magnet_to_trash()
-        run.finish_step()
-
-    ############################################################################
-    # STEP 7: Magnet off
-    ############################################################################
-    if (run.next_step()):
-        magdeck.disengage()
-        run.finish_step()
-
-    ############################################################################
-    # STEP 8: Add 500ul de WB a los bits 4 - 7
-    ############################################################################
-    if (run.next_step()):
-        run.set_pip("left")  # p300 multi
+            run.start_temperature(tempdeck, temperature)
+        run.mark_event('plate_B_loaded')
+
+    for plate in plates:
+        run.register_step(plate_first[plate]+23, add_elution)
+    if interleave_plates:
+        run.register_step(plate_first['B']+1, add_beads)
+        run.register_step(plate_first['B']+2, load_plate_b)
+    run.log_schedule()
+
+    for plate in plates:
+        # Washes of the beads on the magnet, reagents are refilled for each plate
+        supernatant = Reagent(name='Sobrenadante',
+                              num_wells=1,  # change with num samples
+                              delay=0,
+                              flow_rate_aspirate=0.1,  # Original 0.5
+                              flow_rate_dispense=3,  # Original 1
+                              flow_rate_aspirate_mix=15,
+                              flow_rate_dispense_mix=25,
+                              reagent_reservoir_volume=528,
+                              h_cono=4,
+                              v_fondo=4 * math.pi * 4 ** 3 / 3)
         wb = Reagent(name='WB',
                      num_wells=5,  # change with num samples
                      delay=0,
@@ -351,319 +371,384 @@ def run(ctx: protocol_api.ProtocolContext):
                      reagent_reservoir_volume=50000,
                      h_cono=4,
                      v_fondo=4 * math.pi * 4 ** 3 / 30)
-
-        air_gap_vol = 3
-        disposal_height = -1  # Arriba y el último paso lo hacemos dentro
         wb.set_positions(wbetoh_slot.rows()[0][0:6])
+        # Used twice in the next steps
+        etoh = Reagent(name='Etoh',
+                       num_wells=10,  # change with num samples
+                       delay=0,
+                       flow_rate_aspirate=3,  # Original 0.5
+                       flow_rate_dispense=3,  # Original 1
+                       flow_rate_aspirate_mix=15,
+                       flow_rate_dispense_mix=25,
+                       reagent_reservoir_volume=100000,
+                       h_cono=4,
+                       v_fondo=4 * math.pi * 4 ** 3 / 3)
+        etoh.set_positions(wbetoh_slot.rows()[0][0:10])
+        run.stock_reagent(wb)
+        run.stock_reagent(etoh)
+
+        # The lysate is added by the transfer of step 4
+        binding = WashCycle(run, magdeck, mag_wells_multi, run.waste, reagent=supernatant,
+                            supernatant=supernatant, volume=485, engage_height=mag_height)
+        wash_wb = WashCycle(run, magdeck, mag_wells_multi, run.waste, reagent=wb,
+                            supernatant=supernatant, volume=485, mix_rounds=10,
+                            engage_height=mag_height, source_area=pool_area)
+        wash_etoh = WashCycle(run, magdeck, mag_wells_multi, run.waste, reagent=etoh,
+                              supernatant=supernatant, volume=485, mix_rounds=5,
+                              engage_height=mag_height, source_area=pool_area)
+        wash_etoh_final = WashCycle(run, magdeck, mag_wells_multi, run.waste, reagent=etoh,
+                                    supernatant=supernatant, volume=300, mix_rounds=5,
+                                    engage_height=mag_height, source_area=pool_area)
 
-        for destination in mag_wells_multi:
-            run.pick_up()
-            pickup_height = wb.calc_height(pool_area, 175*8, extra_volume=10)
-            run.move_volume(reagent=wb, source=wb.get_current_position(),
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=5, disp_height=disposal_height,
-                            post_dispense=True)
-            pickup_height = wb.calc_height(pool_area, 175*8, extra_volume=10)
-            run.move_volume(reagent=wb, source=wb.get_current_position(),
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=5, disp_height=disposal_height,
-                            post_dispense=True)
-
-            # This will be drop inside
-            pickup_height = wb.calc_height(pool_area, 135*8, extra_volume=10)
-            run.move_volume(reagent=wb, source=wb.get_current_position(),
-                            dest=destination, vol=135, air_gap_vol=air_gap_vol,
-                            pickup_height=5, disp_height=-10)
-
-            run.custom_mix(wb, location=destination, vol=175,
-                           rounds=10, blow_out=True, mix_height=0)
-            run.drop_tip()
-
-        run.finish_step()
-
-    ############################################################################
-    # STEP 9: Magnet on 2 minutos
-    ############################################################################
-    if (run.next_step()):
-        if (set_mag_on):
-            magdeck.engage(height=mag_height)
-        run.finish_step()
-    ############################################################################
-    # STEP 10: Extract liquid from magnet to liquid trash
-    ############################################################################
-    if (run.next_step()):
-        move_magnet_to_trash()
-        run.finish_step()
-
-    ############################################################################
-    # STEP 11: Magnet off
-    ############################################################################
-    if (run.next_step()):
-        magdeck.disengage()
-        run.finish_step()
-
-    ############################################################################
-    # STEP 12: Pause to replace
-    ############################################################################
-    if (run.next_step()):
-        run.blink()
-        ctx.pause(
-            'Replace tips, add WB, add ETOH, vaciar piscina y trash. Cambiar nuevo DW SLOT 10')
-        run.reset_pip_count(run.get_current_pip())
-        run.finish_step()
-
-    # Used twice in the next steps
-    etoh = Reagent(name='Etoh',
-                   num_wells=10,  # change with num samples
-                   delay=0,
-                   flow_rate_aspirate=3,  # Original 0.5
-                   flow_rate_dispense=3,  # Original 1
-                   flow_rate_aspirate_mix=15,
-                   flow_rate_dispense_mix=25,
-                   reagent_reservoir_volume=100000,
-                   h_cono=4,
-                   v_fondo=4 * math.pi * 4 ** 3 / 3)
-
-    etoh.set_positions(wbetoh_slot.rows()[0][0:10])
+        ############################################################################
+        # STEP 1:
+        ############################################################################
+        if (run.next_step()):
+            add_beads()
+            run.finish_step()
 
-    ############################################################################
-    # STEP 13: Add 500ul de etoh a los beats Slot 8 - 7
-    ############################################################################
-    if (run.next_step()):
-        run.set_pip("left")  # p300 multi
-        hot_mix = etoh
-        air_gap_vol = 3
-        disposal_height = -1  # Arriba y el último paso lo hacemos dentro
-        pickup_height = 1
+        ############################################################################
+        # STEP 2
+        ############################################################################
+        if (run.next_step()):
+            if plate == 'B':
+                load_plate_b()
+            else:
+                run.blink()
+                if interleave_plates:
+                    run.tip_pause(
+                        'Go to the hood to disable sample, empty trash, move Slot2 -> Slot 10. New DW on Slot 2 and beads on Slot 3 for plate B')
+                else:
+                    run.tip_pause(
+                        'Go to the hood to disable sample, empty trash, move Slot2 -> Slot 10')
+            run.finish_step()
 
-        for destination in mag_wells_multi:
-            run.pick_up()
-            pickup_height = etoh.calc_height(pool_area, 175*8, extra_volume=10)
-            run.move_volume(reagent=etoh, source=etoh.get_current_position(),
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height,
-                            post_dispense=True)
-            pickup_height = etoh.calc_height(pool_area, 175*8, extra_volume=10)
-            run.move_volume(reagent=etoh, source=etoh.get_current_position(),
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height,
-                            post_dispense=True)
+        ############################################################################
+        # STEP 3: Incubation at 65ºC
+        ############################################################################
+        if (run.next_step()):
+            if plate == 'B':
+                # Plate B was incubated during the washes of plate A
+                run.blink()
+                run.tip_pause(
+                    'Return plate B to Slot 10, remove RNA of plate A from Slot 2, new DW on Slot 7, add WB, vaciar trash')
+            elif (set_temp_on):
+                run.await_temperature(tempdeck, temperature)
+            run.finish_step()
+            tempdeck.deactivate()
 
-            # This will be drop inside
-            pickup_height = etoh.calc_height(pool_area, 135*8, extra_volume=10)
-            run.move_volume(reagent=etoh, source=etoh.get_current_position(),
-                            dest=destination, vol=135, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height-3)
+        ############################################################################
+        # STEP 4: Transfer From temperature to magnet 485ul
+        ############################################################################
+        if (run.next_step()):
+
+            run.set_pip("left")  # p300 multi
+            hot_mix = Reagent(name='MIX_HOT',
+                              num_wells=1,  # change with num samples
+                              delay=0,
+                              flow_rate_aspirate=0.5,  # Original 0.5
+                              flow_rate_dispense=1,  # Original 1
+                              flow_rate_aspirate_mix=15,
+                              flow_rate_dispense_mix=25,
+                              reagent_reservoir_volume=528,
+                              h_cono=4,
+                              v_fondo=4 * math.pi * 4 ** 3 / 3)
+
+            air_gap_vol = 3
+            disposal_height = -5
+            pickup_height = 0.01
+
+            for source, destination in zip(temp_wells_multi, mag_wells_multi):
+                run.pick_up(near=source)
+                run.move_volume(reagent=hot_mix, source=source,
+                                dest=destination, vol=175, air_gap_vol=air_gap_vol,
+                                pickup_height=pickup_height, disp_height=disposal_height,
+                                rinse=True, touch_tip=True)
+                run.move_volume(reagent=hot_mix, source=source,
+                                dest=destination, vol=175, air_gap_vol=air_gap_vol,
+                                pickup_height=pickup_height, disp_height=disposal_height,
+                                rinse=True, touch_tip=True)
+                run.move_volume(reagent=hot_mix, source=source,
+                                dest=destination, vol=135, air_gap_vol=air_gap_vol,
+                                pickup_height=pickup_height, disp_height=disposal_height,
+                                rinse=True, touch_tip=True)
+                run.drop_tip()
 
-            run.custom_mix(etoh, location=destination, vol=175,
-                           rounds=5, blow_out=True, mix_height=0)
-            run.drop_tip()
+            run.finish_step()
 
-    ############################################################################
-    # STEP 14: Magnet on 10 minutos
-    ############################################################################
-    if (run.next_step()):
-        if (set_mag_on):
-            magdeck.engage(height=mag_height)
-        run.finish_step()
-    ############################################################################
-    # STEP 15: Extract liquid from magnet to liquid trash
-    ############################################################################
-    if (run.next_step()):
-        move_magnet_to_trash()
-        run.finish_step()
+        ############################################################################
+        # STEP 5: Magnet on 10 minutos
+        ############################################################################
+        if (run.next_step()):
+            if (set_mag_on):
+                binding.engage()
+            run.finish_step()
 
-    ############################################################################
-    # STEP 16: Magnet off
-    ############################################################################
-    if (run.next_step()):
-        magdeck.disengage()
-        run.finish_step()
+        ############################################################################
+        # STEP 6: Extract liquid from magnet to liquid trash
+        ############################################################################
+        if (run.next_step()):
+            binding.discard()
+            run.finish_step()
 
-    ############################################################################
-    # STEP 17: Add 250 de etoh a los beats Slot 8 - 7
-    ############################################################################
-    if (run.next_step()):
-        run.set_pip("left")  # p300 multi
-        liquid = etoh
-        air_gap_vol = 3
-        disposal_height = -1  # Arriba y el último paso lo hacemos dentro
-        pickup_height = 1
+        ############################################################################
+        # STEP 7: Magnet off
+        ############################################################################
+        if (run.next_step()):
+            binding.disengage()
+            run.finish_step()
 
-        for destination in mag_wells_multi:
-            run.pick_up()
-            run.move_volume(reagent=liquid, source=etoh.get_current_position(),
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height,
-                            post_dispense=True)
-            # This will be drop inside
-            run.move_volume(reagent=liquid, source=etoh.get_current_position(),
-                            dest=destination, vol=125, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=-10)
+        ############################################################################
+        # STEP 8: Add 500ul de WB a los bits 4 - 7
+        ############################################################################
+        if (run.next_step()):
+            wash_wb.add()
+            run.finish_step()
 
-            run.custom_mix(etoh, location=destination, vol=175,
-                           rounds=5, blow_out=True, mix_height=0)
+        ############################################################################
+        # STEP 9: Magnet on 2 minutos
+        ############################################################################
+        if (run.next_step()):
+            if (set_mag_on):
+                wash_wb.engage()
+            run.finish_step()
+        ############################################################################
+        # STEP 10: Extract liquid from magnet to liquid trash
+        ############################################################################
+        if (run.next_step()):
+            wash_wb.discard()
+            run.finish_step()
 
-            run.drop_tip()
+        ############################################################################
+        # STEP 11: Magnet off
+        ############################################################################
+        if (run.next_step()):
+            wash_wb.disengage()
+            run.finish_step()
 
-    ############################################################################
-    # STEP 18: Magnet on 2 minutos
-    ############################################################################
-    if (run.next_step()):
-        if (set_mag_on):
-            magdeck.engage(height=mag_height)
-        run.finish_step()
+        ############################################################################
+        # STEP 12: Pause to replace
+        ############################################################################
+        if (run.next_step()):
+            run.blink()
+            if plate == 'A' and interleave_plates:
+                run.tip_pause(
+                    'Add ETOH, Elution Buffer en SLOT 3, vaciar trash. Plate B stays on SLOT 10')
+            else:
+                run.tip_pause(
+                    'Add WB, add ETOH, Elution Buffer en SLOT 3, vaciar trash. Cambiar nuevo DW SLOT 10')
+            run.finish_step()
 
-    ############################################################################
-    # STEP 19: Extract liquid from magnet to liquid trash
-    ############################################################################
-    if (run.next_step()):
-        move_magnet_to_trash(move_vol_steps=2)
-        run.finish_step()
 
-    ############################################################################
-    # STEP 20: Secar durante 10 minutos
-    ############################################################################
-    if (run.next_step()):
-        move_magnet_to_trash(move_vol_steps=2)
-        run.finish_step()
+        ############################################################################
+        # STEP 13: Add 500ul de etoh a los beats Slot 8 - 7
+        ############################################################################
+        if (run.next_step()):
+            wash_etoh.add()
+            run.finish_step()
 
-    ############################################################################
-    # STEP 21: Magnet off
-    ############################################################################
-    if (run.next_step()):
-        magdeck.disengage()
-        run.finish_step()
+        ############################################################################
+        # STEP 14: Magnet on 10 minutos
+        ############################################################################
+        if (run.next_step()):
+            if (set_mag_on):
+                wash_etoh.engage()
+            run.finish_step()
+        ############################################################################
+        # STEP 15: Extract liquid from magnet to liquid trash
+        ############################################################################
+        if (run.next_step()):
+            wash_etoh.discard()
+            run.finish_step()
 
-    ############################################################################
-    # STEP 22: Pause to replace
-    ############################################################################
-    if (run.next_step()):
-        run.blink()
-        ctx.pause(
-            'Replace tips, add WB, add ETOH, vaciar piscina y trash. Cambiar nuevo DW SLOT 10')
+        ############################################################################
+        # STEP 16: Magnet off
+        ############################################################################
+        if (run.next_step()):
+            wash_etoh.disengage()
+            run.finish_step()
 
-        run.reset_pip_count(run.get_current_pip())
-        run.finish_step()
+        ############################################################################
+        # STEP 17: Add 250 de etoh a los beats Slot 8 - 7
+        ############################################################################
+        if (run.next_step()):
+            wash_etoh_final.add()
+            run.finish_step()
 
-    ############################################################################
-    # STEP 23: Add elution move to temperature same tip 4 -> 7 -> 10
-    ############################################################################
+        ############################################################################
+        # STEP 18: Magnet on 2 minutos
+        ############################################################################
+        if (run.next_step()):
+            if (set_mag_on):
+                wash_etoh_final.engage()
+            run.finish_step()
 
-    # Used to move from temp to magnet and from magnet to destionation
-    elu_beads = Reagent(name='BitsToHot',
-                        num_wells=1,  # change with num samples
-                        delay=0,
-                        flow_rate_aspirate=3,  # Original 0.5
-                        flow_rate_dispense=3,  # Original 1
-                        flow_rate_aspirate_mix=15,
-                        flow_rate_dispense_mix=25,
-                        reagent_reservoir_volume=528,
-                        h_cono=4,
-                        v_fondo=4 * math.pi * 4 ** 3 / 3)
-
-    if (run.next_step()):
-        # to liquid types
-        run.set_pip("left")  # p300 multi
-        elution = Reagent(name='Elution',
-                          num_wells=1,  # change with num samples
-                          delay=0,
-                          flow_rate_aspirate=3,  # Original 0.5
-                          flow_rate_dispense=3,  # Original 1
-                          flow_rate_aspirate_mix=15,
-                          flow_rate_dispense_mix=25,
-                          reagent_reservoir_volume=528,
-                          h_cono=4,
-                          v_fondo=4 * math.pi * 4 ** 3 / 3)
-        air_gap_vol = 3
-        disposal_height = -5
-        pickup_height = 0.01
-        for source, dest_source, destination in zip(wb_wells_multi, mag_wells_multi, temp_wells_multi):
-            run.pick_up()
-            run.move_volume(reagent=elution, source=source,
-                            dest=dest_source, vol=50, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height)
+        ############################################################################
+        # STEP 19: Extract liquid from magnet to liquid trash
+        ############################################################################
+        if (run.next_step()):
+            wash_etoh_final.discard()
+            run.finish_step()
 
-            run.custom_mix(elu_beads, location=dest_source, vol=40,
-                           rounds=10, blow_out=True, mix_height=0)
+        ############################################################################
+        # STEP 20: Secar durante 10 minutos
+        ############################################################################
+        if (run.next_step()):
+            # Second pass for the EtOH left at the bottom
+            wash_etoh_final.discard()
+            # Drying counts from the last column emptied by the second pass
+            run.mark_event('supernatant_removed')
+            run.finish_step()
 
-            # This will be drop inside
-            run.move_volume(reagent=elu_beads, source=dest_source,
-                            dest=destination, vol=50, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=-10)
+        ############################################################################
+        # STEP 21: Magnet off
+        ############################################################################
+        if (run.next_step()):
+            wash_etoh_final.disengage()
+            run.finish_step()
 
-            run.drop_tip()
+        ############################################################################
+        # STEP 22: Pause to replace
+        ############################################################################
+        if (run.next_step()):
+            if plate == 'A' and interleave_plates:
+                # Plate B leaves the tempdeck once its incubation is over
+                if 'plate_B_loaded' in run.events:
+                    run.wait_after('plate_B_loaded',
+                                   run.step_list[plate_first['B']+2]['wait_time'])
+                run.blink()
+                run.tip_pause(
+                    'Vaciar trash. Move plate B from SLOT 10 to the bench, new DW SLOT 10 for the elution')
+            else:
+                run.blink()
+                run.tip_pause(
+                    'Add WB, add ETOH, vaciar trash. Cambiar nuevo DW SLOT 10')
 
-        run.finish_step()
+            run.finish_step()
 
-    ############################################################################
-    # STEP 25: Incubation at 65ºC
-    ############################################################################
-    if (run.next_step()):
-        if (set_temp_on):
-            tempdeck.set_temperature(temperature)
-        run.finish_step()
+        ############################################################################
+        # STEP 23: Add elution to temperature 3 -> 10
+        ############################################################################
+        if (run.next_step()):
+            add_elution()
+            run.finish_step()
 
-        run.finish_step()
+        ############################################################################
+        # STEP 24: Resuspend beads with the elution, same tip 10 -> 7 -> 10
+        ############################################################################
 
-    ############################################################################
-    # STEP 26: Move from temp to magnet
-    ############################################################################
-    if (run.next_step()):
-        run.set_pip("left")  # p300 multi
-        result = Reagent(name='Elution+magnets',
-                         num_wells=1,  # change with num samples
-                         delay=0,
-                         flow_rate_aspirate=1,  # Original 0.5
-                         flow_rate_dispense=3,  # Original 1
-                         flow_rate_aspirate_mix=15,
-                         flow_rate_dispense_mix=25,
-                         reagent_reservoir_volume=528,
-                         h_cono=4,
-                         v_fondo=4 * math.pi * 4 ** 3 / 3)
-
-        for source, destination in zip(temp_wells_multi, mag_wells_multi):
-            run.pick_up()
-            run.move_volume(reagent=result, source=source,
-                            dest=destination, vol=1, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height)
-            run.drop_tip()
+        # Used to move from temp to magnet and from magnet to destionation
+        elu_beads = Reagent(name='BitsToHot',
+                            num_wells=1,  # change with num samples
+                            delay=0,
+                            flow_rate_aspirate=3,  # Original 0.5
+                            flow_rate_dispense=3,  # Original 1
+                            flow_rate_aspirate_mix=15,
+                            flow_rate_dispense_mix=25,
+                            reagent_reservoir_volume=528,
+                            h_cono=4,
+                            v_fondo=4 * math.pi * 4 ** 3 / 3)
+
+        if (run.next_step()):
+            run.set_pip("left")  # p300 multi
+            air_gap_vol = 3
+            disposal_height = -5
+            pickup_height = 0.01
+            for dest_source, destination in zip(mag_wells_multi, temp_wells_multi):
+                run.pick_up(near=destination)
+                run.move_volume(reagent=elu_beads, source=destination,
+                                dest=dest_source, vol=50, air_gap_vol=air_gap_vol,
+                                pickup_height=pickup_height, disp_height=disposal_height)
+
+                run.custom_mix(elu_beads, location=dest_source, vol=40,
+                               rounds=10, blow_out=True, mix_height=0)
+
+                # This will be drop inside
+                run.move_volume(reagent=elu_beads, source=dest_source,
+                                dest=destination, vol=50, air_gap_vol=air_gap_vol,
+                                pickup_height=pickup_height, disp_height=-10)
+
+                run.drop_tip()
+
+            run.finish_step()
 
-        run.finish_step()
+        ############################################################################
+        # STEP 25: Incubation at 65ºC
+        ############################################################################
+        if (run.next_step()):
+            if (set_temp_on):
+                run.await_temperature(tempdeck, temperature)
+            run.finish_step()
 
-    ############################################################################
-    # STEP 27: Magnet on 3 minutos
-    ############################################################################
-    if (run.next_step()):
-        if (set_mag_on):
-            magdeck.engage(height=mag_height)
-        run.finish_step()
+        ############################################################################
+        # STEP 26: Move from temp to magnet
+        ############################################################################
+        if (run.next_step()):
+            run.set_pip("left")  # p300 multi
+            result = Reagent(name='Elution+magnets',
+                             num_wells=1,  # change with num samples
+                             delay=0,
+                             flow_rate_aspirate=1,  # Original 0.5
+                             flow_rate_dispense=3,  # Original 1
+                             flow_rate_aspirate_mix=15,
+                             flow_rate_dispense_mix=25,
+                             reagent_reservoir_volume=528,
+                             h_cono=4,
+                             v_fondo=4 * math.pi * 4 ** 3 / 3)
+
+            for source, destination in zip(temp_wells_multi, mag_wells_multi):
+                run.pick_up(near=source)
+                run.move_volume(reagent=result, source=source,
+                                dest=destination, vol=1, air_gap_vol=air_gap_vol,
+                                pickup_height=pickup_height, disp_height=disposal_height)
+                run.drop_tip()
+
+            run.finish_step()
 
-    ############################################################################
-    # STEP 28: Move from magnet to final output slot 2
-    ############################################################################
-    if (run.next_step()):
-        run.set_pip("left")  # p300 multi
-        result = Reagent(name='Elution-magnets',
-                         num_wells=1,  # change with num samples
-                         delay=0,
-                         flow_rate_aspirate=0.1,  # Original 0.5
-                         flow_rate_dispense=3,  # Original 1
-                         flow_rate_aspirate_mix=15,
-                         flow_rate_dispense_mix=25,
-                         reagent_reservoir_volume=528,
-                         h_cono=4,
-                         v_fondo=4 * math.pi * 4 ** 3 / 3)
-        for source, destination in zip(temp_wells_multi, mag_wells_multi):
-            run.pick_up()
-            run.move_volume(reagent=result, source=source,
-                            dest=destination, vol=50, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height)
-            run.drop_tip()
+        ############################################################################
+        # STEP 27: Magnet on 3 minutos
+        ############################################################################
+        if (run.next_step()):
+            if (set_mag_on):
+                magdeck.engage(height=mag_height)
+            run.finish_step()
 
-        run.finish_step()
+        ############################################################################
+        # STEP 28: Move from magnet to final output slot 2
+        ############################################################################
+        if (run.next_step()):
+            run.set_pip("left")  # p300 multi
+            result = Reagent(name='Elution-magnets',
+                             num_wells=1,  # change with num samples
+                             delay=0,
+                             flow_rate_aspirate=0.1,  # Original 0.5
+                             flow_rate_dispense=3,  # Original 1
+                             flow_rate_aspirate_mix=15,
+                             flow_rate_dispense_mix=25,
+                             reagent_reservoir_volume=528,
+                             h_cono=4,
+                             v_fondo=4 * math.pi * 4 ** 3 / 3)
+            for source, destination in zip(temp_wells_multi, mag_wells_multi):
+                run.pick_up(near=source)
+                run.move_volume(reagent=result, source=source,
+                                dest=destination, vol=50, air_gap_vol=air_gap_vol,
+                                pickup_height=pickup_height, disp_height=disposal_height)
+                run.drop_tip()
+
+            run.finish_step()
 
     run.log_steps_time()
+    run.log_usage()
+    run.log_tips()
+    run.log_tip_recycling()
+    run.log_waste()
+    run.save_inventory()
+    run.flush_modules()
+    run.log_module_savings()
+    run.log_estimated_time()
+    # Keep the block hot for the next plate, it saves the ramp of the next run
+    if (set_temp_on and not next_plate_queued):
+        tempdeck.deactivate()
     run.blink()
     ctx.comment('Finished! \nMove plate to PCR')
 
@@ -721,6 +806,11 @@ class Reagent:
             else:
                 self.vol_well = math.ceil(self.vol_well_max)
 
+        # Volume above the cone of every well when it is filled, and the volume
+        # left in the wells already used
+        self.fill = [self.vol_well] + [self.vol_well_max for _ in range(1, self.num_wells)]
+        self.left_behind = []
+
     def get_current_position(self):
 
         return self.reagent_reservoir[self.col]
@@ -744,16 +834,36 @@ class Reagent:
 
     def next_column(self):
         # Move to next position inside reagent
+        self.left_behind.append(self.vol_well)
         self.col = self.col+1
         if(self.col < self.num_wells):
-            self.vol_well = self.vol_well_max
+            self.vol_well = self.fill[self.col]
         else:
             self.vol_well = self.vol_last_well
 
+    def well_volumes(self):
+        # Volume above the cone left in every well of the reservoir
+        volumes = self.left_behind + [self.vol_well] + self.fill[self.col+1:]
+        return volumes[:self.num_wells]
+
+    def start_from(self, volumes):
+        '''
+        Wells filled from the [volumes] left by the last run, topped up to the
+        nominal fill. Returns the volume to add to every well.
+        '''
+        top_up = [max(fill - left, 0) for fill, left in zip(self.fill, volumes)]
+        self.fill = [max(fill, left) for fill, left in zip(self.fill, volumes)]
+        self.vol_well = self.fill[0]
+        return top_up
+
     def calc_height(self, cross_section_area, aspirate_volume,
-                    min_height=0.3):
+                    min_height=0.3, extra_volume=0):
+        '''
+        Height to aspirate [aspirate_volume] from the current well, moving to the
+        next one if it would leave less than [extra_volume] in the well.
+        '''
 
-        if self.vol_well < aspirate_volume:
+        if self.vol_well - extra_volume < aspirate_volume:
             # column selector position; intialize to required number
             self.next_column()
 
@@ -775,26 +885,646 @@ class Reagent:
         return vol_list
 
 
+class WashCycle:
+    '''
+    Wash of the beads on the magnetic module: add [reagent], mix, engage, wait,
+    discard the supernatant and disengage. Volumes are split in the fewest passes
+    the pipette can hold, with a new tip for every column in each phase. The steps
+    of the protocol run the phases and keep the wait of the magnet.
+    '''
+
+    def __init__(self, run, magdeck, wells, trash, reagent, supernatant, volume,
+                 mix_rounds=5, mix_volume=175, engage_height=6.5,
+                 discard_volume=None, air_gap_vol=3,
+                 pickup_height=1, source_area=None, disp_height=-1, last_disp_height=-10,
+                 discard_height=0.01, trash_height=-5):
+        self.run = run
+        self.magdeck = magdeck
+        self.wells = wells
+        self.trash = trash  # WasteLedger of the liquid trash
+        self.reagent = reagent
+        self.supernatant = supernatant
+        self.volume = volume
+        self.mix_rounds = mix_rounds
+        self.mix_volume = mix_volume
+        self.engage_height = engage_height
+        # Aspirate more than was added to be sure the well is empty
+        self.discard_volume = discard_volume if discard_volume != None else volume*1.1
+        self.air_gap_vol = air_gap_vol
+        self.pickup_height = pickup_height
+        self.source_area = source_area  # Follow the level of the reservoir if set
+        self.disp_height = disp_height
+        self.last_disp_height = last_disp_height
+        self.discard_height = discard_height
+        self.trash_height = trash_height
+        self.times = {}
+
+    def passes(self, volume):
+        # Fewest transfers that fit in the tip together with the air gap
+        return self.reagent.divide_volume(volume, self.run.get_pip_capacity()-self.air_gap_vol)
+
+    def source(self, volume):
+        if self.source_area != None:
+            channels = self.run.get_current_pip().channels
+            height = self.reagent.calc_height(self.source_area, volume*channels)
+            return self.reagent.get_current_position(), height
+        return self.reagent.get_current_position(), self.pickup_height
+
+    def add(self):
+        start = self.run.clock.now()
+        passes = self.passes(self.volume)
+        tips = 0
+        for destination in self.wells:
+            self.run.pick_up(near=self.reagent.get_current_position())
+            tips += 1
+            for i, vol in enumerate(passes):
+                last = i == len(passes)-1
+                source, pickup_height = self.source(vol)
+                self.run.move_volume(reagent=self.reagent, source=source,
+                                     dest=destination, vol=vol, air_gap_vol=self.air_gap_vol,
+                                     pickup_height=pickup_height,
+                                     disp_height=self.last_disp_height if last else self.disp_height)
+            if self.mix_rounds > 0:
+                self.run.custom_mix(self.reagent, location=destination, vol=self.mix_volume,
+                                    rounds=self.mix_rounds, blow_out=True, mix_height=0)
+            self.run.drop_tip()
+        self.log('add', start, passes, tips)
+
+    def engage(self):
+        self.magdeck.engage(height=self.engage_height)
+
+    def discard(self):
+        start = self.run.clock.now()
+        passes = self.passes(self.discard_volume)
+        channels = self.run.get_current_pip().channels
+        for source in self.wells:
+            destination = self.run.waste_well(self.trash, self.discard_volume*channels)
+            self.run.pick_up(near=source)
+            for vol in passes:
+                self.run.move_volume(reagent=self.supernatant, source=source,
+                                     dest=destination, vol=vol, air_gap_vol=self.air_gap_vol,
+                                     pickup_height=self.discard_height,
+                                     disp_height=self.trash_height)
+            self.run.drop_tip()
+        self.log('discard', start, passes, len(self.wells))
+
+    def disengage(self):
+        self.magdeck.disengage()
+
+    def log(self, phase, start, passes, tips):
+        seconds = self.run.clock.now() - start
+        self.times[phase] = self.times.get(phase, 0) + seconds
+        self.run.comment('%s %s: %d passes of %s ul, %d tips, %s' % (
+            self.reagent.name, phase, len(passes), passes[0], tips,
+            timedelta(seconds=int(seconds))))
+
+
+class WasteLedger:
+    '''
+    Liquid waste in every well of [wells], [capacity] ul each. Every discard goes
+    to the emptiest well, so the volume is spread over the whole reservoir.
+    '''
+
+    def __init__(self, wells, capacity):
+        self.wells = wells
+        self.capacity = capacity
+        self.volumes = [0 for _ in wells]
+        self.emptied = 0
+        self.fullest = 0
+
+    def well(self, volume, volumes=None):
+        # Index of the emptiest well if it has room for [volume], None if not
+        volumes = volumes if volumes != None else self.volumes
+        index = min(range(len(volumes)), key=lambda i: (volumes[i], i))
+        return index if volumes[index] + volume <= self.capacity else None
+
+    def add(self, index, volume):
+        self.volumes[index] += volume
+        self.fullest = max(self.fullest, self.volumes[index])
+
+    def place(self, discards, volumes):
+        # Volumes of the wells after the [discards], None if they do not fit
+        volumes = list(volumes)
+        for volume in discards:
+            index = self.well(volume, volumes)
+            if index == None:
+                return None
+            volumes[index] += volume
+        return volumes
+
+    def empty(self):
+        self.volumes = [0 for _ in self.wells]
+        self.emptied += 1
+
+    def slot(self):
+        return str(self.wells[0].parent.parent)
+
+
+class TipLedger:
+    '''
+    Tips taken from every rack of a pipette. The tips are picked up from the racks
+    in the order they were mounted, a whole column at a time for a multichannel,
+    and the racks of [reserve] last. With reserve racks an empty rack is refilled
+    by the operator while the robot goes on with the next one.
+    '''
+
+    def __init__(self, pip, racks, increment, size=96, reserve=[]):
+        self.pip = pip
+        self.racks = [rack for rack in racks if rack not in reserve] + \
+            [rack for rack in racks if rack in reserve]
+        self.increment = increment
+        self.size = size
+        self.hot_swap = len(reserve) > 0
+        self.reserve = len(reserve)
+        self.used = [0 for _ in racks]
+        self.refill = []  # Racks emptied and waiting to be refilled
+        self.replaced = 0
+        # mm from the tips to the sources, and the ones in rack order would have taken
+        self.travel = 0
+        self.travel_in_order = 0
+
+    def available(self, index, refilled=False):
+        if index in self.refill:
+            return self.size if refilled else 0
+        # A partial column does not count for a multi
+        return (self.size - self.used[index])//self.increment*self.increment
+
+    def left(self, refilled=False):
+        return sum(self.available(i, refilled) for i in range(len(self.racks)))
+
+    def capacity(self):
+        return len(self.racks)*self.size
+
+    def tip(self, index):
+        return self.racks[index].wells()[self.used[index]]
+
+    def distance(self, index, well):
+        # On the deck plane, the heights of the labware do not matter
+        tip = self.tip(index).top().point
+        target = well.top().point
+        return math.hypot(tip.x - target.x, tip.y - target.y)
+
+    def next_rack(self, near=None):
+        '''
+        Rack of the next tip, None if all of them are empty. The first one in
+        order, or the one closest to the [near] location. Reserve racks are only
+        used when the rest are empty, so they are kept full for the hot swap.
+        '''
+        candidates = [i for i in range(len(self.racks)) if self.available(i) > 0]
+        if len(candidates) == 0:
+            return None
+        if candidates[0] < len(self.racks) - self.reserve:
+            candidates = [i for i in candidates if i < len(self.racks) - self.reserve]
+        if near == None:
+            return candidates[0]
+        index = min(candidates, key=lambda i: (self.distance(i, near), i))
+        self.travel += self.distance(index, near)
+        self.travel_in_order += self.distance(candidates[0], near)
+        return index
+
+    def take(self, index):
+        '''
+        The tip of the rack [index] has been picked up. Returns the rack if it
+        has been emptied and has to be refilled while the robot goes on.
+        '''
+        self.used[index] += self.increment
+        if self.hot_swap and self.available(index) == 0:
+            self.refill.append(index)
+            return self.racks[index]
+        return None
+
+    def slots(self, indexes=None):
+        # Slots of the racks that have been used
+        if indexes == None:
+            indexes = [i for i, used in enumerate(self.used) if used > 0]
+        return [str(self.racks[i].parent) for i in indexes]
+
+    def refilled(self):
+        for index in self.refill:
+            self.racks[index].reset()
+            self.used[index] = 0
+        self.replaced += len(self.refill)
+        self.refill = []
+
+    def replace(self):
+        self.replaced += len(self.slots())
+        self.pip.reset_tipracks()
+        self.used = [0 for _ in self.racks]
+        self.refill = []
+
+
+class ThermalModel:
+    '''
+    Time the temperature module needs to ramp between two temperatures.
+    Heating and cooling are fitted separately from the ramps logged in the
+    previous runs as: seconds = lag + |delta| * seconds_per_degree
+    '''
+
+    def __init__(self, file_path=None, heat_rate=0.1, cool_rate=0.05, lag=20):
+        # Default rates in degrees per second, used until there are logged ramps
+        self.file_path = file_path
+        self.ramps = []
+        self.fit_params = {'heat': [lag, 1/heat_rate],
+                           'cool': [lag, 1/cool_rate]}
+
+        if self.file_path != None and os.path.isfile(self.file_path):
+            with open(self.file_path) as f:
+                self.ramps = json.load(f)["ramps"]
+            self.fit()
+
+    def direction(self, start, target):
+        if target >= start:
+            return 'heat'
+        return 'cool'
+
+    def fit(self):
+        # Least squares of the ramp time against the temperature delta
+        for direction in self.fit_params:
+            points = [[abs(target-start), seconds] for start, target, seconds in self.ramps
+                      if self.direction(start, target) == direction and abs(target-start) > 1]
+            if len(points) == 0:
+                continue
+            lag = self.fit_params[direction][0]
+            mean_delta = sum([p[0] for p in points])/len(points)
+            mean_seconds = sum([p[1] for p in points])/len(points)
+            var_delta = sum([(p[0]-mean_delta)**2 for p in points])
+            if len(points) > 1 and var_delta > 0:
+                slope = sum([(p[0]-mean_delta)*(p[1]-mean_seconds)
+                             for p in points])/var_delta
+                lag = max(mean_seconds - slope*mean_delta, 0)
+            else:
+                slope = (mean_seconds-lag)/mean_delta
+            if slope > 0:
+                self.fit_params[direction] = [lag, slope]
+
+    def ramp_time(self, start, target):
+        if abs(target-start) < 0.5:
+            return 0
+        lag, slope = self.fit_params[self.direction(start, target)]
+        return lag + abs(target-start)*slope
+
+    def add_ramp(self, start, target, seconds, max_ramps=50):
+        self.ramps.append([start, target, seconds])
+        self.ramps = self.ramps[-max_ramps:]
+        self.fit()
+        if self.file_path != None:
+            with open(self.file_path, 'w') as f:
+                json.dump({"ramps": self.ramps}, f)
+
+
+class ReagentInventory:
+    '''
+    Volume left in the wells of the reservoirs at the end of the last run, by
+    reagent name, saved in [file_path] so the next run starts from it.
+    '''
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self.reagents = {}
+        if self.file_path != None and os.path.isfile(self.file_path):
+            with open(self.file_path) as f:
+                self.reagents = json.load(f)["reagents"]
+
+    def left(self, wells):
+        # Name, volumes and date of the reagent the last run left in [wells]
+        for name, stock in self.reagents.items():
+            if len(set(stock['wells']) & set(wells)) > 0:
+                return dict(stock, name=name)
+        return None
+
+    def save(self, reagents):
+        # [reagents] are the ones in the reservoirs at the end of the run
+        self.reagents = {}
+        for reagent in reagents:
+            self.reagents[reagent.name] = {
+                'wells': ReagentInventory.wells(reagent),
+                'volumes': [round(volume) for volume in reagent.well_volumes()],
+                'date': datetime.now().strftime("%d/%m/%Y %H:%M")}
+        if self.file_path != None:
+            with open(self.file_path, 'w') as f:
+                json.dump({"reagents": self.reagents}, f, indent=2)
+
+    @staticmethod
+    def wells(reagent):
+        return [str(well) for well in reagent.reagent_reservoir[:reagent.num_wells]]
+
+
+class RunClock:
+    '''
+    Time of the run in seconds. On the robot it is the wall clock, in simulation
+    it is a virtual clock that waits, delays, blinks, pauses and the pipetting
+    time model (move_time, the flow rates and tip_change_time) advance instantly.
+    '''
+
+    def __init__(self, simulating):
+        self.simulating = simulating
+        self.virtual_time = 0
+
+    def now(self):
+        if self.simulating:
+            return self.virtual_time
+        return time.monotonic()
+
+    def advance(self, seconds):
+        if self.simulating:
+            self.virtual_time += seconds
+
+    def advance_to(self, instant):
+        if self.simulating:
+            self.virtual_time = max(self.virtual_time, instant)
+
+    def sleep(self, seconds):
+        if self.simulating:
+            self.advance(seconds)
+        else:
+            time.sleep(seconds)
+
+
+class TempDeckEmulator:
+    '''
+    Stand-in of the temperature module for simulation. The temperature follows
+    the ramps of the thermal model along the simulated time instead of jumping
+    to the setpoint, and waiting for it advances the virtual clock.
+    '''
+
+    def __init__(self, run, module, ambient=25):
+        self.run = run
+        self.module = module
+        self.ambient = ambient
+        self._target = None
+        self.ramp_start = [ambient, run.clock.now()]
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def temperature_at(self, t):
+        start, start_time = self.ramp_start
+        end = self._target if self._target != None else self.ambient
+        model = self.run.thermal_model
+        lag, slope = model.fit_params[model.direction(start, end)]
+        if abs(end - start) < 0.5 or t - start_time >= model.ramp_time(start, end):
+            return end
+        change = max(t - start_time - lag, 0) / slope
+        if end > start:
+            return start + change
+        return start - change
+
+    @property
+    def temperature(self):
+        return self.temperature_at(self.run.clock.now())
+
+    @property
+    def target(self):
+        return self._target
+
+    @property
+    def status(self):
+        if self._target == None:
+            return 'idle'
+        if self.temperature == self._target:
+            return 'holding at target'
+        if self._target > self.ramp_start[0]:
+            return 'heating'
+        return 'cooling'
+
+    def start_set_temperature(self, celsius):
+        self.ramp_start = [self.temperature, self.run.clock.now()]
+        self._target = celsius
+        self.module.start_set_temperature(celsius)
+
+    def await_temperature(self, celsius):
+        self.run.clock.advance_to(
+            self.ramp_start[1] + self.run.thermal_model.ramp_time(self.ramp_start[0], celsius))
+        self.module.await_temperature(celsius)
+
+    def set_temperature(self, celsius):
+        self.start_set_temperature(celsius)
+        self.await_temperature(celsius)
+
+    def deactivate(self):
+        # Without control the block drifts back to the ambient temperature
+        self.ramp_start = [self.temperature, self.run.clock.now()]
+        self._target = None
+        self.module.deactivate()
+
+
+class MagDeckEmulator:
+    '''
+    Stand-in of the magnetic module gen2 for simulation, engage and disengage
+    take the travel time of the magnets in the virtual clock.
+    '''
+
+    def __init__(self, run, module, speed=2):
+        self.run = run
+        self.module = module
+        self.speed = speed  # mm/s of the magnets
+        self.height = 0
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    @property
+    def status(self):
+        if self.height > 0:
+            return 'engaged'
+        return 'disengaged'
+
+    def move(self, height):
+        self.run.clock.advance(abs(height - self.height) / self.speed)
+        self.height = height
+
+    def engage(self, height):
+        self.move(height)
+        self.module.engage(height=height)
+
+    def disengage(self):
+        self.move(0)
+        self.module.disengage()
+
+
+class ModuleState:
+    '''
+    Wrapper of a hardware module that keeps track of its state, so commands
+    that would not change anything are skipped. Everything else is passed
+    to the module, so it can be used in place of it.
+    '''
+
+    def __init__(self, run, module):
+        self.run = run
+        self.module = module
+        self.skipped = 0
+        self.saved_time = 0
+        run.modules.append(self)
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def skip(self, command, seconds):
+        self.skipped += 1
+        self.saved_time += seconds
+        self.run.comment('Skipped %s, module already in that state' % command)
+
+    def flush(self):
+        pass
+
+
+class MagDeckState(ModuleState):
+    '''
+    Disengage is delayed until the next pipetting or pause, so a disengage
+    followed by an engage in the next step is merged into nothing.
+    '''
+
+    def __init__(self, run, module, move_time=5):
+        super().__init__(run, module)
+        self.move_time = move_time  # seconds to travel between engaged and disengaged
+        self.engaged = module.status == 'engaged'
+        self.height = None
+        self.pending_disengage = False
+
+    def engage(self, height):
+        if self.pending_disengage:
+            self.pending_disengage = False
+            self.skip('magnet disengage', self.move_time)
+        if self.engaged and self.height == height:
+            self.skip('magnet engage', self.move_time)
+            return
+        self.module.engage(height=height)
+        self.engaged = True
+        self.height = height
+        self.run.mark_event('magnet_engaged')
+
+    def disengage(self):
+        if not self.engaged or self.pending_disengage:
+            self.skip('magnet disengage', self.move_time)
+            return
+        self.pending_disengage = True
+
+    def flush(self):
+        if self.pending_disengage:
+            self.module.disengage()
+            self.engaged = False
+            self.pending_disengage = False
+
+
+class TempDeckState(ModuleState):
+    '''
+    Deactivate is skipped when a later step is scheduled at the same
+    temperature, the block is kept there instead of cooling and heating again.
+    '''
+
+    def __init__(self, run, module, ambient=25):
+        super().__init__(run, module)
+        self.ambient = ambient
+
+    def set_temperature(self, celsius):
+        if self.module.target == celsius and self.module.status == 'holding at target':
+            self.skip('set temperature', 0)
+            return
+        self.module.set_temperature(celsius)
+
+    def deactivate(self):
+        if self.module.target == None:
+            self.skip('temperature deactivate', 0)
+            return
+        target = self.module.target
+        later = [entry for entry in self.run.temp_schedule
+                 if entry['module'] is self and entry['celsius'] == target]
+        if len(later) > 0:
+            # The block drifts to ambient until the step and has to come back
+            model = self.run.thermal_model
+            idle = self.run.time_to_step(later[0]['step'])
+            drift = idle / model.fit_params[model.direction(target, self.ambient)][1]
+            if target > self.ambient:
+                drifted = max(target - drift, self.ambient)
+            else:
+                drifted = min(target + drift, self.ambient)
+            self.skip('temperature deactivate', model.ramp_time(drifted, target))
+            return
+        self.module.deactivate()
+
+
 class ProtocolRun:
     def __init__(self, ctx):
         self.ctx = ctx
         self.step_list = []
         self.step = 0
+        self.clock = RunClock(ctx.is_simulating())
 
         # Folder and file_path for log time
         folder_path = '/var/lib/jupyter/notebooks/'+log_folder
         if not self.ctx.is_simulating():
             if not os.path.isdir(folder_path):
                 os.mkdir(folder_path)
-            self.file_path = folder_path + \
-                '/rna_extraction_%s.tsv' % datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
+            # Validation runs are logged apart, their shortened times must not plan real runs
+            self.file_path = folder_path + '/%srna_extraction_%s.tsv' % (
+                'validation_' if validation_mode else '', datetime.now().strftime("%d_%m_%Y_%H_%M_%S"))
+            self.thermal_model = ThermalModel(
+                folder_path + '/thermal_model.json')
+            self.inventory = ReagentInventory(
+                folder_path + '/reagent_inventory.json')
+        else:
+            self.thermal_model = ThermalModel()
+            self.inventory = ReagentInventory()
+        # Reagents put in the reservoirs in order and top ups for the next pause
+        self.stock = []
+        self.top_ups = []
+        self.folder_path = folder_path
 
         self.selected_pip = "right"
         self.pips = {"right": {}, "left": {}}
-
-    def add_step(self, description, execute=False, wait_time=0):
+        # Transfers, tips used and saved of every reagent by use_tip
+        self.tip_reuse = {}
+        # Step being run, a registered step while it runs out of order
+        self.running = None
+        self.waste = None  # WasteLedger of the liquid trash
+
+        # Temperature ramps: scheduled to be ready for a step and in progress
+        self.temp_schedule = []
+        # Time of the events marked during the run
+        self.events = {}
+        # Plate of the steps being added and of the step being run, tips and liquids used by each
+        self.plate = None
+        self.current_plate = None
+        self.usage = {}
+        self.ramps = {}
+        self.previous_times = []
+
+        # Hardware modules wrapped to skip redundant commands
+        self.modules = []
+
+        if validation_mode and not self.ctx.is_simulating():
+            self.comment('VALIDATION MODE: faster motions and shortened waits, not for samples',
+                         add_hash=True)
+
+    def add_step(self, description, execute=False, wait_time=0, resources=[], depends=None,
+                 duration=0, wait_after=None, tips={}, tip_stop=False, waste=[], plates=0):
+        '''
+        [resources] are the modules and slots the step holds during its wait, [depends]
+        the steps (numbered from 1) that must be finished before, the previous one if
+        not given. [duration] is the expected time when there is no previous log.
+        The [wait_time] counts from the event [wait_after] if it has been marked.
+        [tips] are the tips the step takes from each pipette mount, [tip_stop] marks
+        the pauses of the operator where the tip racks can be replaced, and where
+        the liquid trash can be emptied. [waste] are the discards to the liquid trash.
+        [plates] are the new plates the operator sets in the pause.
+        '''
+        if depends == None:
+            depends = [len(self.step_list)] if len(self.step_list) > 0 else []
+        if self.plate != None:
+            description = description + ' (plate %s)' % self.plate
         self.step_list.append(
-            {'execute': execute, 'description': description, 'wait_time': wait_time, 'execution_time': 0})
+            {'execute': execute, 'description': description, 'wait_time': wait_time, 'execution_time': 0,
+             'resources': resources, 'depends': depends, 'duration': duration,
+             'wait_after': wait_after, 'body': None, 'done': False, 'plate': self.plate,
+             'tips': tips, 'tip_stop': tip_stop, 'waste': waste, 'plates': plates})
+
+    def set_plate(self, plate):
+        # Steps added from now on belong to [plate], None when there is only one
+        self.plate = plate
+
+    def register_step(self, number, body):
+        # A step with a body can be pulled into the wait of an earlier step
+        self.step_list[number-1]['body'] = body
 
     def init_steps(self, steps):
         if(len(steps) > 0):
@@ -806,6 +1536,7 @@ class ProtocolRun:
         else:
             for index, step in enumerate(self.step_list):
                 self.set_execution_step(index, True)
+        self.previous_times = self.load_previous_times()
 
         self.comment("###############################################")
         self.comment("You are about to run %s samples" % (NUM_SAMPLES))
@@ -824,29 +1555,179 @@ class ProtocolRun:
         return self.step_list[self.step]
 
     def next_step(self):
-        if self.step_list[self.step]['execute'] == False:
+        self.check_temperature_schedule()
+        # Steps already run during a wait are skipped too
+        if self.step_list[self.step]['execute'] == False or self.step_list[self.step]['done']:
             self.step += 1
             return False
 
+        self.run_dependencies(self.step)
+        self.running = self.step
+        self.current_plate = self.step_list[self.step]['plate']
         self.comment(self.step_list[self.step]['description'], add_hash=True)
-        self.start = datetime.now()
+        self.start = self.clock.now()
         return True
 
     def finish_step(self):
+        self.release_tips()
         if (self.get_current_step()["wait_time"] > 0 and use_waits):
-            self.cdelay(seconds=int(self.get_current_step()[
+            self.wait_after(self.get_current_step()["wait_after"], int(self.get_current_step()[
                 "wait_time"]), msg=self.get_current_step()["description"])
         if (self.get_current_step()["wait_time"] > 0 and not use_waits):
-            self.ccomment("We simulate a wait of:%s seconds" %
+            self.comment("We simulate a wait of:%s seconds" %
                           self.get_current_step()["wait_time"])
-        end = datetime.now()
-        time_taken = (end - self.start)
+        time_taken = timedelta(seconds=self.clock.now() - self.start)
         self.comment('Step ' + str(self.step + 1) + ': ' +
                      self.step_list[self.step]['description'] + ' took ' + str(time_taken), add_hash=True)
 
         self.step_list[self.step]['execution_time'] = str(time_taken)
+        self.step_list[self.step]['done'] = True
         self.step += 1
         self.log_steps_time()
+        self.check_temperature_schedule()
+
+    def mark_event(self, name):
+        # Waits can be expressed as deadlines relative to this moment
+        self.events[name] = self.clock.now()
+
+    def wait_after(self, event, seconds, msg=None):
+        '''
+        Wait until [seconds] have passed since [event], the whole time if it has
+        not been marked. The wait is filled with independent steps if possible.
+        '''
+        if event in self.events:
+            elapsed = self.clock.now() - self.events[event]
+            if elapsed > 0:
+                self.comment('%d of %d seconds already elapsed since %s' % (
+                    min(elapsed, seconds), seconds, event.replace('_', ' ')))
+            seconds = max(0, seconds - elapsed)
+        if fill_waits:
+            seconds = self.fill_wait(seconds)
+        if seconds > 0:
+            self.delay(seconds=seconds, msg=msg)
+
+    def estimate_step(self, index):
+        # Seconds of the step in the last logged run, or the declared ones
+        if index < len(self.previous_times) and self.previous_times[index] > 0:
+            return self.previous_times[index]
+        return self.step_list[index]['wait_time'] + self.step_list[index]['duration']
+
+    def fillable_steps(self, host, done):
+        # Registered steps that can run during the wait of [host]
+        fillable = []
+        for index in range(host+1, len(self.step_list)):
+            step = self.step_list[index]
+            if not step['execute'] or step['body'] == None or index in done:
+                continue
+            if any(self.step_list[d-1]['execute'] and d-1 not in done for d in step['depends']):
+                continue
+            if len(set(step['resources']) & set(self.step_list[host]['resources'])) > 0:
+                continue
+            fillable.append(index)
+        return fillable
+
+    def fill_wait(self, seconds):
+        '''
+        Run the independent steps that fit in the wait of the current step.
+        Returns the seconds left to wait.
+        '''
+        end = self.clock.now() + seconds
+        done = [i for i, step in enumerate(self.step_list) if step['done']]
+        filled = True
+        while filled:
+            filled = False
+            for index in self.fillable_steps(self.step, done):
+                if self.estimate_step(index) <= end - self.clock.now():
+                    self.run_early(index, 'during the wait of step %d' % (self.step+1))
+                    done.append(index)
+                    filled = True
+                    break
+        return max(0, end - self.clock.now())
+
+    def run_dependencies(self, index):
+        # Later steps the step [index] depends on are run before it
+        for d in self.step_list[index]['depends']:
+            step = self.step_list[d-1]
+            if d-1 > index and step['execute'] and not step['done'] and step['body'] != None:
+                self.run_dependencies(d-1)
+                self.run_early(d-1, 'before step %d' % (index+1))
+
+    def run_early(self, index, reason):
+        # Run the body of a registered step out of order, next_step skips it later
+        self.comment('Step %d: %s, %s' % (
+            index+1, self.step_list[index]['description'], reason), add_hash=True)
+        plate = self.current_plate
+        running = self.running
+        self.current_plate = self.step_list[index]['plate']
+        self.running = index
+        start = self.clock.now()
+        self.step_list[index]['body']()
+        self.release_tips()
+        self.step_list[index]['execution_time'] = str(
+            timedelta(seconds=self.clock.now() - start))
+        self.step_list[index]['done'] = True
+        self.current_plate = plate
+        self.running = running
+
+    def add_usage(self, name, amount):
+        usage = self.usage.setdefault(self.current_plate, {})
+        usage[name] = usage.get(name, 0) + amount
+
+    def log_tips(self):
+        for position, ledger in self.ledgers():
+            if ledger.replaced > 0:
+                self.comment('%s pipette: %d tip racks replaced' % (position, ledger.replaced))
+            if ledger.travel_in_order > 0:
+                self.comment('%s pipette: %d mm from the tips to the sources, %d mm in rack order' % (
+                    position, ledger.travel, ledger.travel_in_order))
+
+    def log_usage(self):
+        # Tips and liquid volumes of each plate, the plan for the next runs
+        for plate, usage in self.usage.items():
+            liquids = ['%s %d ul' % (name, volume) for name, volume in usage.items()
+                       if name != 'tips']
+            self.comment('%s: %d tips, %s' % ('Plate ' + plate if plate != None else 'Run',
+                                              usage.get('tips', 0), ', '.join(liquids)))
+
+    def log_schedule(self):
+        # Critical path of the dependencies and the waits that will be filled
+        finish = {}
+        previous = {}
+        for index, step in enumerate(self.step_list):
+            if not step['execute']:
+                continue
+            start = 0
+            for d in step['depends']:
+                if d-1 in finish and finish[d-1] > start:
+                    start = finish[d-1]
+                    previous[index] = d-1
+            finish[index] = start + self.estimate_step(index)
+        if len(finish) == 0:
+            return
+        index = max(finish, key=lambda i: (finish[i], i))
+        path = [index]
+        while path[-1] in previous:
+            path.append(previous[path[-1]])
+        self.comment('Critical path: steps %s (%s)' % (
+            ', '.join([str(i+1) for i in reversed(path)]),
+            timedelta(seconds=int(finish[index]))))
+        # Plan the waits the same way finish_step fills them
+        saved = 0
+        done = []
+        for host, step in enumerate(self.step_list):
+            if not step['execute'] or host in done:
+                continue
+            if step['wait_time'] > 0 and use_waits and fill_waits:
+                window = step['wait_time']
+                for index in self.fillable_steps(host, done):
+                    if self.estimate_step(index) <= window:
+                        window -= self.estimate_step(index)
+                        saved += self.estimate_step(index)
+                        done.append(index)
+                        self.comment('Step %d planned during the wait of step %d' % (
+                            index+1, host+1))
+            done.append(host)
+        self.comment('Projected time saved filling waits: %s' % timedelta(seconds=int(saved)))
 
     def log_steps_time(self):
         # Export the time log to a tsv file
@@ -856,13 +1737,105 @@ class ProtocolRun:
                 row = ""
                 for step in self.step_list:
                     row = ('{}\t{}\t{}\t{}').format(
-                        step["execute"], step["description"], step["wait_time"], step["execution_time"])
+                        step["execute"], step["description"].replace('\n', ' '), step["wait_time"], step["execution_time"])
                     f.write(row + '\n')
             f.close()
 
+    def load_previous_times(self):
+        # Step durations in seconds of the last logged run, used to plan ahead
+        if self.ctx.is_simulating() or not os.path.isdir(self.folder_path):
+            return []
+        logs = [os.path.join(self.folder_path, f) for f in os.listdir(self.folder_path)
+                if f.startswith('rna_extraction_') and f.endswith('.tsv')]
+        if len(logs) == 0:
+            return []
+        times = []
+        with open(max(logs, key=os.path.getmtime)) as f:
+            for line in f.readlines()[1:]:
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    h, m, s = fields[-1].split(':')
+                    times.append(int(h)*3600 + int(m)*60 + float(s))
+                except ValueError:
+                    times.append(0)
+        # Logs of a different step list are useless
+        if len(times) != len(self.step_list):
+            return []
+        return times
+
+    def time_to_step(self, index):
+        # Estimated seconds until the step [index] begins
+        seconds = 0
+        for i in range(self.step, index):
+            if self.step_list[i]['execute']:
+                if i < len(self.previous_times) and self.previous_times[i] > 0:
+                    seconds += self.previous_times[i]
+                else:
+                    seconds += self.step_list[i]['wait_time']
+        return seconds
+
+    def schedule_temperature(self, module, celsius, step):
+        '''
+        Have the temperature [module] at [celsius] when [step] begins.
+        The ramp is started without blocking as late as the thermal model allows,
+        the step must call await_temperature before using the block.
+        '''
+        self.temp_schedule.append(
+            {'module': module, 'celsius': celsius, 'step': step-1, 'started': False})
+        self.check_temperature_schedule()
+
+    def check_temperature_schedule(self):
+        self.log_ramps()
+        pending_modules = []
+        for entry in list(self.temp_schedule):
+            if entry['step'] < self.step or not self.step_list[entry['step']]['execute']:
+                self.temp_schedule.remove(entry)
+                continue
+            # Only the first scheduled ramp of each module can be started
+            if entry['module'] in pending_modules:
+                continue
+            pending_modules.append(entry['module'])
+            if entry['started']:
+                continue
+            ramp = self.thermal_model.ramp_time(
+                entry['module'].temperature, entry['celsius'])
+            if self.time_to_step(entry['step']) <= ramp:
+                self.start_temperature(entry['module'], entry['celsius'])
+                entry['started'] = True
+
+    def start_temperature(self, module, celsius):
+        # Start the ramp without blocking, it is logged when the target is reached
+        if module.target == celsius:
+            return
+        ramp = self.thermal_model.ramp_time(module.temperature, celsius)
+        self.ramps[id(module)] = {'module': module, 'start': module.temperature,
+                                  'target': celsius, 'time': self.clock.now()}
+        module.start_set_temperature(celsius)
+        self.comment('Temperature module going to %sºC, ready in about %d seconds' % (
+            celsius, ramp))
+
+    def await_temperature(self, module, celsius):
+        self.temp_schedule = [entry for entry in self.temp_schedule
+                              if not (entry['module'] is module and entry['step'] <= self.step)]
+        self.start_temperature(module, celsius)
+        module.await_temperature(celsius)
+        self.log_ramps()
+
+    def log_ramps(self):
+        # Feed the thermal model with the ramps that have reached the target
+        for key, ramp in list(self.ramps.items()):
+            if ramp['module'].status == 'holding at target':
+                if not self.ctx.is_simulating():
+                    self.thermal_model.add_ramp(
+                        ramp['start'], ramp['target'], self.clock.now()-ramp['time'])
+                del self.ramps[key]
+
     def mount_pip(self, position, type, tip_racks, capacity, multi=False, size_tipracks=96):
         self.pips[position]["pip"] = self.ctx.load_instrument(
             type, mount=position, tip_racks=tip_racks)
+        if validation_mode and not self.ctx.is_simulating():
+            self.pips[position]["pip"].default_speed = self.pips[position]["pip"].default_speed * \
+                validation_speed
         self.pips[position]["capacity"] = capacity
         self.pips[position]["count"] = 0
         self.pips[position]["maxes"] = len(tip_racks)*size_tipracks
@@ -870,13 +1843,17 @@ class ProtocolRun:
             self.pips[position]["increment_tips"] = 8
         else:
             self.pips[position]["increment_tips"] = 1
+        reserve = [rack for rack in tip_racks
+                   if str(rack.parent) in [str(slot) for slot in reserve_tip_slots]]
+        self.pips[position]["ledger"] = TipLedger(
+            self.pips[position]["pip"], tip_racks, self.pips[position]["increment_tips"],
+            size_tipracks, reserve)
 
     def mount_right_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("right", type, tip_racks, capacity)
-
+        self.mount_pip("right", type, tip_racks, capacity, multi)
 
-   def mount_left_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("left", type, tip_racks, capacity)
+    def mount_left_pip(self, type, tip_racks, capacity, multi=False):
+        self.mount_pip("left", type, tip_racks, capacity, multi)
 
     def get_current_pip(self):
 
@@ -885,14 +1862,208 @@ class ProtocolRun:
     def get_pip_count(self):
         return self.pips[self.selected_pip]["count"]
 
-    def reset_pip_count(self, pip):       
-        pip.reset_tipracks()
+    def reset_pip_count(self, pip):
+        self.pips[self.selected_pip]["ledger"].replace()
         self.pips[self.selected_pip]["count"] = 0
 
     def add_pip_count(self):
-        self.pips[self.selected_pip]["count"] + \
+        self.pips[self.selected_pip]["count"] += \
             self.pips[self.selected_pip]["increment_tips"]
 
+    def ledgers(self):
+        return [(position, pip["ledger"]) for position, pip in self.pips.items() if "ledger" in pip]
+
+    def tip_segment(self, pending, position):
+        '''
+        Next pause of [pending] where the racks can be replaced, the steps run
+        before it and the tips they take from the pipette at [position].
+        '''
+        stop = None
+        for index in pending:
+            if self.step_list[index]['tip_stop']:
+                stop = index
+                break
+        steps = []
+        for index in pending:
+            step = self.step_list[index]
+            if step['tip_stop']:
+                continue
+            # Registered steps after the pause can be pulled into an earlier wait
+            if stop == None or index < stop or (
+                    step['body'] != None and all(d-1 < stop for d in step['depends'])):
+                steps.append(index)
+        return stop, steps, sum(self.step_list[i]['tips'].get(position, 0) for i in steps)
+
+    def log_tip_plan(self):
+        # Tips of the enabled steps and the pauses where the racks will be replaced
+        for position, ledger in self.ledgers():
+            pending = [i for i, step in enumerate(self.step_list) if step['execute']]
+            left = ledger.capacity()
+            total = 0
+            replaced = []
+            previous = None
+            while True:
+                stop, steps, tips = self.tip_segment(pending, position)
+                if previous != None and tips > left:
+                    replaced.append(str(previous+1))
+                    left = ledger.capacity()
+                if tips > left:
+                    self.comment('Steps %s take %d tips, more than the %d left in the racks: the robot will stop for new racks' % (
+                        ', '.join([str(i+1) for i in steps]), tips, left))
+                    left += ledger.capacity()
+                left -= tips
+                total += tips
+                if stop == None:
+                    break
+                pending = [i for i in pending if i not in steps and i != stop]
+                previous = stop
+            if total > 0:
+                self.comment('%s pipette: %d tips, racks replaced at the pauses of steps %s' % (
+                    position, total, ', '.join(replaced) if replaced else 'none'))
+
+    def set_waste(self, wells, capacity):
+        self.waste = WasteLedger(wells, capacity)
+
+    def waste_segment(self, pending):
+        # Discards to the liquid trash of [pending] until the next pause
+        stop, steps, tips = self.tip_segment(pending, None)
+        return [volume for i in steps for volume in self.step_list[i]['waste']]
+
+    def log_waste_plan(self):
+        # Pauses where the liquid trash will be emptied, only if it would overflow
+        if self.waste == None:
+            return
+        pending = [i for i, step in enumerate(self.step_list) if step['execute']]
+        empty = [0 for _ in self.waste.wells]
+        volumes = empty
+        emptied = []
+        previous = None
+        while True:
+            stop, steps, tips = self.tip_segment(pending, None)
+            discards = self.waste_segment(pending)
+            placed = self.waste.place(discards, volumes)
+            if placed == None and previous != None:
+                emptied.append(str(previous+1))
+                placed = self.waste.place(discards, empty)
+            if placed == None:
+                self.comment('Steps %s discard %d ul, more than the liquid trash of SLOT %s holds: the robot will stop to empty it' % (
+                    ', '.join([str(i+1) for i in steps]), sum(discards), self.waste.slot()))
+                placed = empty
+            volumes = placed
+            if stop == None:
+                break
+            pending = [i for i in pending if i not in steps and i != stop]
+            previous = stop
+        self.comment('Liquid trash of SLOT %s emptied at the pauses of steps %s' % (
+            self.waste.slot(), ', '.join(emptied) if emptied else 'none'))
+
+    def stock_reagent(self, reagent):
+        '''
+        [reagent] fills its reservoir wells. With use_inventory it starts from
+        what the previous plate or the last run left in them: top_up_comment
+        gives the volumes to add to each well.
+        '''
+        wells = ReagentInventory.wells(reagent)
+        # The last reagent put in any of its wells in this run, or by the last run
+        left = self.inventory.left(wells)
+        for previous in self.stock:
+            if len(set(ReagentInventory.wells(previous)) & set(wells)) > 0:
+                left = {'name': previous.name, 'wells': ReagentInventory.wells(previous),
+                        'volumes': previous.well_volumes(), 'date': None}
+        self.stock.append(reagent)
+        # Another reagent is replaced by the operator, not topped up
+        if not use_inventory or left == None or left['name'] != reagent.name or left['wells'] != wells:
+            return
+        top_up = reagent.start_from(left['volumes'])
+        wells = ['%s %d ul' % (well.display_name.split(' ')[0], volume)
+                 for well, volume in zip(reagent.reagent_reservoir, top_up) if volume > 0]
+        source = 'the last run (%s)' % left['date'] if left['date'] != None else 'the previous plate'
+        self.top_ups.append("%s left by %s: %d ul. Top up: %s" % (
+            reagent.name, source, sum(left['volumes']), ', '.join(wells) if wells else 'none'))
+
+    def top_up_comment(self):
+        # Top ups pending for the next pause, to append to its message
+        comment = ''.join(['\n' + top_up for top_up in self.top_ups])
+        self.top_ups = []
+        return comment
+
+    def confirm_stock(self):
+        # The operator confirms the reagents left by the last run before they are used
+        if len(self.top_ups) > 0:
+            self.blink()
+            self.pause('Check the reagents left in the reservoirs and add the top ups' +
+                       self.top_up_comment())
+
+    def save_inventory(self):
+        # Only the last reagent put in each well is still there
+        last = []
+        for index, reagent in enumerate(self.stock):
+            wells = set(ReagentInventory.wells(reagent))
+            if all(len(wells & set(ReagentInventory.wells(later))) == 0 for later in self.stock[index+1:]):
+                last.append(reagent)
+        self.inventory.save(last)
+        for reagent in last:
+            self.comment('%s left in the reservoirs: %s ul' % (
+                reagent.name, ', '.join(['%d' % v for v in reagent.well_volumes()])))
+
+    def waste_well(self, ledger, volume):
+        '''
+        Well of the liquid trash for a discard of [volume]. The robot only stops
+        to empty it if the pauses fell short.
+        '''
+        index = ledger.well(volume)
+        if index == None:
+            self.blink()
+            self.pause('Empty the liquid trash of SLOT %s before resuming' % ledger.slot())
+            ledger.empty()
+            index = ledger.well(volume)
+        ledger.add(index, volume)
+        return ledger.wells[index]
+
+    def log_waste(self):
+        if self.waste != None:
+            self.comment('Liquid trash of SLOT %s: emptied %d times, %d ul in the fullest well' % (
+                self.waste.slot(), self.waste.emptied, self.waste.fullest))
+
+    def tip_pause(self, comment):
+        '''
+        Pause of the operator at a step where the racks can be replaced. They are
+        replaced only if the tips left do not reach the next of these pauses.
+        The racks emptied since the last pause must have been refilled. The liquid
+        trash is emptied only if the discards until the next pause do not fit.
+        '''
+        pending = [i for i, step in enumerate(self.step_list)
+                   if step['execute'] and not step['done'] and i != self.running]
+        short = []
+        for position, ledger in self.ledgers():
+            stop, steps, tips = self.tip_segment(pending, position)
+            if tips > ledger.left(refilled=True):
+                short.append(ledger)
+                comment += '\nReplace the used tipracks of SLOT %s' % ', '.join(ledger.slots())
+            elif len(ledger.refill) > 0:
+                comment += '\nCheck that the tipracks of SLOT %s have been refilled' % \
+                    ', '.join(ledger.slots(ledger.refill))
+        empty_waste = self.waste != None and \
+            self.waste.place(self.waste_segment(pending), self.waste.volumes) == None
+        if empty_waste:
+            comment += '\nEmpty the liquid trash of SLOT %s' % self.waste.slot()
+        comment += self.top_up_comment()
+        self.pause(comment)
+        if empty_waste:
+            self.waste.empty()
+        for position, ledger in self.ledgers():
+            if ledger in short:
+                ledger.replace()
+            else:
+                ledger.refilled()
+
+    def signal_refill(self, ledger, rack):
+        # The robot does not stop, the operator refills the rack while it works
+        left = [str(rack.parent) for i, rack in enumerate(ledger.racks) if ledger.available(i) > 0]
+        self.comment('Refill the tiprack of SLOT %s, the robot goes on with SLOT %s' % (
+            rack.parent, ', '.join(left)), add_hash=True)
+        self.blink()
+
     def get_pip_maxes(self):
         return self.pips[self.selected_pip]["maxes"]
 
@@ -932,31 +2103,119 @@ class ProtocolRun:
         if touch_tip == True:
             pip = self.get_current_pip()
             pip.touch_tip(speed=20, v_offset=-5, radius=0.9)
+        self.pipetting(2 if touch_tip else 1, 1 + vol*rounds, reagent.flow_rate_aspirate_mix,
+                       1 + vol*rounds + post_dispense, reagent.flow_rate_dispense_mix)
 
-    def pick_up(self, position=None):
+    def pick_up(self, position=None, near=None):
+        '''
+        Pick up the next tip of the ledger, from the rack closest to the [near]
+        location (the source of the transfer) if nearest_tips is set.
+        '''
         pip = self.get_current_pip()
-
-        if not self.ctx.is_simulating():
-            if self.get_pip_count() == self.get_pip_maxes():
-                self.ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
-                resuming.')
+        self.flush_modules()
+
+        ledger = self.pips[self.selected_pip]["ledger"]
+        # Only if the plan of the pauses fell short and there is no reserve left
+        if position == None and not pip.hw_pipette['has_tip'] and ledger.next_rack() == None:
+            if len(ledger.refill) > 0:
+                self.pause('Check that the tipracks of SLOT %s have been refilled before resuming.' %
+                           ', '.join(ledger.slots(ledger.refill)))
+                ledger.refilled()
+            else:
+                self.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before resuming.')
                 self.reset_pip_count(pip)
         if position != None:
             pip.pick_up_tip(position)
+            self.add_usage('tips', pip.channels)
+            self.clock.advance(tip_change_time/2)
         else:
             if not pip.hw_pipette['has_tip']:
+                rack = ledger.next_rack(near if nearest_tips else None)
                 self.add_pip_count()
-                pip.pick_up_tip()
+                pip.pick_up_tip(ledger.tip(rack))
+                self.add_usage('tips', pip.channels)
+                self.clock.advance(tip_change_time/2)
+                emptied = ledger.take(rack)
+                # With all the racks empty the next pick up stops the robot anyway
+                if emptied != None and ledger.next_rack() != None:
+                    self.signal_refill(ledger, emptied)
 
     def drop_tip(self):
         pip = self.get_current_pip()
         pip.drop_tip(home_after=False)
-        self.add_pip_count()
+        self.pips[self.selected_pip]["tip"] = None
+        self.clock.advance(tip_change_time/2)
 
     def change_tip(self):
         self.drop_tip()
         self.pick_up()
 
+    def use_tip(self, reagent, source=None, dest=None, top=False, pick_up=None):
+        '''
+        Tip for a transfer of [reagent] from [source] to [dest]. The tip in the
+        pipette is kept for it if reagent.tip_recycling allows it:
+        'none' a new tip for every transfer,
+        'source' while the source well is the same,
+        'column' while the destination column is the same,
+        'step' for the whole step, only for destinations without samples,
+        'top' while every dispense has been from the top, without touching the liquid.
+        A tip is never kept for another reagent or step. [top] is True if the
+        transfer does not touch the liquid of [dest]. [pick_up] picks up the new tip.
+        '''
+        pip = self.get_current_pip()
+        tip = self.pips[self.selected_pip].get("tip")
+        # The column is the well name without the row, with its labware
+        column = dest.display_name[1:] if dest != None else None
+        stats = self.tip_reuse.setdefault(reagent.name, {
+            'policy': reagent.tip_recycling, 'transfers': 0, 'tips': 0, 'saved': 0, 'changes_saved': 0})
+        stats['transfers'] += 1
+        if pip.hw_pipette['has_tip'] and tip != None and tip['reagent'] is reagent and \
+                tip['step'] == self.step and self.keep_tip(reagent.tip_recycling, tip, source, column):
+            stats['saved'] += pip.channels
+            stats['changes_saved'] += 1
+        else:
+            if pip.hw_pipette['has_tip']:
+                self.drop_tip()
+            if pick_up != None:
+                pick_up()
+            else:
+                self.pick_up(near=source)
+            stats['tips'] += pip.channels
+            tip = {'reagent': reagent, 'step': self.step, 'top': True}
+            self.pips[self.selected_pip]["tip"] = tip
+        tip['source'] = source
+        tip['column'] = column
+        tip['top'] = tip['top'] and top
+
+    def keep_tip(self, policy, tip, source, column):
+        # A tip that has touched a destination only goes back to the same column
+        clean = tip['top'] or column == tip['column']
+        if policy == 'source':
+            return source == tip['source'] and clean
+        if policy == 'column':
+            return column == tip['column']
+        if policy == 'step':
+            return True
+        if policy == 'top':
+            return tip['top']
+        return False
+
+    def release_tips(self):
+        # Tips kept for the next transfer do not go on to the next step
+        selected = self.selected_pip
+        for position in self.pips:
+            if self.pips[position].get("tip") != None:
+                self.set_pip(position)
+                self.drop_tip()
+        self.set_pip(selected)
+
+    def log_tip_recycling(self):
+        # Tips the policies of the reagents saved against a new tip every transfer
+        for name, stats in self.tip_reuse.items():
+            self.comment('%s (%s): %d transfers, %d tips, %d tips and %s saved' % (
+                name, stats['policy'], stats['transfers'], stats['tips'], stats['saved'],
+                timedelta(seconds=int(stats['changes_saved']*tip_change_time))))
+
     def comment(self, comment, add_hash=False):
         hash_string = "#######################################################"
         if (add_hash):
@@ -973,11 +2232,20 @@ class ProtocolRun:
                 print(hash_string)
 
     def pause(self, comment):
+        self.flush_modules()
         self.ctx.pause(comment)
+        self.clock.advance(operator_response)
         self.blink(3)
         if self.ctx.is_simulating():
             print("%s\n Press any key to continue " % comment)
 
+    def delay(self, seconds, msg=None):
+        # Waits take no time in simulation and are shortened in validation mode
+        if validation_mode and not self.ctx.is_simulating():
+            seconds = seconds*validation_wait_factor
+        self.ctx.delay(seconds=seconds, msg=msg)
+        self.clock.advance(seconds)
+
     def move_volume(self, reagent, source, dest, vol,
                     pickup_height, disp_height, air_gap_vol = 0, blow_out=False, touch_tip=False, rinse=False,
                     post_dispense=0, x_offset=[0, 0]):
@@ -1004,14 +2272,52 @@ class ProtocolRun:
         drop = dest.top(z=disp_height).move(Point(x=x_offset[1]))
         pipet.dispense(vol + air_gap_vol, drop,
                        rate=reagent.flow_rate_dispense)  # dispense all
+        self.add_usage(reagent.name, vol * pipet.channels)
         # pause for x seconds depending on reagent
-        self.ctx.delay(seconds=reagent.delay)
+        self.delay(seconds=reagent.delay)
         if blow_out == True:
             pipet.blow_out(dest.top(z=-2))
         if post_dispense > 0:
             pipet.dispense(post_dispense, dest.top(z=-2))
         if touch_tip == True:
             pipet.touch_tip(speed=20, v_offset=-5, radius=0.9)
+        self.pipetting(3 if touch_tip else 2, vol + air_gap_vol, reagent.flow_rate_aspirate,
+                       vol + air_gap_vol + post_dispense, reagent.flow_rate_dispense)
+
+    def pipetting(self, moves, aspirated, rate_aspirate, dispensed, rate_dispense):
+        '''
+        Simulated time of [moves] moves of the gantry and of the plunger for the
+        [aspirated] and [dispensed] ul at the flow rates of the pipette times [rate].
+        '''
+        flow_rate = self.get_current_pip().flow_rate
+        self.clock.advance(moves*move_time + aspirated/(flow_rate.aspirate*rate_aspirate)
+                           + dispensed/(flow_rate.dispense*rate_dispense))
+
+    def load_module(self, name, slot):
+        # In simulation the modules are replaced by emulators with realistic timing
+        module = self.ctx.load_module(name, slot)
+        if self.ctx.is_simulating():
+            if 'mag' in name:
+                return MagDeckEmulator(self, module)
+            return TempDeckEmulator(self, module)
+        return module
+
+    def flush_modules(self):
+        # Apply the module changes that were delayed
+        for module in self.modules:
+            module.flush()
+
+    def log_module_savings(self):
+        skipped = sum([module.skipped for module in self.modules])
+        saved_time = sum([module.saved_time for module in self.modules])
+        self.comment('Module commands skipped: %s. Module time saved: %d seconds' % (
+            skipped, saved_time), add_hash=True)
+
+    def log_estimated_time(self):
+        # Virtual time of the simulation: pipetting, waits, modules, blinks and pauses
+        if self.ctx.is_simulating():
+            self.comment('Estimated time of pipetting, waits, modules and pauses: %s' % (
+                timedelta(seconds=int(self.clock.now()))), add_hash=True)
 
     def start_lights(self):
         self.ctx._hw_manager.hardware.set_lights(
@@ -1025,8 +2331,8 @@ class ProtocolRun:
         for i in range(blink_number):
             self.stop_lights()
             # ctx._hw_manager.hardware.set_button_light(1,0,0)
-            time.sleep(0.3)
+            self.clock.sleep(0.3)
             self.start_lights()
             # ctx._hw_manager.hardware.set_button_light(0,0,1)
-            time.sleep(0.3)
+            self.clock.sleep(0.3)
             self.stop_lights()
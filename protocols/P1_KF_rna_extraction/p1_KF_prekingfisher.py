@@ -8,7 +8,7 @@ import os
 import numpy as np
 from timeit import default_timer as timer
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import csv
 import subprocess
 
@@ -26,15 +26,24 @@ metadata = {
 NUM_SAMPLES = 94
 VOL_SAMPLE = 200 # 200 or 400
 steps = [] # Steps you want to execute
+NUM_PLATE_SETS = 1 # Plate sets prepared back to back in one run
 
 # No quitar es seguridad por control + o -
 if(NUM_SAMPLES > 94):
     NUM_SAMPLES = 94
 
 num_cols = math.ceil(NUM_SAMPLES/8)
+# Wells of the plates filled by columns: the samples, and the controls G12 and H12 with 94
+plate_wells = NUM_SAMPLES if NUM_SAMPLES < 94 else 96
+# Wells that get reagent, the negative control G12 is filled by hand below 94 samples
+num_wells_filled = plate_wells + 1 if NUM_SAMPLES < 94 else plate_wells
+
+# Free slots for the tip racks of a campaign of plate sets
+tip_slots = [9, 4, 7, 8]
 
 # Usar control general para las esperas para debug, siempre True
 use_waits = True
+tip_change_time = 10  # Seconds to drop a tip and pick up a new one, for the tips saved
 
 diameter_screwcap = 8.1  # Diameter of the screwcap
 volume_cone = 57  # Volume in ul that fit in the screwcap cone
@@ -60,15 +69,17 @@ log_folder = 'prekingfisher'
 def run(ctx: protocol_api.ProtocolContext):
     # Init protocol run
     run = ProtocolRun(ctx)
- 
+
     # Define stesp
-    run.add_step(description="Transfer Binding Buffer Beads 6 - 5 Multi and mix")  # 1
-    run.add_step(description="Pause to pick up deep well plate on slot 5")  # 2
-    
-    # Tranfers     
-    run.add_step(description="Slot 2 -> 1 Washing buffer to plate")  # 3
-    run.add_step(description="Slot 2 -> 3 elution buffer to plate")  # 4
-    run.add_step(description="Slot 10 -> 11 etoh to plate")  # 5
+    for plate_set in range(1, NUM_PLATE_SETS+1):
+        suffix = ' (set %d)' % plate_set if NUM_PLATE_SETS > 1 else ''
+        run.add_step(description="Transfer Binding Buffer Beads 6 - 5 Multi and mix" + suffix)  # 1
+        run.add_step(description="Pause to pick up deep well plate on slot 5" + suffix)  # 2
+
+        # Tranfers
+        run.add_step(description="Slot 2 -> 1 Washing buffer to plate" + suffix)  # 3
+        run.add_step(description="Slot 2 -> 3 elution buffer to plate" + suffix)  # 4
+        run.add_step(description="Slot 10 -> 11 etoh to plate" + suffix)  # 5
 
     # execute avaliaible steps
     run.init_steps(steps)
@@ -84,7 +95,9 @@ def run(ctx: protocol_api.ProtocolContext):
         aw_slot = ctx.load_labware(labware_type, 5)
 
     aw_wells = aw_slot.wells()[:NUM_SAMPLES]
-    aw_wells_multi = aw_slot.rows()[0][:num_cols]
+    # The negative control is filled by hand below 94 samples, with the single
+    negative_control = ["G12"] if NUM_SAMPLES < 94 else []
+    aw_plan = ColumnPlan(aw_slot, plate_wells, negative_control)
 
     # Magnetic Beads Pool
     beads_slot = ctx.load_labware(
@@ -100,258 +113,307 @@ def run(ctx: protocol_api.ProtocolContext):
     etoh_pool_wells_multi = etoh_pool_slot.rows()[0][:num_cols]
 
     wb_slot = ctx.load_labware(labware_type, 1)
-    wb_wells_multi = wb_slot.rows()[0][:num_cols]
+    wb_plan = ColumnPlan(wb_slot, plate_wells, negative_control)
 
     eb_slot = ctx.load_labware(labware_type, 3)
-    eb_wells_multi = eb_slot.rows()[0][:num_cols]
+    eb_plan = ColumnPlan(eb_slot, plate_wells, negative_control)
 
     etoh_slot = ctx.load_labware(labware_type, 11)
-    etoh_wells_multi = etoh_slot.rows()[0][:num_cols]
+    etoh_plan = ColumnPlan(etoh_slot, plate_wells, negative_control)
+
+    # Every set takes a column of tips for each reagent and a single tip for the
+    # wells of the partial column and the negative control, one of each before the pause
+    controls = 1 if NUM_SAMPLES < 94 else 0
+    campaign = Campaign(NUM_PLATE_SETS, tips_before=(1, controls), tips_after=(3, 3*controls))
 
     # Mount pippets and set racks
     # Tipracks20_multi
-    tips300 = ctx.load_labware('opentrons_96_filtertiprack_200ul', 9)
+    num_racks = min(len(tip_slots), campaign.racks_needed())
+    tips300 = [ctx.load_labware('opentrons_96_filtertiprack_200ul', slot)
+               for slot in tip_slots[:num_racks]]
+    campaign.set_tip_racks(tips300)
 
-    run.mount_right_pip('p300_single_gen2', tip_racks=[tips300], capacity=200)
-    run.mount_left_pip('p300_multi_gen2', tip_racks=[tips300], capacity=200, multi=True)
+    run.mount_right_pip('p300_single_gen2', tip_racks=tips300, capacity=200)
+    run.mount_left_pip('p300_multi_gen2', tip_racks=tips300, capacity=200, multi=True)
 
-    ############################################################################
-    # STEP 1: Slot 3 -2 BindingBuffer
-    ############################################################################
-    if (run.next_step()):
-        ############################################################################
-        # Light flash end of program
-        run.set_pip("left")  # p300 multi
-        
+    # Reagents are filled for as many sets as the reservoirs hold. The plates have
+    # no samples yet, one tip of the multi for each reagent
+    def binding_buffer(sets):
         bbuffer = Reagent(name='Binding Buffer',
                         flow_rate_aspirate=0.25,
                         flow_rate_dispense=0.25,
                         flow_rate_dispense_mix=0.25,
                         flow_rate_aspirate_mix=0.25,
                         delay=1,
-                        reagent_reservoir_volume=vol_bb*(NUM_SAMPLES+1)*1.1,
+                        reagent_reservoir_volume=vol_bb*num_wells_filled*1.1*sets,
                         h_cono=1.95,
                         v_fondo=695,
+                        tip_recycling='step',
                         )
-        
-        run.comment(bbuffer.get_volumes_fill_print(),add_hash=True)
-
         #First 3 rows in this case
         bbuffer.set_positions(beads_slot.rows()[0][0:bbuffer.num_wells])
-        air_gap_vol = 0
-        disposal_height = -5
-        
-        pool_area = 8.3*71.1
-
-        run.pick_up()
-        for destination in aw_wells_multi:
-            
-            for vol in bbuffer.divide_volume(vol_bb,150):
-                pickup_height = bbuffer.calc_height(pool_area, vol*8)
-                
-                run.move_volume(reagent=bbuffer, source=bbuffer.get_current_position(),
-                            dest=destination, vol=vol, air_gap_vol=0,touch_tip=True,
-                            pickup_height=pickup_height, disp_height=disposal_height,
-                            )
-            #run.change_tip()                
-
-        run.drop_tip()
-
-        # Manual negative control
-        if(NUM_SAMPLES<94):
-            #set up negative control
-            run.set_pip("right")
-            run.pick_up(tips300["H12"])
-            negative_control_well = aw_slot.wells("G12")[0]
-            pickup_height = bbuffer.calc_height(pool_area, vol)
-            for vol in bbuffer.divide_volume(vol_bb,175):
-                pickup_height = bbuffer.calc_height(pool_area, vol)
-                run.move_volume(reagent=bbuffer, source=bbuffer.get_current_position(),
-                                dest=negative_control_well, vol=vol, air_gap_vol=air_gap_vol,
-                                pickup_height=pickup_height-2, disp_height=disposal_height,touch_tip=True,
-                                )
-
-            run.drop_tip()
-        run.finish_step()
+        return bbuffer
 
-    ############################################################################
-    # STEP 2: Pause, get DW replace tip racks
-    ############################################################################
-    if (run.next_step()):
-        ############################################################################
-        # Light flash end of program
-        run.blink(5)
-        run.pause("Get deepwell Binding buffer from Slot 5")
-        run.finish_step()
-                
-    ############################################################################
-    # STEP 3: Slot 2 -> 1 Washing buffer to plate
-    ############################################################################
-    if (run.next_step()):
-        ############################################################################
-        # Light flash end of program
-        run.set_pip("left")  # p300 multi
-        volume = vol_wb
+    def wash_buffer(sets):
         wb = Reagent(name='WB Wash buffer',
                         flow_rate_aspirate=0.25,
                         flow_rate_dispense=0.25,
                         flow_rate_dispense_mix=0.25,
                         flow_rate_aspirate_mix=0.25,
                         delay=1,
-                        reagent_reservoir_volume=vol_wb*(NUM_SAMPLES+1)*1.1,
+                        reagent_reservoir_volume=vol_wb*num_wells_filled*1.1*sets,
                         h_cono=1.95,
                         v_fondo=695,
+                        tip_recycling='step',
                         )
-
-        run.comment(wb.get_volumes_fill_print(),add_hash=True)
         wb.set_positions(wbeb_slot.rows()[0][0:wb.num_wells])
+        return wb
 
-        air_gap_vol = 1
-        disposal_height = -5
-        
-        pool_area = 8.3*71.1
-
-        run.pick_up()
-        for destination in wb_wells_multi:            
-            for vol in wb.divide_volume(volume,150):
-                pool_area = 8.3*71.1
-                pickup_height= wb.calc_height(
-                    pool_area, vol*8)
-
-                run.move_volume(reagent=wb, source=wb.get_current_position(),
-                                dest=destination, vol=vol, air_gap_vol=air_gap_vol,
-                                pickup_height=pickup_height, disp_height=disposal_height,touch_tip=True,
-                                )
-        run.drop_tip()
-
-        # Manual negative control
-        if(NUM_SAMPLES<94):
-            #set up negative control
-            run.set_pip("right")
-            negative_control_well = wb_slot.wells("G12")[0]
-            run.pick_up(tips300["G12"])
-            
-            for vol in wb.divide_volume(volume,175):
-                pickup_height= wb.calc_height(
-                    pool_area, vol)
-
-                run.move_volume(reagent=wb, source=wb.get_current_position(),
-                                dest=negative_control_well, vol=vol, air_gap_vol=air_gap_vol,
-                                pickup_height=pickup_height-2, disp_height=disposal_height, touch_tip=True,
-                                )
-
-            run.drop_tip()
-
-        run.finish_step()
-    
-    ############################################################################
-    # STEP 4: Slot 2 -> 3 elution buffer to plate
-    ############################################################################
-    if (run.next_step()):
-
-        run.set_pip("left")  # p300 multi
-        
+    def elution_buffer(sets):
         elution = Reagent(name='Elution Buffer',
                         flow_rate_aspirate=2,
                         flow_rate_dispense=2,
                         flow_rate_dispense_mix=4,
                         flow_rate_aspirate_mix=4,
-                        reagent_reservoir_volume=vol_eb*(NUM_SAMPLES+1),
+                        reagent_reservoir_volume=vol_eb*num_wells_filled*sets,
                         delay=1, 
                         num_wells=1,
                         h_cono=1.95,
                         v_fondo=695,
-                        rinse_loops=3)
-        run.comment(elution.get_volumes_fill_print(),add_hash=True)
+                        rinse_loops=3,
+                        tip_recycling='step')
         elution.set_positions(wbeb_slot.rows()[0][11:12])
-        
-        air_gap_vol = 1
-        disposal_height = -5
-        
-        pool_area = 8.3*71.1
-        pickup_height= 1
+        return elution
 
-        run.pick_up()
-        for destination in eb_wells_multi:    
-            run.move_volume(reagent=elution, source=elution.get_current_position(),
-                                dest=destination, vol=vol_eb, air_gap_vol=air_gap_vol,
-                                pickup_height=pickup_height, disp_height=disposal_height,
-                                touch_tip=True, rinse=True)
-        run.drop_tip()
-
-        # Manual negative control
-        if(NUM_SAMPLES<94):
-            #set up negative control
-            run.set_pip("right")
-            negative_control_well = eb_slot.wells("G12")[0]
-            run.pick_up(tips300["F12"])
-            pickup_height= 1
-
-            run.move_volume(reagent=wb, source=elution.get_current_position(),
-                            dest=negative_control_well, vol=vol_eb, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height, touch_tip=True,
-                            rinse=True)
-
-            run.drop_tip()
-            
-        run.finish_step()
-    
-    # ############################################################################
-    # # STEP 5: Slot 10 -> 11 etoh to plate
-    # ############################################################################
-    if (run.next_step()):
-        ############################################################################
-        run.set_pip("left")  # p300 multi
+    def ethanol(sets):
         etoh = Reagent(name='ETOH',
                         flow_rate_aspirate=1,
                         flow_rate_dispense=1,
                         flow_rate_dispense_mix=4,
                         flow_rate_aspirate_mix=4,
                         delay=1,
-                        reagent_reservoir_volume=vol_etoh*(NUM_SAMPLES+1),
+                        reagent_reservoir_volume=vol_etoh*num_wells_filled*sets,
                         vol_well_max=195000,
                         rinse=True,
                         num_wells=1,
                         h_cono=1.95,
-                        v_fondo=695)
+                        v_fondo=695,
+                        tip_recycling='step')
+        etoh.set_positions(etoh_pool_wells_multi[0:1])
+        return etoh
+
+    # The binding buffer of the next set is added before its pause, the
+    # rest of reagents of a set after it
+    new_reagent = {'Binding Buffer': binding_buffer, 'WB Wash buffer': wash_buffer,
+                   'Elution Buffer': elution_buffer, 'ETOH': ethanol}
+    campaign.add_reagent('Binding Buffer', vol_bb*num_wells_filled*1.1, 12*(12000-695), offset=1)
+    campaign.add_reagent('WB Wash buffer', vol_wb*num_wells_filled*1.1, 11*(12000-695))
+    campaign.add_reagent('Elution Buffer', vol_eb*num_wells_filled, 12000)
+    campaign.add_reagent('ETOH', vol_etoh*num_wells_filled, 195000)
+    campaign.plan()
+
+    reagents = {}
+    for name in new_reagent:
+        reagents[name] = new_reagent[name](campaign.initial_sets(name))
+        run.comment(reagents[name].get_volumes_fill_print(), add_hash=True)
+    if NUM_PLATE_SETS > 1:
+        run.comment(campaign.summary(), add_hash=True)
+
+    for plate_set in range(1, NUM_PLATE_SETS+1):
+        ############################################################################
+        # STEP 1: Slot 3 -2 BindingBuffer
+        ############################################################################
+        if (run.next_step()):
+            ############################################################################
+            # Light flash end of program
+            run.set_pip("left")  # p300 multi
+            bbuffer = reagents['Binding Buffer']
 
-        run.comment(etoh.get_volumes_fill_print(),add_hash=True)
+            air_gap_vol = 0
+            disposal_height = -5
+
+            pool_area = 8.3*71.1
+
+            for destination in aw_plan.whole:
+                run.use_tip(bbuffer, bbuffer.get_current_position(), destination,
+                            pick_up=lambda: campaign.pick_up(run))
+                for vol in bbuffer.divide_volume(vol_bb,150):
+                    pickup_height = bbuffer.calc_height(pool_area, vol*8)
+
+                    run.move_volume(reagent=bbuffer, source=bbuffer.get_current_position(),
+                                dest=destination, vol=vol, air_gap_vol=0,touch_tip=True,
+                                pickup_height=pickup_height, disp_height=disposal_height,
+                                )
+                #run.change_tip()                
 
-        air_gap_vol = 3
-        disposal_height = -5
-        
-        pool_area = 8.3*71.1
-        pickup_height = 1
-
-        run.pick_up()
-        for destination in etoh_wells_multi:            
-            volume_list = etoh.divide_volume(vol_etoh,175)
-            for vol in volume_list:
-                run.move_volume(reagent=etoh, source=etoh_pool_wells_multi[0],
-                                dest=destination, vol=vol, air_gap_vol=air_gap_vol,
-                                pickup_height=1, disp_height=disposal_height,
-                                rinse=True)
-            
-        
-        run.drop_tip()
-
-        #Negative control if less than 94
-        if(NUM_SAMPLES<94):
-            #set up negative control
-            run.set_pip("right")
-            negative_control_well = etoh_slot.wells("G12")[0]
-            run.pick_up(tips300["E12"])
-            volume_list = etoh.divide_volume(vol_etoh,175)
-            for vol in volume_list:
-                run.move_volume(reagent=etoh, source=etoh_pool_wells_multi[0],
-                                dest=negative_control_well, vol=vol, air_gap_vol=air_gap_vol,
-                                pickup_height=1, disp_height=disposal_height,
-                                rinse=True, touch_tip=True)
             run.drop_tip()
 
-        run.finish_step()
-    
+            # Wells of the partial column and manual negative control
+            if len(aw_plan.single) > 0:
+                run.set_pip("right")
+                for destination in aw_plan.single:
+                    run.use_tip(bbuffer, bbuffer.get_current_position(), destination,
+                                pick_up=lambda: campaign.pick_up(run, single=True))
+                    for vol in bbuffer.divide_volume(vol_bb,175):
+                        pickup_height = bbuffer.calc_height(pool_area, vol)
+                        run.move_volume(reagent=bbuffer, source=bbuffer.get_current_position(),
+                                        dest=destination, vol=vol, air_gap_vol=air_gap_vol,
+                                        pickup_height=pickup_height-2, disp_height=disposal_height,touch_tip=True,
+                                        )
+
+                run.drop_tip()
+            run.finish_step()
+
+        ############################################################################
+        # STEP 2: Pause, get DW replace tip racks
+        ############################################################################
+        if (run.next_step()):
+            ############################################################################
+            # Light flash end of program
+            # Every swap and refill of the set is done in this pause
+            actions = campaign.pause_actions(plate_set)
+            for name, sets in actions['refill']:
+                reagents[name] = new_reagent[name](sets)
+                run.comment(reagents[name].get_volumes_fill_print(), add_hash=True)
+            if actions['tips']:
+                campaign.reload_tips(run)
+            run.blink(5)
+            run.pause(campaign.pause_message(plate_set, actions))
+            run.finish_step()
+
+        ############################################################################
+        # STEP 3: Slot 2 -> 1 Washing buffer to plate
+        ############################################################################
+        if (run.next_step()):
+            ############################################################################
+            # Light flash end of program
+            run.set_pip("left")  # p300 multi
+            volume = vol_wb
+            wb = reagents['WB Wash buffer']
+
+            air_gap_vol = 1
+            disposal_height = -5
+
+            pool_area = 8.3*71.1
+
+            for destination in wb_plan.whole:            
+                run.use_tip(wb, wb.get_current_position(), destination,
+                            pick_up=lambda: campaign.pick_up(run))
+                for vol in wb.divide_volume(volume,150):
+                    pool_area = 8.3*71.1
+                    pickup_height= wb.calc_height(
+                        pool_area, vol*8)
+
+                    run.move_volume(reagent=wb, source=wb.get_current_position(),
+                                    dest=destination, vol=vol, air_gap_vol=air_gap_vol,
+                                    pickup_height=pickup_height, disp_height=disposal_height,touch_tip=True,
+                                    )
+            run.drop_tip()
+
+            # Wells of the partial column and manual negative control
+            if len(wb_plan.single) > 0:
+                run.set_pip("right")
+                for destination in wb_plan.single:
+                    run.use_tip(wb, wb.get_current_position(), destination,
+                                pick_up=lambda: campaign.pick_up(run, single=True))
+                    for vol in wb.divide_volume(volume,175):
+                        pickup_height= wb.calc_height(
+                            pool_area, vol)
+
+                        run.move_volume(reagent=wb, source=wb.get_current_position(),
+                                        dest=destination, vol=vol, air_gap_vol=air_gap_vol,
+                                        pickup_height=pickup_height-2, disp_height=disposal_height, touch_tip=True,
+                                        )
+
+                run.drop_tip()
+
+            run.finish_step()
+
+        ############################################################################
+        # STEP 4: Slot 2 -> 3 elution buffer to plate
+        ############################################################################
+        if (run.next_step()):
+
+            run.set_pip("left")  # p300 multi
+            elution = reagents['Elution Buffer']
+
+            air_gap_vol = 1
+            disposal_height = -5
+
+            pool_area = 8.3*71.1
+            pickup_height= 1
+
+            for destination in eb_plan.whole:    
+                run.use_tip(elution, elution.get_current_position(), destination,
+                            pick_up=lambda: campaign.pick_up(run))
+                run.move_volume(reagent=elution, source=elution.get_current_position(),
+                                    dest=destination, vol=vol_eb, air_gap_vol=air_gap_vol,
+                                    pickup_height=pickup_height, disp_height=disposal_height,
+                                    touch_tip=True, rinse=True)
+            run.drop_tip()
+
+            # Wells of the partial column and manual negative control
+            if len(eb_plan.single) > 0:
+                run.set_pip("right")
+                pickup_height= 1
+                for destination in eb_plan.single:
+                    run.use_tip(elution, elution.get_current_position(), destination,
+                                pick_up=lambda: campaign.pick_up(run, single=True))
+                    run.move_volume(reagent=elution, source=elution.get_current_position(),
+                                    dest=destination, vol=vol_eb, air_gap_vol=air_gap_vol,
+                                    pickup_height=pickup_height, disp_height=disposal_height, touch_tip=True,
+                                    rinse=True)
+
+                run.drop_tip()
+
+            run.finish_step()
+
+        # ############################################################################
+        # # STEP 5: Slot 10 -> 11 etoh to plate
+        # ############################################################################
+        if (run.next_step()):
+            ############################################################################
+            run.set_pip("left")  # p300 multi
+            etoh = reagents['ETOH']
+
+            air_gap_vol = 3
+            disposal_height = -5
+
+            pool_area = 8.3*71.1
+            pickup_height = 1
+
+            for destination in etoh_plan.whole:            
+                run.use_tip(etoh, etoh.get_current_position(), destination,
+                            pick_up=lambda: campaign.pick_up(run))
+                volume_list = etoh.divide_volume(vol_etoh,175)
+                for vol in volume_list:
+                    run.move_volume(reagent=etoh, source=etoh.get_current_position(),
+                                    dest=destination, vol=vol, air_gap_vol=air_gap_vol,
+                                    pickup_height=1, disp_height=disposal_height,
+                                    rinse=True)
+
+
+            run.drop_tip()
+
+            # Wells of the partial column and manual negative control
+            if len(etoh_plan.single) > 0:
+                run.set_pip("right")
+                for destination in etoh_plan.single:
+                    run.use_tip(etoh, etoh.get_current_position(), destination,
+                                pick_up=lambda: campaign.pick_up(run, single=True))
+                    volume_list = etoh.divide_volume(vol_etoh,175)
+                    for vol in volume_list:
+                        run.move_volume(reagent=etoh, source=etoh.get_current_position(),
+                                        dest=destination, vol=vol, air_gap_vol=air_gap_vol,
+                                        pickup_height=1, disp_height=disposal_height,
+                                        rinse=True, touch_tip=True)
+                run.drop_tip()
+
+            run.finish_step()
+
     run.log_steps_time()
+    run.log_tip_recycling()
+    run.comment('Tips left in the racks: %d whole columns, %d tips' % campaign.tips.available())
     run.blink()
     for c in robot.commands():
         ctx.comment(c)
@@ -463,6 +525,162 @@ class Reagent:
         vol_list.append(last_vol)
         return vol_list
 
+class ColumnPlan:
+    '''
+    Wells of [plate] that get a reagent: the top wells of the whole columns of the
+    first [num_wells] for the multi, and the wells of the trailing partial column
+    and the [controls] for the single, so no empty well gets reagent.
+    '''
+
+    def __init__(self, plate, num_wells, controls=[]):
+        wells = plate.wells()[:num_wells]
+        whole = len(wells)//8*8
+        self.whole = [wells[i] for i in range(0, whole, 8)]
+        self.single = wells[whole:] + [plate.wells(name)[0] for name in controls]
+
+class Campaign:
+    '''
+    Plan to prepare [num_sets] plate sets back to back. Reservoirs are filled for
+    as many sets as they hold and the tip racks for as many sets as fit in the deck.
+    Every plate swap, refill and rack change of a set is grouped in its pause.
+    tips_before/tips_after: (multi columns, single tips) used before and after the pause
+    '''
+
+    def __init__(self, num_sets, tips_before, tips_after):
+        self.num_sets = num_sets
+        self.tips_before = tips_before
+        self.tips_after = tips_after
+        self.reagents = []
+        self.pauses = []
+
+    def racks_needed(self):
+        cols = (self.tips_before[0]+self.tips_after[0])*self.num_sets
+        singles = (self.tips_before[1]+self.tips_after[1])*self.num_sets
+        return max(1, math.ceil((cols + math.ceil(singles/8))/12))
+
+    def set_tip_racks(self, tip_racks):
+        self.tip_racks = tip_racks
+        self.total_cols = len(tip_racks)*12
+        self.tips = TipAllocator(tip_racks)
+
+    def add_reagent(self, name, volume_set, capacity, offset=0):
+        # offset: 1 if the reagent of the next set is used before the pause
+        sets = max(1, min(self.num_sets, math.floor(capacity/volume_set)))
+        self.reagents.append({'name': name, 'sets_per_fill': sets, 'offset': offset})
+
+    def initial_sets(self, name):
+        for reagent in self.reagents:
+            if reagent['name'] == name:
+                return reagent['sets_per_fill']
+
+    def tips_fit(self, cols, singles):
+        return cols + math.ceil(singles/8) <= self.total_cols
+
+    def plan(self):
+        filled = {r['name']: r['sets_per_fill'] for r in self.reagents}
+        cols, singles = self.tips_before
+        for plate_set in range(1, self.num_sets+1):
+            actions = {'refill': [], 'tips': False}
+            for reagent in self.reagents:
+                need = plate_set + reagent['offset']
+                if need <= self.num_sets and need > filled[reagent['name']]:
+                    sets = min(reagent['sets_per_fill'], self.num_sets-need+1)
+                    actions['refill'].append((reagent['name'], sets))
+                    filled[reagent['name']] = need-1+reagent['sets_per_fill']
+            # Tips until the pause of the next set
+            next_cols, next_singles = self.tips_after
+            if plate_set < self.num_sets:
+                next_cols += self.tips_before[0]
+                next_singles += self.tips_before[1]
+            if not self.tips_fit(cols+next_cols, singles+next_singles):
+                actions['tips'] = True
+                cols, singles = 0, 0
+            cols += next_cols
+            singles += next_singles
+            self.pauses.append(actions)
+
+    def pause_actions(self, plate_set):
+        return self.pauses[plate_set-1]
+
+    def pause_message(self, plate_set, actions):
+        message = "Get deepwell Binding buffer from Slot 5"
+        if plate_set > 1:
+            message += ", get WB, EB and EtOH plates of set %d from slots 1, 3 and 11 and place empty ones" % (
+                plate_set-1)
+        if plate_set < self.num_sets:
+            message += ", place an empty deepwell on slot 5 for set %d" % (plate_set+1)
+        for name, sets in actions['refill']:
+            message += ", refill %s for %d sets" % (name, sets)
+        if actions['tips']:
+            message += ", replace all tip racks"
+        return message
+
+    def summary(self):
+        refills = sum(len(actions['refill']) for actions in self.pauses)
+        racks = sum(1 for actions in self.pauses if actions['tips'])
+        return "Campaign of %d plate sets: %d tip racks, %d refills and %d rack changes in %d pauses" % (
+            self.num_sets, len(self.tip_racks), refills, racks, len(self.pauses))
+
+    def pick_up(self, run, single=False):
+        tip = self.tips.single() if single else self.tips.column()
+        if tip == None:
+            # Only if the steps run do not follow the plan of the pauses
+            run.blink(5)
+            run.pause('Replace all tip racks before resuming')
+            self.reload_tips(run)
+            tip = self.tips.single() if single else self.tips.column()
+        run.pick_up(tip)
+
+    def reload_tips(self, run):
+        selected = run.selected_pip
+        for position in ['left', 'right']:
+            run.set_pip(position)
+            run.reset_pip_count(run.get_current_pip())
+        run.set_pip(selected)
+        self.tips.reset()
+
+class TipAllocator:
+    '''
+    Tips of the racks shared by the multi and the single channel pipettes. The
+    multi takes the first whole column, the single takes its tips from the bottom
+    of the partial columns first and then of the last whole column, so no column
+    the multi can use is opened while there are loose tips. The racks are only
+    empty when every tip has been used.
+    '''
+
+    def __init__(self, tip_racks):
+        self.columns = [column for rack in tip_racks for column in rack.columns()]
+        self.reset()
+
+    def reset(self):
+        self.left = [len(column) for column in self.columns]
+
+    def column(self):
+        # Top well of the first whole column, None if there is none
+        for index, column in enumerate(self.columns):
+            if self.left[index] == len(column):
+                self.left[index] = 0
+                return column[0]
+        return None
+
+    def single(self):
+        # Lowest tip of the partial column with fewer tips, or of the last whole one
+        partial = [i for i, column in enumerate(self.columns) if 0 < self.left[i] < len(column)]
+        if len(partial) > 0:
+            index = min(partial, key=lambda i: (self.left[i], i))
+        else:
+            whole = [i for i in range(len(self.columns)) if self.left[i] > 0]
+            if len(whole) == 0:
+                return None
+            index = whole[-1]
+        self.left[index] -= 1
+        return self.columns[index][self.left[index]]
+
+    def available(self):
+        # Whole columns for the multi and loose tips for the single
+        whole = sum(1 for i, column in enumerate(self.columns) if self.left[i] == len(column))
+        return whole, sum(self.left)
+
 class ProtocolRun:
     def __init__(self, ctx):
         self.ctx = ctx
@@ -479,6 +697,8 @@ class ProtocolRun:
 
         self.selected_pip = "right"
         self.pips = {"right": {}, "left": {}}
+        # Transfers, tips used and saved of every reagent by use_tip
+        self.tip_reuse = {}
 
     def add_step(self, description, execute=False, wait_time=0):
         self.step_list.append(
@@ -521,6 +741,7 @@ class ProtocolRun:
         return True
 
     def finish_step(self):
+        self.release_tips()
         if (self.get_current_step()["wait_time"] > 0 and use_waits):
             self.cdelay(seconds=int(self.get_current_step()[
                 "wait_time"]), msg=self.get_current_step()["description"])
@@ -560,10 +781,10 @@ class ProtocolRun:
             self.pips[position]["increment_tips"] = 1
 
     def mount_right_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("right", type, tip_racks, capacity)
+        self.mount_pip("right", type, tip_racks, capacity, multi)
 
     def mount_left_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("left", type, tip_racks, capacity)
+        self.mount_pip("left", type, tip_racks, capacity, multi)
 
     def get_current_pip(self):
         return self.pips[self.selected_pip]["pip"]
@@ -576,7 +797,7 @@ class ProtocolRun:
         self.pips[self.selected_pip]["count"] = 0
 
     def add_pip_count(self):
-        self.pips[self.selected_pip]["count"] + \
+        self.pips[self.selected_pip]["count"] += \
             self.pips[self.selected_pip]["increment_tips"]
 
     def get_pip_maxes(self):
@@ -636,12 +857,78 @@ class ProtocolRun:
     def drop_tip(self):
         pip = self.get_current_pip()
         pip.drop_tip(home_after=False)
-        self.add_pip_count()
+        self.pips[self.selected_pip]["tip"] = None
 
     def change_tip(self):
         self.drop_tip()
         self.pick_up()
 
+    def use_tip(self, reagent, source=None, dest=None, top=False, pick_up=None):
+        '''
+        Tip for a transfer of [reagent] from [source] to [dest]. The tip in the
+        pipette is kept for it if reagent.tip_recycling allows it:
+        'none' a new tip for every transfer,
+        'source' while the source well is the same,
+        'column' while the destination column is the same,
+        'step' for the whole step, only for destinations without samples,
+        'top' while every dispense has been from the top, without touching the liquid.
+        A tip is never kept for another reagent or step. [top] is True if the
+        transfer does not touch the liquid of [dest]. [pick_up] picks up the new tip.
+        '''
+        pip = self.get_current_pip()
+        tip = self.pips[self.selected_pip].get("tip")
+        # The column is the well name without the row, with its labware
+        column = dest.display_name[1:] if dest != None else None
+        stats = self.tip_reuse.setdefault(reagent.name, {
+            'policy': reagent.tip_recycling, 'transfers': 0, 'tips': 0, 'saved': 0, 'changes_saved': 0})
+        stats['transfers'] += 1
+        if pip.hw_pipette['has_tip'] and tip != None and tip['reagent'] is reagent and \
+                tip['step'] == self.step and self.keep_tip(reagent.tip_recycling, tip, source, column):
+            stats['saved'] += pip.channels
+            stats['changes_saved'] += 1
+        else:
+            if pip.hw_pipette['has_tip']:
+                self.drop_tip()
+            if pick_up != None:
+                pick_up()
+            else:
+                self.pick_up()
+            stats['tips'] += pip.channels
+            tip = {'reagent': reagent, 'step': self.step, 'top': True}
+            self.pips[self.selected_pip]["tip"] = tip
+        tip['source'] = source
+        tip['column'] = column
+        tip['top'] = tip['top'] and top
+
+    def keep_tip(self, policy, tip, source, column):
+        # A tip that has touched a destination only goes back to the same column
+        clean = tip['top'] or column == tip['column']
+        if policy == 'source':
+            return source == tip['source'] and clean
+        if policy == 'column':
+            return column == tip['column']
+        if policy == 'step':
+            return True
+        if policy == 'top':
+            return tip['top']
+        return False
+
+    def release_tips(self):
+        # Tips kept for the next transfer do not go on to the next step
+        selected = self.selected_pip
+        for position in self.pips:
+            if self.pips[position].get("tip") != None:
+                self.set_pip(position)
+                self.drop_tip()
+        self.set_pip(selected)
+
+    def log_tip_recycling(self):
+        # Tips the policies of the reagents saved against a new tip every transfer
+        for name, stats in self.tip_reuse.items():
+            self.comment('%s (%s): %d transfers, %d tips, %d tips and %s saved' % (
+                name, stats['policy'], stats['transfers'], stats['tips'], stats['saved'],
+                timedelta(seconds=int(stats['changes_saved']*tip_change_time))))
+
     def comment(self, comment, add_hash=False):
         hash_string = "#######################################################"
         if (add_hash):
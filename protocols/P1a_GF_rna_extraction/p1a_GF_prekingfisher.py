@@ -414,10 +414,10 @@ class ProtocolRun:
             self.pips[position]["increment_tips"] = 1
 
     def mount_right_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("right", type, tip_racks, capacity)
+        self.mount_pip("right", type, tip_racks, capacity, multi)
 
     def mount_left_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("left", type, tip_racks, capacity)
+        self.mount_pip("left", type, tip_racks, capacity, multi)
 
     def get_current_pip(self):
         
@@ -431,7 +431,7 @@ class ProtocolRun:
         self.pips[self.selected_pip]["count"] = 0
 
     def add_pip_count(self):
-        self.pips[self.selected_pip]["count"] + \
+        self.pips[self.selected_pip]["count"] += \
             self.pips[self.selected_pip]["increment_tips"]
 
     def get_pip_maxes(self):
@@ -492,7 +492,6 @@ class ProtocolRun:
     def drop_tip(self):
         pip = self.get_current_pip()
         pip.drop_tip(home_after=False)
-        self.add_pip_count()
 
     def change_tip(self):
         self.drop_tip()
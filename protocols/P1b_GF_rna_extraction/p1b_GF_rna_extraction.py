@@ -8,7 +8,7 @@ import os
 import numpy as np
 from timeit import default_timer as timer
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import csv
 import subprocess
 
@@ -154,6 +154,66 @@ def run(ctx: protocol_api.ProtocolContext):
                        tips300_8,tips300_9, tips300_6, tips300_5], capacity=200, multi=True)
 
     run.set_pip("left")
+
+    # Washes of the beads on the magnet
+    supernatant = Reagent(name='Sobrenadante',
+                          num_wells=1,  # change with num samples
+                          delay=0,
+                          flow_rate_aspirate=0.2,  # Original 0.5
+                          flow_rate_dispense=3,  # Original 1
+                          reagent_reservoir_volume=528,
+                          h_cono=4,
+                          v_fondo=4 * math.pi * 4 ** 3 / 3)
+
+    vol_wb = 485
+    wb = Reagent(name='WB Wash buffer',
+                 flow_rate_aspirate=0.25,
+                 flow_rate_dispense=0.25,
+                 flow_rate_dispense_mix=0.25,
+                 flow_rate_aspirate_mix=0.25,
+                 delay=1,
+                 reagent_reservoir_volume=vol_wb*(NUM_SAMPLES+1)*1.1,
+                 h_cono=1.95,
+                 v_fondo=695,
+                 )
+    run.comment(wb.get_volumes_fill_print(), add_hash=True)
+    wb.set_positions(wbeb_slot.rows()[0][0:wb.num_wells])
+
+    # Used twice in the next steps
+    vol_etoh = 500+250
+    etoh = Reagent(name='ETOH',
+                   flow_rate_aspirate=1,
+                   flow_rate_dispense=1,
+                   flow_rate_dispense_mix=4,
+                   flow_rate_aspirate_mix=4,
+                   delay=1,
+                   reagent_reservoir_volume=vol_etoh*(NUM_SAMPLES+1),
+                   vol_well_max=195000,
+                   rinse=True,
+                   num_wells=1,
+                   h_cono=1.95,
+                   v_fondo=695)
+    run.comment(etoh.get_volumes_fill_print(), add_hash=True)
+    etoh.set_positions(etoh_wells_multi)
+
+    trash_pool = [trash_pool_wells_multi[0]]
+    # The lysate is added by the transfer of step 2
+    binding = WashCycle(run, magdeck, mag_wells_multi, trash_pool, reagent=supernatant,
+                        supernatant=supernatant, volume=485, engage_height=mag_height,
+                        discard_height=1, trash_height=0)
+    wash_wb = WashCycle(run, magdeck, mag_wells_multi, trash_pool, reagent=wb,
+                        supernatant=supernatant, volume=vol_wb, mix_rounds=10, mix_volume=50,
+                        engage_height=mag_height, source_area=8.3*71.1, last_disp_height=-1,
+                        discard_height=1, trash_height=0)
+    wash_etoh = WashCycle(run, magdeck, mag_wells_multi, trash_pool, reagent=etoh,
+                          supernatant=supernatant, volume=485, mix_rounds=5, mix_volume=50,
+                          engage_height=mag_height, last_disp_height=-4,
+                          discard_height=1, trash_height=0)
+    wash_etoh_final = WashCycle(run, magdeck, mag_wells_multi, trash_pool, reagent=etoh,
+                                supernatant=supernatant, volume=300, mix_rounds=5, mix_volume=50,
+                                engage_height=mag_height, last_disp_height=-4,
+                                discard_height=1, trash_height=0)
+
     ############################################################################
     # STEP 1: Incubation at 65ºC
     ############################################################################
@@ -206,59 +266,21 @@ def run(ctx: protocol_api.ProtocolContext):
     ############################################################################
     if (run.next_step()):
         if (set_mag_on):
-            magdeck.engage(height=mag_height)
+            binding.engage()
         run.finish_step()
-    
-    # Extraer liquido sin tocar los beats. Slot 7 - Piscina Slot 3
-    def move_magnet_to_trash(move_vol_steps=3):
-        run.set_pip("left")  # p300 multi
-        # Sobre nadante primer paso
-        liquid = Reagent(name='Sobrenadante',
-                         num_wells=1,  # change with num samples
-                         delay=0,
-                         flow_rate_aspirate=0.2,  # Original 0.5
-                         flow_rate_dispense=3,  # Original 1
-                         reagent_reservoir_volume=528,
-                         h_cono=4,
-                         v_fondo=4 * math.pi * 4 ** 3 / 3)
-
-        air_gap_vol = 3
-        pickup_height = 1
-        disposal_height = 0
-        # Hay que revisar los offsets para el movimiento este
-        for source in mag_wells_multi:
-            destination=trash_pool_wells_multi[0]
-            # Replace this
-            run.pick_up()
-            run.move_volume(reagent=liquid, source=source,
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height)
-
-            # Patch for last step of etho 250ul instead of 500
-            if(move_vol_steps == 3):
-                run.move_volume(reagent=liquid, source=source,
-                                dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                                pickup_height=pickup_height, disp_height=disposal_height)
-
-            # We want to empty does not matter if we aspirate more
-            run.move_volume(reagent=liquid, source=source,
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height)
-            run.drop_tip()
-
 
     ############################################################################
     # STEP 4: Extract liquid from magnet to liquid trash
     ############################################################################
     if (run.next_step()):
-        move_magnet_to_trash()
+        binding.discard()
         run.finish_step()
 
     ############################################################################
     # STEP 5: Magnet off
     ############################################################################
     if (run.next_step()):
-        magdeck.disengage()
+        binding.disengage()
         run.finish_step()
 
     ############################################################################
@@ -275,56 +297,7 @@ def run(ctx: protocol_api.ProtocolContext):
     # STEP 7: Add 500ul de WB a los bits 4 - 7
     ############################################################################
     if (run.next_step()):
-        run.set_pip("left")  # p300 multi
-        vol_wb = 485
-        wb = Reagent(name='WB Wash buffer',
-                        flow_rate_aspirate=0.25,
-                        flow_rate_dispense=0.25,
-                        flow_rate_dispense_mix=0.25,
-                        flow_rate_aspirate_mix=0.25,
-                        delay=1,
-                        reagent_reservoir_volume=vol_wb*(NUM_SAMPLES+1)*1.1,
-                        h_cono=1.95,
-                        v_fondo=695,
-                        )
-
-        run.comment(wb.get_volumes_fill_print(),add_hash=True)
-        wb.set_positions(wbeb_slot.rows()[0][0:wb.num_wells])
-
-        air_gap_vol = 3
-        disposal_height = -1  # Arriba y el último paso lo hacemos dentro
-        pool_area = 8.3*71.1
-        
-        for destination in mag_wells_multi:
-            run.pick_up()
-            
-            pickup_height= wb.calc_height(
-                    pool_area, 175*8)
-
-            run.move_volume(reagent=liquid, source=wb.get_current_position(),
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height
-                            )
-            pickup_height= wb.calc_height(
-                    pool_area, 175*8)
-
-            run.move_volume(reagent=liquid, source=wb.get_current_position(),
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height)
-
-            # This will be drop inside
-            pickup_height= wb.calc_height(
-                    pool_area, 175*8)
-
-            disposal_height=2
-            run.move_volume(reagent=liquid, source=wb.get_current_position(),
-                            dest=destination, vol=135, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height-3)
-
-            run.custom_mix(liquid, location=destination, vol=50,
-                           rounds=10, blow_out=True, mix_height=0)
-            run.drop_tip()
-
+        wash_wb.add()
         run.finish_step()
 
     ############################################################################
@@ -332,70 +305,27 @@ def run(ctx: protocol_api.ProtocolContext):
     ############################################################################
     if (run.next_step()):
         if (set_mag_on):
-            magdeck.engage(height=mag_height)
+            wash_wb.engage()
         run.finish_step()
     ############################################################################
     # STEP 9: Extract liquid from magnet to liquid trash
     ############################################################################
     if (run.next_step()):
-        move_magnet_to_trash()
+        wash_wb.discard()
         run.finish_step()
 
     ############################################################################
     # STEP 10: Magnet off
     ############################################################################
     if (run.next_step()):
-        magdeck.disengage()
+        wash_wb.disengage()
         run.finish_step()
 
-    # Used twice in the next steps
-
-    vol_etoh=500+250
-    etoh = Reagent(name='ETOH',
-                        flow_rate_aspirate=1,
-                        flow_rate_dispense=1,
-                        flow_rate_dispense_mix=4,
-                        flow_rate_aspirate_mix=4,
-                        delay=1,
-                        reagent_reservoir_volume=vol_etoh*(NUM_SAMPLES+1),
-                        vol_well_max=195000,
-                        rinse=True,
-                        num_wells=1,
-                        h_cono=1.95,
-                        v_fondo=695)
-
-    run.comment(etoh.get_volumes_fill_print(),add_hash=True)
-
     ############################################################################
     # STEP 11: Add 500ul de etoh a los beats Slot 8 - 7
     ############################################################################
     if (run.next_step()):
-
-        run.set_pip("left")  # p300 multi
-        liquid = etoh
-        air_gap_vol = 3
-        disposal_height = -1  # Arriba y el último paso lo hacemos dentro
-        pickup_height = 1
-
-        for source, destination in zip(etoh_wells_multi, mag_wells_multi):
-            run.pick_up()
-            run.move_volume(reagent=liquid, source=source,
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height
-                            )
-            run.move_volume(reagent=liquid, source=source,
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height)
-
-            # This will be drop inside
-            run.move_volume(reagent=liquid, source=source,
-                            dest=destination, vol=135, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height-3)
-
-            run.custom_mix(liquid, location=destination, vol=50,
-                           rounds=5, blow_out=True, mix_height=0)
-
-            run.drop_tip()
+        wash_etoh.add()
         run.finish_step()
 
     ############################################################################
@@ -403,20 +333,20 @@ def run(ctx: protocol_api.ProtocolContext):
     ############################################################################
     if (run.next_step()):
         if (set_mag_on):
-            magdeck.engage(height=mag_height)
+            wash_etoh.engage()
         run.finish_step()
     ############################################################################
     # STEP 13: Extract liquid from magnet to liquid trash
     ############################################################################
     if (run.next_step()):
-        move_magnet_to_trash()
+        wash_etoh.discard()
         run.finish_step()
 
     ############################################################################
     # STEP 14   : Magnet off
     ############################################################################
     if (run.next_step()):
-        magdeck.disengage()
+        wash_etoh.disengage()
         run.finish_step()
 
     ############################################################################
@@ -434,43 +364,22 @@ def run(ctx: protocol_api.ProtocolContext):
     # STEP 16: Add 250 de etoh a los beats Slot 8 - 7
     ############################################################################
     if (run.next_step()):
-
-        run.set_pip("left")  # p300 multi
-        liquid = etoh
-        air_gap_vol = 3
-        disposal_height = -1  # Arriba y el último paso lo hacemos dentro
-        pickup_height = 1
-
-        for source, destination in zip(etoh_wells_multi, mag_wells_multi):
-            run.pick_up()
-            run.move_volume(reagent=liquid, source=source,
-                            dest=destination, vol=175, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height
-                            )
-            # This will be drop inside
-            run.move_volume(reagent=liquid, source=source,
-                            dest=destination, vol=125, air_gap_vol=air_gap_vol,
-                            pickup_height=pickup_height, disp_height=disposal_height-3)
-            
-            run.custom_mix(liquid, location=destination, vol=50,
-                           rounds=5, blow_out=True, mix_height=0)
-
-
-            run.drop_tip()
+        wash_etoh_final.add()
+        run.finish_step()
 
     ############################################################################
     # STEP 17: Magnet on 2 minutos
     ############################################################################
     if (run.next_step()):
         if (set_mag_on):
-            magdeck.engage(height=mag_height)
+            wash_etoh_final.engage()
         run.finish_step()
 
     ############################################################################
     # STEP 18: Extract liquid from magnet to liquid trash
     ############################################################################
     if (run.next_step()):
-        move_magnet_to_trash(move_vol_steps=2)
+        wash_etoh_final.discard()
         run.finish_step()
 
     ############################################################################
@@ -486,7 +395,7 @@ def run(ctx: protocol_api.ProtocolContext):
     # STEP 20: Magnet off
     ############################################################################
     if (run.next_step()):
-        magdeck.disengage()
+        wash_etoh_final.disengage()
         run.finish_step()
 
     ############################################################################
@@ -736,6 +645,99 @@ class Reagent:
         vol_list.append(last_vol)
         return vol_list
 
+class WashCycle:
+    '''
+    Wash of the beads on the magnetic module: add [reagent], mix, engage, wait,
+    discard the supernatant and disengage. Volumes are split in the fewest passes
+    the pipette can hold, with a new tip for every column in each phase. The steps
+    of the protocol run the phases and keep the wait of the magnet.
+    '''
+
+    def __init__(self, run, magdeck, wells, trash, reagent, supernatant, volume,
+                 mix_rounds=5, mix_volume=175, engage_height=6.5,
+                 discard_volume=None, air_gap_vol=3,
+                 pickup_height=1, source_area=None, disp_height=-1, last_disp_height=-10,
+                 discard_height=0.01, trash_height=-5):
+        self.run = run
+        self.magdeck = magdeck
+        self.wells = wells
+        self.trash = trash  # One trash well per column or a single pool
+        self.reagent = reagent
+        self.supernatant = supernatant
+        self.volume = volume
+        self.mix_rounds = mix_rounds
+        self.mix_volume = mix_volume
+        self.engage_height = engage_height
+        # Aspirate more than was added to be sure the well is empty
+        self.discard_volume = discard_volume if discard_volume != None else volume*1.1
+        self.air_gap_vol = air_gap_vol
+        self.pickup_height = pickup_height
+        self.source_area = source_area  # Follow the level of the reservoir if set
+        self.disp_height = disp_height
+        self.last_disp_height = last_disp_height
+        self.discard_height = discard_height
+        self.trash_height = trash_height
+        self.times = {}
+
+    def passes(self, volume):
+        # Fewest transfers that fit in the tip together with the air gap
+        return self.reagent.divide_volume(volume, self.run.get_pip_capacity()-self.air_gap_vol)
+
+    def source(self, volume):
+        if self.source_area != None:
+            channels = self.run.get_current_pip().channels
+            height = self.reagent.calc_height(self.source_area, volume*channels)
+            return self.reagent.get_current_position(), height
+        return self.reagent.get_current_position(), self.pickup_height
+
+    def add(self):
+        start = timer()
+        passes = self.passes(self.volume)
+        tips = 0
+        for destination in self.wells:
+            self.run.pick_up()
+            tips += 1
+            for i, vol in enumerate(passes):
+                last = i == len(passes)-1
+                source, pickup_height = self.source(vol)
+                self.run.move_volume(reagent=self.reagent, source=source,
+                                     dest=destination, vol=vol, air_gap_vol=self.air_gap_vol,
+                                     pickup_height=pickup_height,
+                                     disp_height=self.last_disp_height if last else self.disp_height)
+            if self.mix_rounds > 0:
+                self.run.custom_mix(self.reagent, location=destination, vol=self.mix_volume,
+                                    rounds=self.mix_rounds, blow_out=True, mix_height=0)
+            self.run.drop_tip()
+        self.log('add', start, passes, tips)
+
+    def engage(self):
+        self.magdeck.engage(height=self.engage_height)
+
+    def discard(self):
+        start = timer()
+        passes = self.passes(self.discard_volume)
+        for i, source in enumerate(self.wells):
+            destination = self.trash[i % len(self.trash)]
+            self.run.pick_up()
+            for vol in passes:
+                self.run.move_volume(reagent=self.supernatant, source=source,
+                                     dest=destination, vol=vol, air_gap_vol=self.air_gap_vol,
+                                     pickup_height=self.discard_height,
+                                     disp_height=self.trash_height)
+            self.run.drop_tip()
+        self.log('discard', start, passes, len(self.wells))
+
+    def disengage(self):
+        self.magdeck.disengage()
+
+    def log(self, phase, start, passes, tips):
+        seconds = timer() - start
+        self.times[phase] = self.times.get(phase, 0) + seconds
+        self.run.comment('%s %s: %d passes of %s ul, %d tips, %s' % (
+            self.reagent.name, phase, len(passes), passes[0], tips,
+            timedelta(seconds=int(seconds))))
+
+
 class ProtocolRun:
     def __init__(self, ctx):
         self.ctx = ctx
@@ -833,10 +835,10 @@ class ProtocolRun:
             self.pips[position]["increment_tips"] = 1
 
     def mount_right_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("right", type, tip_racks, capacity)
+        self.mount_pip("right", type, tip_racks, capacity, multi)
 
     def mount_left_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("left", type, tip_racks, capacity)
+        self.mount_pip("left", type, tip_racks, capacity, multi)
 
     def get_current_pip(self):
         
@@ -850,7 +852,7 @@ class ProtocolRun:
         self.pips[self.selected_pip]["count"] = 0
 
     def add_pip_count(self):
-        self.pips[self.selected_pip]["count"] + \
+        self.pips[self.selected_pip]["count"] += \
             self.pips[self.selected_pip]["increment_tips"]
 
     def get_pip_maxes(self):
@@ -911,7 +913,6 @@ class ProtocolRun:
     def drop_tip(self):
         pip = self.get_current_pip()
         pip.drop_tip(home_after=False)
-        self.add_pip_count()
 
     def change_tip(self):
         self.drop_tip()
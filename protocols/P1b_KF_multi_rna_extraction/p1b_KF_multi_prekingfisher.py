@@ -71,7 +71,7 @@ def run(ctx: protocol_api.ProtocolContext):
     tube_rack = ctx.load_labware(
         'opentrons_24_aluminumblock_generic_2ml_screwcap', 4)
 
-    reagents_pool = ctx.load_labware)
+    reagents_pool = ctx.load_labware(
         'nest_12_reservoir_15ml', 1)
 
     reagents_pool_multi = reagents_pool.rows() [0][:num_cols]
@@ -88,36 +88,15 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # Mount pippets and set racks
     # Tipracks20_multi
-<<<<<<< HEAD
-    tips20_1 = ctx.load_labware('opentrons_96_tiprack_20ul', 7)
-    tips20_2 = ctx.load_labware('opentrons_96_filtertiprack_200ul', 8)
-    tips20_3 = ctx.load_labware('opentrons_96_filtertiprack_200ul', 9)
-
-    run.mount_right_pip('p20_single_gen2', tip_racks=[tips20_1], capacity=20)
-    run.mount_left_pip('p20_multi_gen2', tip_racks=[
-                       tips20_2, tips20_3], capacity=200, multi=True)
-
-=======
     tips20_1 = ctx.load_labware('opentrons_96_tiprack_20ul', 9)
     tips20_2 = ctx.load_labware('opentrons_96_tiprack_20ul', 6)
     
     run.mount_left_pip('p20_single_gen2', tip_racks=[tips20_1,tips20_2], capacity=20)
     
->>>>>>> 4903dd0929c14132bf21224ff662430c5a56502f
     ############################################################################
     # STEP 1: Transfer PK+MS2 - To AW_PLATE
     ############################################################################
     if (run.next_step()):
-<<<<<<< HEAD
-        run.set_pip("right")  # multi 20
-        volumen_move = 5
-        source = tube_rack.wells("A6")[0]
-        liquid = Reagent(name='Proteinasa K',
-                         num_wells=1,  # change with num samples
-                         flow_rate_aspirate=0.75,  # Original 0.5
-                         flow_rate_dispense=3,  # Original 1
-                         reagent_reservoir_volume=528,
-=======
         run.set_pip("left")  # single 20
         
         pkms2 = Reagent(
@@ -129,7 +108,6 @@ def run(ctx: protocol_api.ProtocolContext):
                          delay=1,
                          vol_well_max=1100,
                          reagent_reservoir_volume=vol_pkms2*(NUM_SAMPLES+1),
->>>>>>> 4903dd0929c14132bf21224ff662430c5a56502f
                          h_cono=4,
                          v_fondo=4 * math.pi * 4 ** 3 / 3
                          )
@@ -419,10 +397,10 @@ class ProtocolRun:
             self.pips[position]["increment_tips"] = 1
 
     def mount_right_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("right", type, tip_racks, capacity)
+        self.mount_pip("right", type, tip_racks, capacity, multi)
 
     def mount_left_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("left", type, tip_racks, capacity)
+        self.mount_pip("left", type, tip_racks, capacity, multi)
 
     def get_current_pip(self):
         
@@ -436,7 +414,7 @@ class ProtocolRun:
         self.pips[self.selected_pip]["count"] = 0
 
     def add_pip_count(self):
-        self.pips[self.selected_pip]["count"] + \
+        self.pips[self.selected_pip]["count"] += \
             self.pips[self.selected_pip]["increment_tips"]
 
     def get_pip_maxes(self):
@@ -497,7 +475,6 @@ class ProtocolRun:
     def drop_tip(self):
         pip = self.get_current_pip()
         pip.drop_tip(home_after=False)
-        self.add_pip_count()
 
     def change_tip(self):
         self.drop_tip()
@@ -95,7 +95,7 @@ def run(ctx: protocol_api.ProtocolContext):
     tips20_2 = ctx.load_labware('opentrons_96_tiprack_20ul', 6)
     
     run.mount_left_pip('p20_single_gen2', tip_racks=[tips20_1,tips20_2], capacity=20)
-    run.mount_right_pip('p20_multi_gen2', tip_racks=[tips20_1, tips20_2], capacity=20)
+    run.mount_right_pip('p20_multi_gen2', tip_racks=[tips20_1, tips20_2], capacity=20, multi=True)
     
     ############################################################################
     # STEP 1: Transfer PK+MS2 - To AW_PLATE
@@ -395,10 +395,10 @@ class ProtocolRun:
             self.pips[position]["increment_tips"] = 1
 
     def mount_right_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("right", type, tip_racks, capacity)
+        self.mount_pip("right", type, tip_racks, capacity, multi)
 
     def mount_left_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("left", type, tip_racks, capacity)
+        self.mount_pip("left", type, tip_racks, capacity, multi)
 
     def get_current_pip(self):
         
@@ -413,7 +413,7 @@ class ProtocolRun:
         self.pips[self.selected_pip]["count"] = 0
 
     def add_pip_count(self):
-        self.pips[self.selected_pip]["count"] + \
+        self.pips[self.selected_pip]["count"] += \
             self.pips[self.selected_pip]["increment_tips"]
 
     def get_pip_maxes(self):
@@ -470,7 +470,6 @@ class ProtocolRun:
     def drop_tip(self):
         pip = self.get_current_pip()
         pip.drop_tip(home_after=False)
-        self.add_pip_count()
 
     def change_tip(self):
         self.drop_tip()
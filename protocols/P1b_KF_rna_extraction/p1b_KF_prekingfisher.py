@@ -8,7 +8,7 @@ import os
 import numpy as np
 from timeit import default_timer as timer
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import csv
 import subprocess
 
@@ -45,6 +45,11 @@ num_cols = math.ceil(NUM_SAMPLES/8)
 # Usar control general para las esperas para debug, siempre True
 use_waits = True
 
+# 'none' a new tip for every sample, 'top' keeps the tip of a reagent while it is
+# dispensed from the top without touch tip (see ProtocolRun.use_tip)
+reagent_tip_recycling = 'none'
+tip_change_time = 10  # Seconds to drop a tip and pick up a new one, for the tips saved
+
 diameter_screwcap = 8.1  # Diameter of the screwcap
 volume_cone = 57  # Volume in ul that fit in the screwcap cone
 area_section_screwcap = (np.pi * diameter_screwcap**2) / 4
@@ -104,20 +109,23 @@ def run(ctx: protocol_api.ProtocolContext):
                          vol_well_max=1100,
                          reagent_reservoir_volume=vol_pkms2*(NUM_SAMPLES+1),
                          h_cono=4,
-                         v_fondo=4 * math.pi * 4 ** 3 / 3
+                         v_fondo=4 * math.pi * 4 ** 3 / 3,
+                         tip_recycling=reagent_tip_recycling
                          )
         pkms2.set_positions([tube_rack.wells("A6")[0],tube_rack.wells("B6")[0]])
         run.comment(pkms2.get_volumes_fill_print(),add_hash=True)
         
+        # Touch tip is the only contact with the samples
+        touch_tip = reagent_tip_recycling != 'top'
         for dest in aw_wells:
             pickup_height = pkms2.calc_height(
                 4.12*4.12*math.pi, vol_pkms2)
-            run.pick_up()
+            run.use_tip(pkms2, pkms2.get_current_position(), dest, top=not touch_tip)
             run.move_volume(reagent=pkms2, source=pkms2.get_current_position(),
                             dest=dest, vol=vol_pkms2, 
                             pickup_height=pickup_height, disp_height=disposal_height,
-                            touch_tip=True, post_dispense=5)
-            run.drop_tip()
+                            touch_tip=touch_tip, post_dispense=5)
+        run.drop_tip()
 
         # Manual negative control
         if(NUM_SAMPLES<94):
@@ -150,21 +158,23 @@ def run(ctx: protocol_api.ProtocolContext):
                          reagent_reservoir_volume=vol_beads*(NUM_SAMPLES+1),
                          vol_well_max=1100,
                          h_cono=4,
-                         v_fondo=4 * math.pi * 4 ** 3 / 3
+                         v_fondo=4 * math.pi * 4 ** 3 / 3,
+                         tip_recycling=reagent_tip_recycling
                          )
 
         beads.set_positions([tube_rack.wells("C6")[0],tube_rack.wells("D6")[0]])
         run.comment(beads.get_volumes_fill_print(),add_hash=True)
 
+        touch_tip = reagent_tip_recycling != 'top'
         for dest in aw_wells:
-            run.pick_up()
             pickup_height = beads.calc_height(
                 4.12*4.12*math.pi, vol_beads)
+            run.use_tip(beads, beads.get_current_position(), dest, top=not touch_tip)
             run.move_volume(reagent=beads, source=beads.get_current_position(),
                             dest=dest, vol=vol_beads, 
                             pickup_height=pickup_height, disp_height=disposal_height,
-                            touch_tip=True, post_dispense=5)
-            run.drop_tip()
+                            touch_tip=touch_tip, post_dispense=5)
+        run.drop_tip()
 
         # Manual negative control
         if(NUM_SAMPLES<94):
@@ -183,6 +193,7 @@ def run(ctx: protocol_api.ProtocolContext):
         
 
     run.log_steps_time()
+    run.log_tip_recycling()
     run.blink()
     for c in robot.commands():
         ctx.comment(c)
@@ -311,6 +322,8 @@ class ProtocolRun:
 
         self.selected_pip = "right"
         self.pips = {"right": {}, "left": {}}
+        # Transfers, tips used and saved of every reagent by use_tip
+        self.tip_reuse = {}
 
     def add_step(self, description, execute=False, wait_time=0):
         self.step_list.append(
@@ -353,6 +366,7 @@ class ProtocolRun:
         return True
 
     def finish_step(self):
+        self.release_tips()
         if (self.get_current_step()["wait_time"] > 0 and use_waits):
             self.cdelay(seconds=int(self.get_current_step()[
                 "wait_time"]), msg=self.get_current_step()["description"])
@@ -392,10 +406,10 @@ class ProtocolRun:
             self.pips[position]["increment_tips"] = 1
 
     def mount_right_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("right", type, tip_racks, capacity)
+        self.mount_pip("right", type, tip_racks, capacity, multi)
 
     def mount_left_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("left", type, tip_racks, capacity)
+        self.mount_pip("left", type, tip_racks, capacity, multi)
 
     def get_current_pip(self):
         
@@ -409,7 +423,7 @@ class ProtocolRun:
         self.pips[self.selected_pip]["count"] = 0
 
     def add_pip_count(self):
-        self.pips[self.selected_pip]["count"] + \
+        self.pips[self.selected_pip]["count"] += \
             self.pips[self.selected_pip]["increment_tips"]
 
     def get_pip_maxes(self):
@@ -470,12 +484,78 @@ class ProtocolRun:
     def drop_tip(self):
         pip = self.get_current_pip()
         pip.drop_tip(home_after=False)
-        self.add_pip_count()
+        self.pips[self.selected_pip]["tip"] = None
 
     def change_tip(self):
         self.drop_tip()
         self.pick_up()
 
+    def use_tip(self, reagent, source=None, dest=None, top=False, pick_up=None):
+        '''
+        Tip for a transfer of [reagent] from [source] to [dest]. The tip in the
+        pipette is kept for it if reagent.tip_recycling allows it:
+        'none' a new tip for every transfer,
+        'source' while the source well is the same,
+        'column' while the destination column is the same,
+        'step' for the whole step, only for destinations without samples,
+        'top' while every dispense has been from the top, without touching the liquid.
+        A tip is never kept for another reagent or step. [top] is True if the
+        transfer does not touch the liquid of [dest]. [pick_up] picks up the new tip.
+        '''
+        pip = self.get_current_pip()
+        tip = self.pips[self.selected_pip].get("tip")
+        # The column is the well name without the row, with its labware
+        column = dest.display_name[1:] if dest != None else None
+        stats = self.tip_reuse.setdefault(reagent.name, {
+            'policy': reagent.tip_recycling, 'transfers': 0, 'tips': 0, 'saved': 0, 'changes_saved': 0})
+        stats['transfers'] += 1
+        if pip.hw_pipette['has_tip'] and tip != None and tip['reagent'] is reagent and \
+                tip['step'] == self.step and self.keep_tip(reagent.tip_recycling, tip, source, column):
+            stats['saved'] += pip.channels
+            stats['changes_saved'] += 1
+        else:
+            if pip.hw_pipette['has_tip']:
+                self.drop_tip()
+            if pick_up != None:
+                pick_up()
+            else:
+                self.pick_up()
+            stats['tips'] += pip.channels
+            tip = {'reagent': reagent, 'step': self.step, 'top': True}
+            self.pips[self.selected_pip]["tip"] = tip
+        tip['source'] = source
+        tip['column'] = column
+        tip['top'] = tip['top'] and top
+
+    def keep_tip(self, policy, tip, source, column):
+        # A tip that has touched a destination only goes back to the same column
+        clean = tip['top'] or column == tip['column']
+        if policy == 'source':
+            return source == tip['source'] and clean
+        if policy == 'column':
+            return column == tip['column']
+        if policy == 'step':
+            return True
+        if policy == 'top':
+            return tip['top']
+        return False
+
+    def release_tips(self):
+        # Tips kept for the next transfer do not go on to the next step
+        selected = self.selected_pip
+        for position in self.pips:
+            if self.pips[position].get("tip") != None:
+                self.set_pip(position)
+                self.drop_tip()
+        self.set_pip(selected)
+
+    def log_tip_recycling(self):
+        # Tips the policies of the reagents saved against a new tip every transfer
+        for name, stats in self.tip_reuse.items():
+            self.comment('%s (%s): %d transfers, %d tips, %d tips and %s saved' % (
+                name, stats['policy'], stats['transfers'], stats['tips'], stats['saved'],
+                timedelta(seconds=int(stats['changes_saved']*tip_change_time))))
+
     def comment(self, comment, add_hash=False):
         hash_string = "#######################################################"
         if (add_hash):
@@ -4,11 +4,12 @@ from opentrons import robot
 from opentrons import protocol_api
 from opentrons import labware
 import time
+import threading
 import os
 import numpy as np
 from timeit import default_timer as timer
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import csv
 
 # metadata
@@ -16,7 +17,7 @@ metadata = {
     'protocolName': 'Per Version 2',
     'author': 'Matias Bonet Fullana & Antoni Morla. based on: Malen Aguirregabiria,Aitor Gastaminza & José Luis Villanueva (jlvillanueva@clinic.cat)',
     'source': 'Hospital Son Espases Palma',
-    'apiLevel': '2.2',
+    'apiLevel': '2.3',
     'description': 'Protocol for Marter mix'
 }
 
@@ -29,6 +30,19 @@ metadata = {
 # when robot finish to use reagents, stop session and wait romoving reagents --> the when user press resume button --> continue
 remove_termoblock = False
 stop_termoblock = True  # when finish to use tempdeck, temperature control is deactivating
+next_plate_queued = False  # another plate is queued: keep the termoblock cold for the next run
+temp_tolerance = 0.5  # ºC around the target that count as reached
+temp_stable_time = 30  # Seconds the block must stay within tolerance before starting
+temp_timeout = 1200  # Seconds to wait for a stable block before falling back to the module
+temp_sample_interval = 2  # Seconds between temperature samples of the log
+
+# Dry run on the robot to check a new desk: faster motions and shortened waits
+validation_mode = False
+validation_speed = 2  # Pipette motion speed multiplier in validation mode
+validation_wait_factor = 0.1  # Waits and delays are multiplied by this factor
+operator_response = 60  # Seconds a pause is assumed to last in simulation
+move_time = 2  # Seconds of a move of the gantry between two locations in simulation
+tip_change_time = 10  # Seconds to drop a tip and pick up a new one in simulation
 
 # Check stop termoblock when remove termoblock
 if remove_termoblock == True:
@@ -39,7 +53,7 @@ if remove_termoblock == True:
 NUM_SAMPLES = 96
 steps = []  # Steps you want to execute
 temp = 25  # Define termoblock temperature
-num_blinks = 10  # Define number of advisor temperature blinks
+num_blinks = 10  # Define number of advisor blinks at the end of the run
 air_gap_vol = 10
 air_gap_mmix = 0
 air_gap_sample = 0
@@ -54,6 +68,14 @@ select_mmix = "Termofisher"  # Now only one recipe available
 
 volume_elution = 10  # Volume of the sample
 extra_dispensal = 0  # Extra volume for master mix in each distribute transfer
+# The pipette of a transfer is the one with the fewest aspirations, a tip rack
+# change counts as this many aspirations
+rack_change_cost = 20
+# Step 2 distributes the master mix: an aspiration of the tip capacity fills consecutive wells.
+# Only if a pipette measures the volume_mmix of every well above its minimum volume
+distribute_mmix = True
+disposal_vol = 10  # ul aspirated over the dispenses and blown back to the tube
+conditioning_vol = 5  # ul dispensed back to the tube after every aspiration to wet the tip
 diameter_screwcap = 8.1  # Diameter of the screwcap
 elution_initial_volume = 50  # True
 volume_cone = 57  # Volume in ul that fit in the screwcap cone
@@ -88,6 +110,12 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # Init protocol run
     run = ProtocolRun(ctx)
+
+    # Start cooling the termoblock while the desk is being checked
+    tempdeck = run.load_module('tempdeck', '10')
+    run.start_temperature(tempdeck, temp)
+    run.monitor_temperature(tempdeck)
+
     run.comment("You are about to run %s samples" % NUM_SAMPLES, add_hash=True)
     run.pause("Are you sure the set up is correct? Check the desk before continue")
 
@@ -101,7 +129,6 @@ def run(ctx: protocol_api.ProtocolContext):
 
     ##################################
     # Define desk
-    tempdeck = ctx.load_module('tempdeck', '10')
     tuberack = tempdeck.load_labware(
         'opentrons_24_aluminumblock_generic_2ml_screwcap')
 
@@ -228,10 +255,7 @@ def run(ctx: protocol_api.ProtocolContext):
     elution_wells = elution_plate.wells()[:NUM_SAMPLES]
 
     # check temperature to know if the protocol can start
-    tempdeck.set_temperature(temp)
-    for i in range(num_blinks):
-        if tempdeck.temperature == temp:
-            run.blink()
+    run.await_temperature(tempdeck, temp)
 
     ############################################################################
     # STEP 1: Make Master MIX
@@ -242,9 +266,6 @@ def run(ctx: protocol_api.ProtocolContext):
         run.comment('Selected MMIX: ' +
                     select_mmix, add_hash=True)
 
-        run.set_pip("left")
-        run.pick_up()
-        drop = False
         for i, [source] in enumerate(MMIX_components_location):
 
             run.comment('Add component: ' +
@@ -252,46 +273,27 @@ def run(ctx: protocol_api.ProtocolContext):
 
             # Get volumen calculated
             vol = MMIX_make["volumes"][i]
-            # because 20ul is the maximum volume of the tip we will choose 17
-            if (vol + air_gap_vol) > run.get_pip_capacity():
-                # calculate what volume should be transferred in each step
-                vol_list = run.divide_volume(vol, run.get_pip_capacity())
-                for vol in vol_list:
-                    # If not in first step we need to change everytime
-                    if(i > 0):
-                        run.pick_up()
-
-                    run.move_volume(reagent=MMIX_components[i], source=source, dest=MMIX_destination[0],
-                                    vol=vol, air_gap_vol=air_gap_vol, pickup_height=0, disp_height=-10,
-                                    blow_out=True)
-
-                    # If not in first step we need to change everytime
-                    if(i > 0):
-                        run.drop_tip()
-                        drop = True
-
-            else:
-                if(i > 0):
-                    run.pick_up()
-
+            run.select_pip(vol, air_gap_vol)
+            # calculate what volume should be transferred in each step
+            vol_list = MMIX_components[i].divide_volume(vol, run.get_pip_capacity()-air_gap_vol)
+            for vol in vol_list:
+                # The first component with one tip, the rest with a new one every time
+                run.pick_up()
                 run.move_volume(reagent=MMIX_components[i], source=source, dest=MMIX_destination[0],
-                                vol=vol, air_gap_vol=air_gap_vol, pickup_height=0,
-                                disp_height=-10, blow_out=True)
+                                vol=vol, air_gap_vol=air_gap_vol, pickup_height=0, disp_height=-10,
+                                blow_out=True)
                 if(i > 0):
                     run.drop_tip()
-                    drop = True
-
-            if i+1 < len(MMIX_components):
-                if(not drop):
-                    run.drop_tip()
+            if(i == 0):
+                run.drop_tip()
 
-            else:
-                run.pick_up()
-                run.comment('Final mix', add_hash=True)
+        run.select_pip(50)
+        run.pick_up()
+        run.comment('Final mix', add_hash=True)
 
-                run.custom_mix(reagent=MMIX, location=MMIX_destination[0], vol=50, rounds=5,
-                               blow_out=True, mix_height=2)
-                run.drop_tip()
+        run.custom_mix(reagent=MMIX, location=MMIX_destination[0], vol=50, rounds=5,
+                       blow_out=True, mix_height=2)
+        run.drop_tip()
 
         run.finish_step()
 
@@ -299,20 +301,31 @@ def run(ctx: protocol_api.ProtocolContext):
     # STEP 2: Positive and negative control
     ############################################################################
     if (run.next_step()):
-        run.set_pip("right")
-        run.pick_up()
-        volumen_mmix = MMIX_make["volume_available"]
-        for dest in pcr_wells:
-            [pickup_height, col_change] = run.calc_height(
-                MMIX, area_section_screwcap, MMIX_make["volume_mmix"])
-            print('Destination: ' + str(dest) +
-                  ' Pickup: --> ' + str(pickup_height))
-            run.comment('Start transfer MasterMIX')
-            run.move_volume(reagent=MMIX, source=MMIX_destination[0],
-                            dest=dest, vol=MMIX_make["volume_mmix"], air_gap_vol=air_gap_mmix,
-                            pickup_height=pickup_height, disp_height=-10,
-                            blow_out=True, touch_tip=True)
-            # change
+        # None when no pipette measures every dispense above its minimum volume
+        distributor = run.select_pip(MMIX_make["volume_mmix"], transfers=len(pcr_wells),
+                                     distribute=True) if distribute_mmix else None
+        if distributor != None:
+            run.pick_up()
+            run.distribute(reagent=MMIX, source=MMIX_destination[0], dests=pcr_wells,
+                           vol=MMIX_make["volume_mmix"], disp_height=-10,
+                           source_area=area_section_screwcap, touch_tip=True)
+            # The controls go with the pipette of the master mix, as without distribute
+            run.drop_tip()
+            run.select_pip(MMIX_make["volume_mmix"], air_gap_sample, transfers=3)
+            run.pick_up()
+        else:
+            run.select_pip(MMIX_make["volume_mmix"], air_gap_mmix, transfers=len(pcr_wells)+2)
+            run.pick_up()
+            for dest in pcr_wells:
+                pickup_height = MMIX.calc_height(
+                    area_section_screwcap, MMIX_make["volume_mmix"])
+                print('Destination: ' + str(dest) +
+                      ' Pickup: --> ' + str(pickup_height))
+                run.comment('Start transfer MasterMIX')
+                run.move_volume(reagent=MMIX, source=MMIX_destination[0],
+                                dest=dest, vol=MMIX_make["volume_mmix"], air_gap_vol=air_gap_mmix,
+                                pickup_height=pickup_height, disp_height=-10,
+                                blow_out=True, touch_tip=True)
         # mmix to positive and negative control
         #    -> Positive
         run.comment('MMIX to positive recipe')
@@ -348,7 +361,7 @@ def run(ctx: protocol_api.ProtocolContext):
     ############################################################################
     if(run.next_step()):
         run.comment('pcr_wells')
-        run.set_pip("right")
+        run.select_pip(volume_elution, air_gap_sample)
         run.pick_up()
 
         # Positive Control
@@ -364,12 +377,9 @@ def run(ctx: protocol_api.ProtocolContext):
         # ASK IF WANT DEACTIVATE TERMOBLOCK
         ####################################
         if remove_termoblock == True:
-            for i in range(num_blinks):
-                if tempdeck.temperature == temp:
-                    run.blink()
-            ctx.pause("Please remove the termoblock module to continue")
+            run.pause("Please remove the termoblock module to continue")
 
-        if stop_termoblock == True:
+        if stop_termoblock == True and not next_plate_queued:
             tempdeck.deactivate()
 
         run.drop_tip()
@@ -380,7 +390,7 @@ def run(ctx: protocol_api.ProtocolContext):
     ############################################################################
     if(run.next_step()):
         run.comment('pcr_wells')
-        run.set_pip("right")
+        run.select_pip(volume_elution, air_gap_sample, transfers=len(pcr_wells))
         # Loop over defined wells
         for s, d in zip(elution_wells, pcr_wells):
             run.comment("%s %s" % (s, d))
@@ -401,9 +411,9 @@ def run(ctx: protocol_api.ProtocolContext):
     ############################################################################
     # Light flash end of program
     run.log_steps_time()
-    for i in range(num_blinks):
-        if tempdeck.temperature == temp:
-            run.blink()
+    run.log_estimated_time()
+    run.stop_monitors()
+    run.blink(blink_number=num_blinks)
     run.comment('Finished! \nMove plate to PCR')
 
 
@@ -515,23 +525,328 @@ class Reagent:
         vol_list.append(last_vol)
         return vol_list
 
+class ThermalModel:
+    '''
+    Time the temperature module needs to ramp between two temperatures.
+    Heating and cooling are fitted separately from the ramps logged in the
+    previous runs as: seconds = lag + |delta| * seconds_per_degree
+    '''
+
+    def __init__(self, file_path=None, heat_rate=0.1, cool_rate=0.05, lag=20):
+        # Default rates in degrees per second, used until there are logged ramps
+        self.file_path = file_path
+        self.ramps = []
+        self.fit_params = {'heat': [lag, 1/heat_rate],
+                           'cool': [lag, 1/cool_rate]}
+
+        if self.file_path != None and os.path.isfile(self.file_path):
+            with open(self.file_path) as f:
+                self.ramps = json.load(f)["ramps"]
+            self.fit()
+
+    def direction(self, start, target):
+        if target >= start:
+            return 'heat'
+        return 'cool'
+
+    def fit(self):
+        # Least squares of the ramp time against the temperature delta
+        for direction in self.fit_params:
+            points = [[abs(target-start), seconds] for start, target, seconds in self.ramps
+                      if self.direction(start, target) == direction and abs(target-start) > 1]
+            if len(points) == 0:
+                continue
+            lag = self.fit_params[direction][0]
+            mean_delta = sum([p[0] for p in points])/len(points)
+            mean_seconds = sum([p[1] for p in points])/len(points)
+            var_delta = sum([(p[0]-mean_delta)**2 for p in points])
+            if len(points) > 1 and var_delta > 0:
+                slope = sum([(p[0]-mean_delta)*(p[1]-mean_seconds)
+                             for p in points])/var_delta
+                lag = max(mean_seconds - slope*mean_delta, 0)
+            else:
+                slope = (mean_seconds-lag)/mean_delta
+            if slope > 0:
+                self.fit_params[direction] = [lag, slope]
+
+    def ramp_time(self, start, target):
+        if abs(target-start) < 0.5:
+            return 0
+        lag, slope = self.fit_params[self.direction(start, target)]
+        return lag + abs(target-start)*slope
+
+    def add_ramp(self, start, target, seconds, max_ramps=50):
+        self.ramps.append([start, target, seconds])
+        self.ramps = self.ramps[-max_ramps:]
+        self.fit()
+        if self.file_path != None:
+            with open(self.file_path, 'w') as f:
+                json.dump({"ramps": self.ramps}, f)
+
+
+class RunClock:
+    '''
+    Time of the run in seconds. On the robot it is the wall clock, in simulation
+    it is a virtual clock that waits, delays, blinks, pauses and the pipetting
+    time model (move_time, the flow rates and tip_change_time) advance instantly.
+    '''
+
+    def __init__(self, simulating):
+        self.simulating = simulating
+        self.virtual_time = 0
+
+    def now(self):
+        if self.simulating:
+            return self.virtual_time
+        return time.monotonic()
+
+    def advance(self, seconds):
+        if self.simulating:
+            self.virtual_time += seconds
+
+    def advance_to(self, instant):
+        if self.simulating:
+            self.virtual_time = max(self.virtual_time, instant)
+
+    def sleep(self, seconds):
+        if self.simulating:
+            self.advance(seconds)
+        else:
+            time.sleep(seconds)
+
+
+class TempDeckEmulator:
+    '''
+    Stand-in of the temperature module for simulation. The temperature follows
+    the ramps of the thermal model along the simulated time instead of jumping
+    to the setpoint, and waiting for it advances the virtual clock.
+    '''
+
+    def __init__(self, run, module, ambient=25):
+        self.run = run
+        self.module = module
+        self.ambient = ambient
+        self._target = None
+        self.ramp_start = [ambient, run.clock.now()]
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def temperature_at(self, t):
+        start, start_time = self.ramp_start
+        end = self._target if self._target != None else self.ambient
+        model = self.run.thermal_model
+        lag, slope = model.fit_params[model.direction(start, end)]
+        if abs(end - start) < 0.5 or t - start_time >= model.ramp_time(start, end):
+            return end
+        change = max(t - start_time - lag, 0) / slope
+        if end > start:
+            return start + change
+        return start - change
+
+    @property
+    def temperature(self):
+        return self.temperature_at(self.run.clock.now())
+
+    @property
+    def target(self):
+        return self._target
+
+    @property
+    def status(self):
+        if self._target == None:
+            return 'idle'
+        if self.temperature == self._target:
+            return 'holding at target'
+        if self._target > self.ramp_start[0]:
+            return 'heating'
+        return 'cooling'
+
+    def start_set_temperature(self, celsius):
+        self.ramp_start = [self.temperature, self.run.clock.now()]
+        self._target = celsius
+        self.module.start_set_temperature(celsius)
+
+    def await_temperature(self, celsius):
+        self.run.clock.advance_to(
+            self.ramp_start[1] + self.run.thermal_model.ramp_time(self.ramp_start[0], celsius))
+        self.module.await_temperature(celsius)
+
+    def set_temperature(self, celsius):
+        self.start_set_temperature(celsius)
+        self.await_temperature(celsius)
+
+    def deactivate(self):
+        # Without control the block drifts back to the ambient temperature
+        self.ramp_start = [self.temperature, self.run.clock.now()]
+        self._target = None
+        self.module.deactivate()
+
+
+class MagDeckEmulator:
+    '''
+    Stand-in of the magnetic module gen2 for simulation, engage and disengage
+    take the travel time of the magnets in the virtual clock.
+    '''
+
+    def __init__(self, run, module, speed=2):
+        self.run = run
+        self.module = module
+        self.speed = speed  # mm/s of the magnets
+        self.height = 0
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    @property
+    def status(self):
+        if self.height > 0:
+            return 'engaged'
+        return 'disengaged'
+
+    def move(self, height):
+        self.run.clock.advance(abs(height - self.height) / self.speed)
+        self.height = height
+
+    def engage(self, height):
+        self.move(height)
+        self.module.engage(height=height)
+
+    def disengage(self):
+        self.move(0)
+        self.module.disengage()
+
+
+class TemperatureMonitor:
+    '''
+    Samples the temperature module in the background and logs the time series
+    of the run. wait_until returns as soon as the block is stable at the target.
+    '''
+
+    def __init__(self, module, file_path=None, interval=2, clock=None, simulating=False):
+        self.module = module
+        self.file_path = file_path
+        self.interval = interval
+        self.clock = clock
+        self.simulating = simulating
+        self.samples = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.start_time = self.now()
+        if self.file_path != None:
+            with open(self.file_path, 'w') as f:
+                f.write('time\ttemperature\ttarget\tstatus\n')
+
+    def now(self):
+        if self.clock != None:
+            return self.clock.now()
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if self.clock != None:
+            self.clock.sleep(seconds)
+        elif not self.simulating:
+            time.sleep(seconds)
+
+    def start(self):
+        # No thread in simulation, wait_until samples by itself
+        if self.simulating or self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join(self.interval*2)
+            self.thread = None
+
+    def loop(self):
+        while self.running:
+            try:
+                self.sample()
+            except Exception:
+                # A failed reading must not stop the run
+                pass
+            time.sleep(self.interval)
+
+    def sample(self):
+        reading = (round(self.now()-self.start_time, 1), self.module.temperature,
+                   self.module.target, self.module.status)
+        with self.lock:
+            self.samples.append(reading)
+        if self.file_path != None:
+            with open(self.file_path, 'a') as f:
+                f.write('\t'.join([str(value) for value in reading])+'\n')
+        return reading
+
+    def latest(self):
+        with self.lock:
+            if len(self.samples) == 0:
+                return None
+            return self.samples[-1]
+
+    def wait_until(self, target, tolerance=0.5, stable_for=30, timeout=1200):
+        '''
+        Wait until the temperature stays within [tolerance] of [target] during
+        [stable_for] seconds. Returns False if it is not stable after [timeout].
+        '''
+        start = self.now()
+        stable_since = None
+        while True:
+            reading = self.latest() if self.running else self.sample()
+            now = self.now()
+            if reading != None and abs(reading[1]-target) <= tolerance:
+                if stable_since == None:
+                    stable_since = now
+                if now-stable_since >= stable_for:
+                    return True
+            else:
+                stable_since = None
+            if now-start >= timeout:
+                return False
+            if self.simulating and self.clock == None:
+                # The simulated module is already at its setpoint
+                return stable_since != None
+            self.sleep(self.interval)
+
+
 class ProtocolRun:
     def __init__(self, ctx):
         self.ctx = ctx
         self.step_list = []
         self.step = 0
+        self.clock = RunClock(ctx.is_simulating())
 
         # Folder and file_path for log time
         folder_path = '/var/lib/jupyter/notebooks/'+log_folder
         if not self.ctx.is_simulating():
             if not os.path.isdir(folder_path):
                 os.mkdir(folder_path)
-            self.file_path = folder_path + \
-                '/rna_extraction_%s.tsv' % datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
+            # Validation runs are logged apart, their shortened times must not plan real runs
+            self.file_path = folder_path + '/%srna_extraction_%s.tsv' % (
+                'validation_' if validation_mode else '', datetime.now().strftime("%d_%m_%Y_%H_%M_%S"))
+            self.thermal_model = ThermalModel(
+                folder_path + '/thermal_model.json')
+        else:
+            self.thermal_model = ThermalModel()
+        self.folder_path = folder_path
 
         self.selected_pip = "right"
         self.pips = {"right": {}, "left": {}}
 
+        # Temperature ramps: scheduled to be ready for a step and in progress
+        self.temp_schedule = []
+        self.ramps = {}
+        self.monitors = {}
+        self.previous_times = []
+
+        if validation_mode and not self.ctx.is_simulating():
+            self.comment('VALIDATION MODE: faster motions and shortened waits, not for samples',
+                         add_hash=True)
+
     def add_step(self, description, execute=False, wait_time=0):
         self.step_list.append(
             {'execute': execute, 'description': description, 'wait_time': wait_time, 'execution_time': 0})
@@ -546,7 +861,7 @@ class ProtocolRun:
         else:
             for index, step in enumerate(self.step_list):
                 self.set_execution_step(index, True)
-
+        self.previous_times = self.load_previous_times()
 
         self.comment("###############################################")
         self.comment("You are about to run %s samples" % (NUM_SAMPLES))
@@ -564,29 +879,27 @@ class ProtocolRun:
         return self.step_list[self.step]
 
     def next_step(self):
+        self.check_temperature_schedule()
         if self.step_list[self.step]['execute'] == False:
             self.step += 1
             return False
 
         self.comment(self.step_list[self.step]['description'], add_hash=True)
-        self.start = datetime.now()
+        self.start = self.clock.now()
         return True
 
     def finish_step(self):
-        if (self.get_current_step()["wait_time"] > 0 and use_waits):
-            self.cdelay(seconds=int(self.get_current_step()[
+        if (self.get_current_step()["wait_time"] > 0):
+            self.delay(seconds=int(self.get_current_step()[
                 "wait_time"]), msg=self.get_current_step()["description"])
-        if (self.get_current_step()["wait_time"] > 0 and not use_waits):
-            self.ccomment("We simulate a wait of:%s seconds" %
-                          self.get_current_step()["wait_time"])
-        end = datetime.now()
-        time_taken = (end - self.start)
+        time_taken = timedelta(seconds=self.clock.now() - self.start)
         self.comment('Step ' + str(self.step + 1) + ': ' +
                      self.step_list[self.step]['description'] + ' took ' + str(time_taken), add_hash=True)
 
         self.step_list[self.step]['execution_time'] = str(time_taken)
         self.step += 1
         self.log_steps_time()
+        self.check_temperature_schedule()
 
     def log_steps_time(self):
         # Export the time log to a tsv file
@@ -596,13 +909,128 @@ class ProtocolRun:
                 row = ""
                 for step in self.step_list:
                     row = ('{}\t{}\t{}\t{}').format(
-                        step["execute"], step["description"], step["wait_time"], step["execution_time"])
+                        step["execute"], step["description"].replace('\n', ' '), step["wait_time"], step["execution_time"])
                     f.write(row + '\n')
             f.close()
 
+    def load_previous_times(self):
+        # Step durations in seconds of the last logged run, used to plan ahead
+        if self.ctx.is_simulating() or not os.path.isdir(self.folder_path):
+            return []
+        logs = [os.path.join(self.folder_path, f) for f in os.listdir(self.folder_path)
+                if f.startswith('rna_extraction_') and f.endswith('.tsv')]
+        if len(logs) == 0:
+            return []
+        times = []
+        with open(max(logs, key=os.path.getmtime)) as f:
+            for line in f.readlines()[1:]:
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    h, m, s = fields[-1].split(':')
+                    times.append(int(h)*3600 + int(m)*60 + float(s))
+                except ValueError:
+                    times.append(0)
+        # Logs of a different step list are useless
+        if len(times) != len(self.step_list):
+            return []
+        return times
+
+    def time_to_step(self, index):
+        # Estimated seconds until the step [index] begins
+        seconds = 0
+        for i in range(self.step, index):
+            if self.step_list[i]['execute']:
+                if i < len(self.previous_times) and self.previous_times[i] > 0:
+                    seconds += self.previous_times[i]
+                else:
+                    seconds += self.step_list[i]['wait_time']
+        return seconds
+
+    def schedule_temperature(self, module, celsius, step):
+        '''
+        Have the temperature [module] at [celsius] when [step] begins.
+        The ramp is started without blocking as late as the thermal model allows,
+        the step must call await_temperature before using the block.
+        '''
+        self.temp_schedule.append(
+            {'module': module, 'celsius': celsius, 'step': step-1, 'started': False})
+        self.check_temperature_schedule()
+
+    def check_temperature_schedule(self):
+        self.log_ramps()
+        pending_modules = []
+        for entry in list(self.temp_schedule):
+            if entry['step'] < self.step or not self.step_list[entry['step']]['execute']:
+                self.temp_schedule.remove(entry)
+                continue
+            # Only the first scheduled ramp of each module can be started
+            if entry['module'] in pending_modules:
+                continue
+            pending_modules.append(entry['module'])
+            if entry['started']:
+                continue
+            ramp = self.thermal_model.ramp_time(
+                entry['module'].temperature, entry['celsius'])
+            if self.time_to_step(entry['step']) <= ramp:
+                self.start_temperature(entry['module'], entry['celsius'])
+                entry['started'] = True
+
+    def start_temperature(self, module, celsius):
+        # Start the ramp without blocking, it is logged when the target is reached
+        if module.target == celsius:
+            return
+        ramp = self.thermal_model.ramp_time(module.temperature, celsius)
+        self.ramps[id(module)] = {'module': module, 'start': module.temperature,
+                                  'target': celsius, 'time': self.clock.now()}
+        module.start_set_temperature(celsius)
+        self.comment('Temperature module going to %sºC, ready in about %d seconds' % (
+            celsius, ramp))
+
+    def monitor_temperature(self, module):
+        # Sample the module in the background, one time series per run
+        file_path = None
+        if not self.ctx.is_simulating():
+            file_path = self.folder_path + '/temperature_%s.tsv' % datetime.now().strftime(
+                "%d_%m_%Y_%H_%M_%S")
+        monitor = TemperatureMonitor(module, file_path=file_path, interval=temp_sample_interval,
+                                     clock=self.clock, simulating=self.ctx.is_simulating())
+        monitor.start()
+        self.monitors[id(module)] = monitor
+        return monitor
+
+    def stop_monitors(self):
+        for monitor in self.monitors.values():
+            monitor.stop()
+
+    def await_temperature(self, module, celsius):
+        self.temp_schedule = [entry for entry in self.temp_schedule
+                              if not (entry['module'] is module and entry['step'] <= self.step)]
+        self.start_temperature(module, celsius)
+        monitor = self.monitors.get(id(module))
+        if monitor == None:
+            module.await_temperature(celsius)
+        elif not monitor.wait_until(celsius, tolerance=temp_tolerance,
+                                    stable_for=temp_stable_time, timeout=temp_timeout):
+            self.comment('Temperature not stable at %sºC after %d seconds, waiting for the module' % (
+                celsius, temp_timeout), add_hash=True)
+            module.await_temperature(celsius)
+        self.log_ramps()
+
+    def log_ramps(self):
+        # Feed the thermal model with the ramps that have reached the target
+        for key, ramp in list(self.ramps.items()):
+            if ramp['module'].status == 'holding at target':
+                if not self.ctx.is_simulating():
+                    self.thermal_model.add_ramp(
+                        ramp['start'], ramp['target'], self.clock.now()-ramp['time'])
+                del self.ramps[key]
+
     def mount_pip(self, position, type, tip_racks, capacity, multi=False, size_tipracks=96):
         self.pips[position]["pip"] = self.ctx.load_instrument(
             type, mount=position, tip_racks=tip_racks)
+        if validation_mode and not self.ctx.is_simulating():
+            self.pips[position]["pip"].default_speed = self.pips[position]["pip"].default_speed * \
+                validation_speed
         self.pips[position]["capacity"] = capacity
         self.pips[position]["count"] = 0
         self.pips[position]["maxes"] = len(tip_racks)*size_tipracks
@@ -612,10 +1040,10 @@ class ProtocolRun:
             self.pips[position]["increment_tips"] = 1
 
     def mount_right_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("right", type, tip_racks, capacity)
+        self.mount_pip("right", type, tip_racks, capacity, multi)
 
     def mount_left_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("left", type, tip_racks, capacity)
+        self.mount_pip("left", type, tip_racks, capacity, multi)
 
     def get_current_pip(self):
         
@@ -629,7 +1057,7 @@ class ProtocolRun:
         self.pips[self.selected_pip]["count"] = 0
 
     def add_pip_count(self):
-        self.pips[self.selected_pip]["count"] + \
+        self.pips[self.selected_pip]["count"] += \
             self.pips[self.selected_pip]["increment_tips"]
 
     def get_pip_maxes(self):
@@ -641,6 +1069,56 @@ class ProtocolRun:
     def set_pip(self, position):
         self.selected_pip = position
 
+    def select_pip(self, vol, air_gap_vol=0, transfers=1, distribute=False):
+        '''
+        Selects the pipette for [transfers] transfers of [vol]: the one with the
+        fewest aspirations among those that measure the volume of each one above
+        their minimum volume. A tip already on saves a pick up and running out of
+        tips adds rack_change_cost. The smaller pipette, more accurate, on a tie.
+        With [distribute] the transfers are the dispenses of distribute(): every
+        dispense of [vol] must be above the minimum volume and at least two must fit
+        in the tip, None is returned and no pipette selected if none can.
+        '''
+        options = []
+        for position, mounted in self.pips.items():
+            if "pip" not in mounted:
+                continue
+            pip = mounted["pip"]
+            capacity = mounted["capacity"] - air_gap_vol
+            if capacity <= 0:
+                continue
+            if distribute:
+                per_trip = math.floor((capacity - disposal_vol - conditioning_vol)/vol)
+                if per_trip < 2:
+                    continue
+                # Every dispense is measured on its own
+                aspirated = vol
+                cost = math.ceil(transfers/per_trip)
+                tips = 1
+            else:
+                aspirations = math.ceil(vol/capacity)
+                aspirated = vol/aspirations
+                cost = aspirations*transfers
+                tips = transfers
+            if aspirated < pip.min_volume:
+                continue
+            if not pip.hw_pipette['has_tip']:
+                cost += 1
+            if mounted["count"] + tips*mounted["increment_tips"] > mounted["maxes"]:
+                cost += rack_change_cost
+            options.append((cost, mounted["capacity"], position))
+        if len(options) == 0 and distribute:
+            return None
+        if len(options) == 0:
+            # Below the minimum of every pipette, the smallest one is the most accurate
+            options = [(0, mounted["capacity"], position)
+                       for position, mounted in self.pips.items() if "pip" in mounted]
+        position = min(options)[2]
+        if position != self.selected_pip:
+            self.comment('%.1f ul with the %s pipette' % (vol, self.pips[position]["pip"].name))
+        self.set_pip(position)
+        return position
+
     def custom_mix(self, reagent, location, vol, rounds, mix_height, blow_out=False,
                    source_height=3, post_dispense=0, x_offset=[0, 0],touch_tip=False):
         '''
@@ -671,6 +1149,8 @@ class ProtocolRun:
         if touch_tip == True:
             pip = self.get_current_pip()
             pip.touch_tip(speed=20, v_offset=-5, radius=0.9)
+        self.pipetting(2 if touch_tip else 1, 1 + vol*rounds, reagent.flow_rate_aspirate_mix,
+                       1 + vol*rounds + post_dispense, reagent.flow_rate_dispense_mix)
 
     def pick_up(self, position=None):
         pip = self.get_current_pip()
@@ -682,15 +1162,17 @@ class ProtocolRun:
                 self.reset_pip_count(pip)
         if position != None:
             pip.pick_up_tip(position)
+            self.clock.advance(tip_change_time/2)
         else:
             if not pip.hw_pipette['has_tip']:
                 self.add_pip_count()
                 pip.pick_up_tip()
+                self.clock.advance(tip_change_time/2)
 
     def drop_tip(self):
         pip = self.get_current_pip()
         pip.drop_tip(home_after=False)
-        self.add_pip_count()
+        self.clock.advance(tip_change_time/2)
 
     def change_tip(self):
         self.drop_tip()
@@ -713,18 +1195,27 @@ class ProtocolRun:
 
     def pause(self, comment):
         self.ctx.pause(comment)
+        self.clock.advance(operator_response)
         self.blink(3)
         if self.ctx.is_simulating():
             print("%s\n Press any key to continue " % comment)
 
+    def delay(self, seconds, msg=None):
+        # Waits take no time in simulation and are shortened in validation mode
+        if validation_mode and not self.ctx.is_simulating():
+            seconds = seconds*validation_wait_factor
+        self.ctx.delay(seconds=seconds, msg=msg)
+        self.clock.advance(seconds)
+
     def move_volume(self, reagent, source, dest, vol, 
                     pickup_height, disp_height, air_gap_vol = 0,blow_out=False, touch_tip=False, rinse=False,
-                    post_dispense=0,x_offset=[0, 0]):
+                    post_dispense=0,x_offset=[0, 0], post_airgap=False, post_airgap_vol=2):
         # x_offset: list with two values. x_offset in source and x_offset in destination i.e. [-1,1]
         # pickup_height: height from bottom where volume
         # rinse: if True it will do 2 rounds of aspirate and dispense before the tranfer
         # disp_height: dispense height; by default it's close to the top (z=-2), but in case it is needed it can be lowered
         # blow_out, touch_tip: if True they will be done after dispensing
+        # post_airgap: aspirate [post_airgap_vol] of air at the end so no drop falls from the tip
 
         # Rinse before aspirating
         pipet = self.get_current_pip()
@@ -744,13 +1235,80 @@ class ProtocolRun:
         pipet.dispense(vol + air_gap_vol, drop,
                        rate=reagent.flow_rate_dispense)  # dispense all
         # pause for x seconds depending on reagent
-        self.ctx.delay(seconds=reagent.delay)
+        self.delay(seconds=reagent.delay)
         if blow_out == True:
             pipet.blow_out(dest.top(z=-2))
         if post_dispense >0:
             pipet.dispense(post_dispense, dest.top(z=-2))
         if touch_tip == True:
             pipet.touch_tip(speed=20, v_offset=-5, radius=0.9)
+        if post_airgap == True:
+            pipet.aspirate(post_airgap_vol, dest.top(z=2), rate=reagent.flow_rate_aspirate)
+        self.pipetting(3 if touch_tip else 2,
+                       vol + air_gap_vol + (post_airgap_vol if post_airgap else 0),
+                       reagent.flow_rate_aspirate,
+                       vol + air_gap_vol + post_dispense, reagent.flow_rate_dispense)
+
+    def pipetting(self, moves, aspirated, rate_aspirate, dispensed, rate_dispense):
+        '''
+        Simulated time of [moves] moves of the gantry and of the plunger for the
+        [aspirated] and [dispensed] ul at the flow rates of the pipette times [rate].
+        '''
+        flow_rate = self.get_current_pip().flow_rate
+        self.clock.advance(moves*move_time + aspirated/(flow_rate.aspirate*rate_aspirate)
+                           + dispensed/(flow_rate.dispense*rate_dispense))
+
+    def distribute(self, reagent, source, dests, vol, disp_height, source_area=None,
+                   pickup_height=1, touch_tip=False):
+        '''
+        Distributes [vol] to every well of [dests] from [source] with the tip on:
+        each aspiration fills the tip for as many wells as fit with disposal_vol,
+        which is not dispensed so the last well gets as much as the first, and
+        conditioning_vol, dispensed back first to wet the tip. Both go back to the
+        source. With [source_area] the height follows the level of the source.
+        '''
+        pip = self.get_current_pip()
+        capacity = self.get_pip_capacity()
+        per_trip = max(1, math.floor((capacity - disposal_vol - conditioning_vol)/vol))
+        trips = 0
+        for start in range(0, len(dests), per_trip):
+            batch = dests[start:start+per_trip]
+            returned = min(disposal_vol + conditioning_vol, capacity - vol*len(batch))
+            aspirate = vol*len(batch) + returned
+            if source_area != None:
+                pickup_height = reagent.calc_height(source_area, aspirate)
+                # What goes back to the source is still there for the next trip
+                reagent.vol_well += returned
+            pip.aspirate(aspirate, source.bottom(pickup_height), rate=reagent.flow_rate_aspirate)
+            if returned > disposal_vol:
+                pip.dispense(returned - disposal_vol, source.bottom(pickup_height),
+                             rate=reagent.flow_rate_dispense)
+            for dest in batch:
+                pip.dispense(vol, dest.top(z=disp_height), rate=reagent.flow_rate_dispense)
+                self.delay(seconds=reagent.delay)
+                if touch_tip == True:
+                    pip.touch_tip(speed=20, v_offset=-5, radius=0.9)
+            pip.blow_out(source.top(z=-2))
+            # Source, every well and back to the source to blow out
+            self.pipetting(len(batch)*(2 if touch_tip else 1) + 2, aspirate, reagent.flow_rate_aspirate,
+                           aspirate - disposal_vol, reagent.flow_rate_dispense)
+            trips += 1
+        self.comment('%s distributed to %d wells in %d aspirations' % (reagent.name, len(dests), trips))
+
+    def load_module(self, name, slot):
+        # In simulation the modules are replaced by emulators with realistic timing
+        module = self.ctx.load_module(name, slot)
+        if self.ctx.is_simulating():
+            if 'mag' in name:
+                return MagDeckEmulator(self, module)
+            return TempDeckEmulator(self, module)
+        return module
+
+    def log_estimated_time(self):
+        # Virtual time of the simulation: pipetting, waits, modules, blinks and pauses
+        if self.ctx.is_simulating():
+            self.comment('Estimated time of pipetting, waits, modules and pauses: %s' % (
+                timedelta(seconds=int(self.clock.now()))), add_hash=True)
 
     def start_lights(self):
         self.ctx._hw_manager.hardware.set_lights(
@@ -764,8 +1322,8 @@ class ProtocolRun:
         for i in range(blink_number):
             self.stop_lights()
             # ctx._hw_manager.hardware.set_button_light(1,0,0)
-            time.sleep(0.3)
+            self.clock.sleep(0.3)
             self.start_lights()
             # ctx._hw_manager.hardware.set_button_light(0,0,1)
-            time.sleep(0.3)
+            self.clock.sleep(0.3)
             self.stop_lights()
@@ -4,6 +4,7 @@ from opentrons import robot
 from opentrons import protocol_api
 from opentrons import labware
 import time
+import threading
 import os
 import numpy as np
 from timeit import default_timer as timer
@@ -16,7 +17,7 @@ metadata = {
     'protocolName': 'Per Version 2',
     'author': 'Matias Bonet Fullana & Antoni Morla. based on: Malen Aguirregabiria,Aitor Gastaminza & José Luis Villanueva (jlvillanueva@clinic.cat)',
     'source': 'Hospital Son Espases Palma',
-    'apiLevel': '2.2',
+    'apiLevel': '2.3',
     'description': 'Protocol for Marter mix'
 }
 
@@ -29,6 +30,11 @@ metadata = {
 remove_termoblock = False
 stop_termoblock = True
 temperature_pause = False
+next_plate_queued = False  # another plate is queued: keep the termoblock cold for the next run
+temp_tolerance = 0.5  # ºC around the target that count as reached
+temp_stable_time = 30  # Seconds the block must stay within tolerance before starting
+temp_timeout = 1200  # Seconds to wait for a stable block before falling back to the module
+temp_sample_interval = 2  # Seconds between temperature samples of the log
 
 # Check stop termoblock when remove termoblock
 if remove_termoblock == True:
@@ -39,7 +45,7 @@ if remove_termoblock == True:
 NUM_SAMPLES = 96
 steps = [2]  # Steps you want to execute
 temp = 10  # Define termoblock temperature
-num_blinks = 5  # Define number of advisor temperature blinks
+num_blinks = 5  # Define number of advisor blinks at the end of the run
 air_gap_vol = 1
 air_gap_mmix = 0
 air_gap_sample = 0
@@ -87,6 +93,12 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # Init protocol run
     run = ProtocolRun(ctx)
+
+    # Start cooling the termoblock while the desk is being checked
+    tempdeck = ctx.load_module('tempdeck', 10)
+    run.start_temperature(tempdeck, temp)
+    run.monitor_temperature(tempdeck)
+
     run.comment("You are about to run %s samples" % NUM_SAMPLES, add_hash=True)
     run.pause("Are you sure the set up is correct? Check the desk before continue")
 
@@ -99,7 +111,6 @@ def run(ctx: protocol_api.ProtocolContext):
 
     ##################################
     # Define desk
-    tempdeck = ctx.load_module('tempdeck', 10)
     tuberack = tempdeck.load_labware(
         'opentrons_24_aluminumblock_generic_2ml_screwcap')
 
@@ -225,7 +236,7 @@ def run(ctx: protocol_api.ProtocolContext):
     
 
     # check temperature to know if the protocol can start
-    tempdeck.set_temperature(temp)
+    run.await_temperature(tempdeck, temp)
     run.blink()
 
     if(temperature_pause):
@@ -352,12 +363,9 @@ def run(ctx: protocol_api.ProtocolContext):
         # ASK IF WANT DEACTIVATE TERMOBLOCK
         ####################################
         if remove_termoblock == True:
-            for i in range(num_blinks):
-                if tempdeck.temperature == temp:
-                    run.blink()
-            ctx.pause("Please remove the termoblock module to continue")
+            run.pause("Please remove the termoblock module to continue")
 
-        if stop_termoblock == True:
+        if stop_termoblock == True and not next_plate_queued:
             tempdeck.deactivate()
 
         run.finish_step()
@@ -365,9 +373,8 @@ def run(ctx: protocol_api.ProtocolContext):
     ############################################################################
     # Light flash end of program
     run.log_steps_time()
-    for i in range(10):
-        if tempdeck.temperature == temp:
-            run.blink()
+    run.stop_monitors()
+    run.blink(blink_number=num_blinks)
     run.comment('Finished! \nMove plate to PCR')
 
 
@@ -479,6 +486,161 @@ class Reagent:
         vol_list.append(last_vol)
         return vol_list
 
+class ThermalModel:
+    '''
+    Time the temperature module needs to ramp between two temperatures.
+    Heating and cooling are fitted separately from the ramps logged in the
+    previous runs as: seconds = lag + |delta| * seconds_per_degree
+    '''
+
+    def __init__(self, file_path=None, heat_rate=0.1, cool_rate=0.05, lag=20):
+        # Default rates in degrees per second, used until there are logged ramps
+        self.file_path = file_path
+        self.ramps = []
+        self.fit_params = {'heat': [lag, 1/heat_rate],
+                           'cool': [lag, 1/cool_rate]}
+
+        if self.file_path != None and os.path.isfile(self.file_path):
+            with open(self.file_path) as f:
+                self.ramps = json.load(f)["ramps"]
+            self.fit()
+
+    def direction(self, start, target):
+        if target >= start:
+            return 'heat'
+        return 'cool'
+
+    def fit(self):
+        # Least squares of the ramp time against the temperature delta
+        for direction in self.fit_params:
+            points = [[abs(target-start), seconds] for start, target, seconds in self.ramps
+                      if self.direction(start, target) == direction and abs(target-start) > 1]
+            if len(points) == 0:
+                continue
+            lag = self.fit_params[direction][0]
+            mean_delta = sum([p[0] for p in points])/len(points)
+            mean_seconds = sum([p[1] for p in points])/len(points)
+            var_delta = sum([(p[0]-mean_delta)**2 for p in points])
+            if len(points) > 1 and var_delta > 0:
+                slope = sum([(p[0]-mean_delta)*(p[1]-mean_seconds)
+                             for p in points])/var_delta
+                lag = max(mean_seconds - slope*mean_delta, 0)
+            else:
+                slope = (mean_seconds-lag)/mean_delta
+            if slope > 0:
+                self.fit_params[direction] = [lag, slope]
+
+    def ramp_time(self, start, target):
+        if abs(target-start) < 0.5:
+            return 0
+        lag, slope = self.fit_params[self.direction(start, target)]
+        return lag + abs(target-start)*slope
+
+    def add_ramp(self, start, target, seconds, max_ramps=50):
+        self.ramps.append([start, target, seconds])
+        self.ramps = self.ramps[-max_ramps:]
+        self.fit()
+        if self.file_path != None:
+            with open(self.file_path, 'w') as f:
+                json.dump({"ramps": self.ramps}, f)
+
+
+class TemperatureMonitor:
+    '''
+    Samples the temperature module in the background and logs the time series
+    of the run. wait_until returns as soon as the block is stable at the target.
+    '''
+
+    def __init__(self, module, file_path=None, interval=2, clock=None, simulating=False):
+        self.module = module
+        self.file_path = file_path
+        self.interval = interval
+        self.clock = clock
+        self.simulating = simulating
+        self.samples = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.start_time = self.now()
+        if self.file_path != None:
+            with open(self.file_path, 'w') as f:
+                f.write('time\ttemperature\ttarget\tstatus\n')
+
+    def now(self):
+        if self.clock != None:
+            return self.clock.now()
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        if self.clock != None:
+            self.clock.sleep(seconds)
+        elif not self.simulating:
+            time.sleep(seconds)
+
+    def start(self):
+        # No thread in simulation, wait_until samples by itself
+        if self.simulating or self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread != None:
+            self.thread.join(self.interval*2)
+            self.thread = None
+
+    def loop(self):
+        while self.running:
+            try:
+                self.sample()
+            except Exception:
+                # A failed reading must not stop the run
+                pass
+            time.sleep(self.interval)
+
+    def sample(self):
+        reading = (round(self.now()-self.start_time, 1), self.module.temperature,
+                   self.module.target, self.module.status)
+        with self.lock:
+            self.samples.append(reading)
+        if self.file_path != None:
+            with open(self.file_path, 'a') as f:
+                f.write('\t'.join([str(value) for value in reading])+'\n')
+        return reading
+
+    def latest(self):
+        with self.lock:
+            if len(self.samples) == 0:
+                return None
+            return self.samples[-1]
+
+    def wait_until(self, target, tolerance=0.5, stable_for=30, timeout=1200):
+        '''
+        Wait until the temperature stays within [tolerance] of [target] during
+        [stable_for] seconds. Returns False if it is not stable after [timeout].
+        '''
+        start = self.now()
+        stable_since = None
+        while True:
+            reading = self.latest() if self.running else self.sample()
+            now = self.now()
+            if reading != None and abs(reading[1]-target) <= tolerance:
+                if stable_since == None:
+                    stable_since = now
+                if now-stable_since >= stable_for:
+                    return True
+            else:
+                stable_since = None
+            if now-start >= timeout:
+                return False
+            if self.simulating and self.clock == None:
+                # The simulated module is already at its setpoint
+                return stable_since != None
+            self.sleep(self.interval)
+
+
 class ProtocolRun:
     def __init__(self, ctx):
         self.ctx = ctx
@@ -492,10 +654,21 @@ class ProtocolRun:
                 os.mkdir(folder_path)
             self.file_path = folder_path + \
                 '/rna_extraction_%s.tsv' % datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
+            self.thermal_model = ThermalModel(
+                folder_path + '/thermal_model.json')
+        else:
+            self.thermal_model = ThermalModel()
+        self.folder_path = folder_path
 
         self.selected_pip = "right"
         self.pips = {"right": {}, "left": {}}
 
+        # Temperature ramps: scheduled to be ready for a step and in progress
+        self.temp_schedule = []
+        self.ramps = {}
+        self.monitors = {}
+        self.previous_times = []
+
     def add_step(self, description, execute=False, wait_time=0):
         self.step_list.append(
             {'execute': execute, 'description': description, 'wait_time': wait_time, 'execution_time': 0})
@@ -510,7 +683,7 @@ class ProtocolRun:
         else:
             for index, step in enumerate(self.step_list):
                 self.set_execution_step(index, True)
-
+        self.previous_times = self.load_previous_times()
 
         self.comment("###############################################")
         self.comment("You are about to run %s samples" % (NUM_SAMPLES))
@@ -528,6 +701,7 @@ class ProtocolRun:
         return self.step_list[self.step]
 
     def next_step(self):
+        self.check_temperature_schedule()
         if self.step_list[self.step]['execute'] == False:
             self.step += 1
             return False
@@ -551,6 +725,7 @@ class ProtocolRun:
         self.step_list[self.step]['execution_time'] = str(time_taken)
         self.step += 1
         self.log_steps_time()
+        self.check_temperature_schedule()
 
     def log_steps_time(self):
         # Export the time log to a tsv file
@@ -560,10 +735,122 @@ class ProtocolRun:
                 row = ""
                 for step in self.step_list:
                     row = ('{}\t{}\t{}\t{}').format(
-                        step["execute"], step["description"], step["wait_time"], step["execution_time"])
+                        step["execute"], step["description"].replace('\n', ' '), step["wait_time"], step["execution_time"])
                     f.write(row + '\n')
             f.close()
 
+    def load_previous_times(self):
+        # Step durations in seconds of the last logged run, used to plan ahead
+        if self.ctx.is_simulating() or not os.path.isdir(self.folder_path):
+            return []
+        logs = [os.path.join(self.folder_path, f) for f in os.listdir(self.folder_path)
+                if f.endswith('.tsv')]
+        if len(logs) == 0:
+            return []
+        times = []
+        with open(max(logs, key=os.path.getmtime)) as f:
+            for line in f.readlines()[1:]:
+                fields = line.rstrip('\n').split('\t')
+                try:
+                    h, m, s = fields[-1].split(':')
+                    times.append(int(h)*3600 + int(m)*60 + float(s))
+                except ValueError:
+                    times.append(0)
+        # Logs of a different step list are useless
+        if len(times) != len(self.step_list):
+            return []
+        return times
+
+    def time_to_step(self, index):
+        # Estimated seconds until the step [index] begins
+        seconds = 0
+        for i in range(self.step, index):
+            if self.step_list[i]['execute']:
+                if i < len(self.previous_times) and self.previous_times[i] > 0:
+                    seconds += self.previous_times[i]
+                else:
+                    seconds += self.step_list[i]['wait_time']
+        return seconds
+
+    def schedule_temperature(self, module, celsius, step):
+        '''
+        Have the temperature [module] at [celsius] when [step] begins.
+        The ramp is started without blocking as late as the thermal model allows,
+        the step must call await_temperature before using the block.
+        '''
+        self.temp_schedule.append(
+            {'module': module, 'celsius': celsius, 'step': step-1, 'started': False})
+        self.check_temperature_schedule()
+
+    def check_temperature_schedule(self):
+        self.log_ramps()
+        pending_modules = []
+        for entry in list(self.temp_schedule):
+            if entry['step'] < self.step or not self.step_list[entry['step']]['execute']:
+                self.temp_schedule.remove(entry)
+                continue
+            # Only the first scheduled ramp of each module can be started
+            if entry['module'] in pending_modules:
+                continue
+            pending_modules.append(entry['module'])
+            if entry['started']:
+                continue
+            ramp = self.thermal_model.ramp_time(
+                entry['module'].temperature, entry['celsius'])
+            if self.time_to_step(entry['step']) <= ramp:
+                self.start_temperature(entry['module'], entry['celsius'])
+                entry['started'] = True
+
+    def start_temperature(self, module, celsius):
+        # Start the ramp without blocking, it is logged when the target is reached
+        if module.target == celsius:
+            return
+        ramp = self.thermal_model.ramp_time(module.temperature, celsius)
+        self.ramps[id(module)] = {'module': module, 'start': module.temperature,
+                                  'target': celsius, 'time': time.monotonic()}
+        module.start_set_temperature(celsius)
+        self.comment('Temperature module going to %sºC, ready in about %d seconds' % (
+            celsius, ramp))
+
+    def monitor_temperature(self, module):
+        # Sample the module in the background, one time series per run
+        file_path = None
+        if not self.ctx.is_simulating():
+            file_path = self.folder_path + '/temperature_%s.tsv' % datetime.now().strftime(
+                "%d_%m_%Y_%H_%M_%S")
+        monitor = TemperatureMonitor(module, file_path=file_path, interval=temp_sample_interval,
+                                     clock=None, simulating=self.ctx.is_simulating())
+        monitor.start()
+        self.monitors[id(module)] = monitor
+        return monitor
+
+    def stop_monitors(self):
+        for monitor in self.monitors.values():
+            monitor.stop()
+
+    def await_temperature(self, module, celsius):
+        self.temp_schedule = [entry for entry in self.temp_schedule
+                              if not (entry['module'] is module and entry['step'] <= self.step)]
+        self.start_temperature(module, celsius)
+        monitor = self.monitors.get(id(module))
+        if monitor == None:
+            module.await_temperature(celsius)
+        elif not monitor.wait_until(celsius, tolerance=temp_tolerance,
+                                    stable_for=temp_stable_time, timeout=temp_timeout):
+            self.comment('Temperature not stable at %sºC after %d seconds, waiting for the module' % (
+                celsius, temp_timeout), add_hash=True)
+            module.await_temperature(celsius)
+        self.log_ramps()
+
+    def log_ramps(self):
+        # Feed the thermal model with the ramps that have reached the target
+        for key, ramp in list(self.ramps.items()):
+            if ramp['module'].status == 'holding at target':
+                if not self.ctx.is_simulating():
+                    self.thermal_model.add_ramp(
+                        ramp['start'], ramp['target'], time.monotonic()-ramp['time'])
+                del self.ramps[key]
+
     def mount_pip(self, position, type, tip_racks, capacity, multi=False, size_tipracks=96):
         self.pips[position]["pip"] = self.ctx.load_instrument(
             type, mount=position, tip_racks=tip_racks)
@@ -576,10 +863,10 @@ class ProtocolRun:
             self.pips[position]["increment_tips"] = 1
 
     def mount_right_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("right", type, tip_racks, capacity)
+        self.mount_pip("right", type, tip_racks, capacity, multi)
 
     def mount_left_pip(self, type, tip_racks, capacity, multi=False):
-        self.mount_pip("left", type, tip_racks, capacity)
+        self.mount_pip("left", type, tip_racks, capacity, multi)
 
     def get_current_pip(self):
         
@@ -593,7 +880,7 @@ class ProtocolRun:
         self.pips[self.selected_pip]["count"] = 0
 
     def add_pip_count(self):
-        self.pips[self.selected_pip]["count"] + \
+        self.pips[self.selected_pip]["count"] += \
             self.pips[self.selected_pip]["increment_tips"]
 
     def get_pip_maxes(self):
@@ -654,7 +941,6 @@ class ProtocolRun:
     def drop_tip(self):
         pip = self.get_current_pip()
         pip.drop_tip(home_after=False)
-        self.add_pip_count()
 
     def change_tip(self):
         self.drop_tip()
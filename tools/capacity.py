@@ -0,0 +1,271 @@
+'''
+Discrete event model of the capacity of the lab.
+
+Samples arrive at random at --arrivals a day and are grouped in plates of 94.
+Every plate goes through the stages of the orchestrator (prep, KingFisher,
+master mix), each one on a free robot of its kind. The operators load and
+unload the plates and attend the pauses of the protocols (set up check, plate
+moves, tip racks, trash), and only then the robot goes on. The time an operator
+takes to answer is random, so the model is run for many days and replicas:
+
+    python tools/capacity.py --arrivals 600 --operators 2 --days 1000
+    python tools/capacity.py --arrivals 900 --operators 2 --sweep
+
+Stage durations are the ones of the orchestrator (step logs or defaults). The
+pauses in the middle of a run are the tip_stop steps of the protocols that
+declare the tips of their steps, for the others the pause calls of their run()
+plus --tip-pauses, the tip rack changes that pick_up asks for. The set up
+check of every run is counted apart, with the loading of the plate.
+--sweep compares the samples a day with one more operator or one more robot of
+each kind, to show which one pays off.
+'''
+import argparse
+import ast
+import heapq
+import math
+import os
+import random
+from collections import deque
+
+import forecast
+import orchestrator
+import params
+
+PLATE_SAMPLES = 94
+DAY = 24*3600
+SET_UP_CHECK = 'set up is correct'
+
+
+def is_set_up_check(call):
+    message = call.args[0] if len(call.args) > 0 else None
+    return isinstance(message, ast.Constant) and SET_UP_CHECK in str(message.value)
+
+
+def protocol_pauses(protocol, tip_pauses=0):
+    '''
+    Pauses of the operator in a run of the protocol, besides the set up check:
+    its tip_stop steps if it declares the tips of its steps, otherwise the pause
+    calls of its run() and [tip_pauses] tip rack changes.
+    '''
+    with open(os.path.join(orchestrator.PROTOCOLS, protocol)) as f:
+        source = f.read()
+    steps = forecast.declared_steps(source, params.protocol_globals(source))
+    if any(step.get('tips') for step in steps):
+        return sum(1 for step in steps if step.get('tip_stop'))
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.FunctionDef) and node.name == 'run':
+            return tip_pauses + sum(
+                1 for call in ast.walk(node) if isinstance(call, ast.Call)
+                and isinstance(call.func, ast.Attribute)
+                and call.func.attr in ('pause', 'tip_pause') and not is_set_up_check(call))
+    return tip_pauses
+
+
+def stage_models(config, tip_pauses=0):
+    '''Duration and operator interactions of every stage'''
+    stages = []
+    for s in config['stages']:
+        stage = orchestrator.Stage(s['name'], s['duration'], s.get('slot', ''),
+                                   s.get('protocols', []), config.get('log_folder'))
+        pauses = [protocol_pauses(p, tip_pauses) for p in stage.protocols]
+        stage.pauses = sum(pauses)/len(pauses) if len(pauses) > 0 else 0
+        stages.append(stage)
+    return stages
+
+
+def positive(text):
+    value = float(text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('must be greater than 0')
+    return value
+
+
+class Lab:
+    '''
+    One replica of the lab. Events are (time, order, action, arguments) in a heap.
+    '''
+
+    def __init__(self, stages, robots, operators, arrivals, response, handling, rng):
+        self.stages = stages
+        self.free_robots = list(robots)
+        self.robots = robots
+        self.operators = operators
+        self.free_operators = operators
+        self.arrivals = arrivals
+        self.response = response
+        self.handling = handling
+        self.rng = rng
+        self.events = []
+        self.order = 0
+        self.now = 0
+        self.queues = [deque() for _ in stages]
+        self.calls = deque()  # Operator calls waiting for a free operator
+        self.operator_busy = 0
+        self.robot_busy = [0 for _ in stages]
+        self.queue_area = [0 for _ in stages]
+        self.last_change = 0
+        self.done_samples = 0
+        self.turnaround = []
+
+    def schedule(self, delay, action, *args):
+        self.order += 1
+        heapq.heappush(self.events, (self.now + delay, self.order, action, args))
+
+    def response_time(self):
+        # Lognormal with the mean [response] and a long tail
+        sigma = 0.75
+        return self.rng.lognormvariate(math.log(self.response) - sigma**2/2, sigma)
+
+    def account(self):
+        elapsed = self.now - self.last_change
+        for index, queue in enumerate(self.queues):
+            self.queue_area[index] += len(queue)*elapsed
+        self.last_change = self.now
+
+    def next_plate(self):
+        # Time to the 94 next samples, the sum of their random arrival intervals
+        self.schedule(self.rng.gammavariate(PLATE_SAMPLES, DAY/self.arrivals), self.arrive)
+
+    def run(self, days):
+        self.next_plate()
+        end = days*DAY
+        while self.events and self.events[0][0] <= end:
+            time, _, action, args = heapq.heappop(self.events)
+            self.now = time
+            self.account()
+            action(*args)
+        self.now = end
+        self.account()
+
+    def arrive(self):
+        self.enqueue(0, {'start': self.now, 'samples': PLATE_SAMPLES})
+        self.next_plate()
+
+    def enqueue(self, stage, plate):
+        if stage == len(self.stages):
+            self.done_samples += plate['samples']
+            self.turnaround.append(self.now - plate['start'])
+            return
+        self.queues[stage].append(plate)
+        self.dispatch(stage)
+
+    def dispatch(self, stage):
+        while self.queues[stage] and self.robots[stage] > 0 and self.free_robots[stage] > 0:
+            self.free_robots[stage] -= 1
+            plate = self.queues[stage].popleft()
+            # Loading the plate and answering the set up check of init_steps
+            self.call_operator(self.start_run, stage, plate)
+
+    def call_operator(self, then, *args):
+        if self.free_operators > 0:
+            self.free_operators -= 1
+            busy = self.response_time() + self.handling
+            self.operator_busy += busy
+            self.schedule(busy, self.release_operator, then, args)
+        else:
+            self.calls.append((then, args))
+
+    def release_operator(self, then, args):
+        self.free_operators += 1
+        then(*args)
+        while self.calls and self.free_operators > 0:
+            waiting_then, waiting_args = self.calls.popleft()
+            self.call_operator(waiting_then, *waiting_args)
+
+    def start_run(self, stage, plate):
+        model = self.stages[stage]
+        # Pauses are spread along the run, each one is a segment
+        pauses = int(model.pauses) + (1 if self.rng.random() < model.pauses % 1 else 0)
+        self.run_segment(stage, plate, pauses, model.duration/(pauses+1))
+
+    def run_segment(self, stage, plate, pauses, segment):
+        self.robot_busy[stage] += segment
+        if pauses > 0:
+            self.schedule(segment, self.call_operator, self.run_segment, stage, plate, pauses-1, segment)
+        else:
+            self.schedule(segment, self.call_operator, self.finish_run, stage, plate)
+
+    def finish_run(self, stage, plate):
+        # The operator unloads the plate and takes it to the next stage
+        self.free_robots[stage] += 1
+        self.dispatch(stage)
+        self.enqueue(stage+1, plate)
+
+    def results(self, days):
+        seconds = days*DAY
+        return {
+            'samples_day': self.done_samples/days,
+            'queues': [area/seconds for area in self.queue_area],
+            'operator_use': self.operator_busy/(self.operators*seconds) if self.operators > 0 else 0,
+            'robot_use': [busy/(robots*seconds) if robots > 0 else 0
+                          for busy, robots in zip(self.robot_busy, self.robots)],
+            'turnaround': sum(self.turnaround)/len(self.turnaround) if self.turnaround else 0,
+        }
+
+
+def simulate(stages, robots, operators, arrivals, response, handling, days, replicas, seed=0):
+    '''Mean of the results of [replicas] runs of [days] days each'''
+    totals = None
+    for replica in range(replicas):
+        lab = Lab(stages, robots, operators, arrivals, response, handling,
+                  random.Random(seed + replica))
+        lab.run(days)
+        results = lab.results(days)
+        if totals == None:
+            totals = results
+        else:
+            for key, value in results.items():
+                if isinstance(value, list):
+                    totals[key] = [a + b for a, b in zip(totals[key], value)]
+                else:
+                    totals[key] += value
+    for key, value in totals.items():
+        totals[key] = [v/replicas for v in value] if isinstance(value, list) else value/replicas
+    return totals
+
+
+def print_results(title, stages, results):
+    print('%s: %.0f samples/day, operators %.0f%% busy, turnaround %.1f h' % (
+        title, results['samples_day'], 100*results['operator_use'], results['turnaround']/3600))
+    for stage, queue, use in zip(stages, results['queues'], results['robot_use']):
+        print('    %-12s queue %5.2f plates, robots %3.0f%% busy' % (stage.name, queue, 100*use))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--arrivals', type=positive, default=600, help='samples a day')
+    parser.add_argument('--prep-robots', type=int, default=2)
+    parser.add_argument('--kingfishers', type=int, default=1)
+    parser.add_argument('--mmix-robots', type=int, default=1)
+    parser.add_argument('--operators', type=int, default=1)
+    parser.add_argument('--response', type=float, default=5, help='mean minutes an operator takes to answer')
+    parser.add_argument('--handling', type=float, default=2, help='minutes of work of every interaction')
+    parser.add_argument('--tip-pauses', type=float, default=0,
+                        help='tip rack changes a run of the protocols that do not declare their tips')
+    parser.add_argument('--days', type=int, default=200, help='days of every replica')
+    parser.add_argument('--replicas', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sweep', action='store_true', help='compare one more operator or robot')
+    args = parser.parse_args()
+
+    stages = stage_models(orchestrator.DEFAULT_CONFIG, args.tip_pauses)
+    robots = [args.prep_robots, args.kingfishers, args.mmix_robots]
+    common = (args.arrivals, args.response*60, args.handling*60, args.days, args.replicas, args.seed)
+
+    base = simulate(stages, robots, args.operators, *common)
+    print_results('Lab', stages, base)
+    if not args.sweep:
+        return
+    options = [('+1 operator', robots, args.operators + 1)]
+    for index, stage in enumerate(stages):
+        more = list(robots)
+        more[index] += 1
+        options.append(('+1 %s robot' % stage.name, more, args.operators))
+    for title, option_robots, operators in options:
+        results = simulate(stages, option_robots, operators, *common)
+        print_results('%s (%+.0f samples/day)' % (title, results['samples_day'] - base['samples_day']),
+                      stages, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+'''
+Dispatch service of protocol runs to a pool of robots.
+
+A job is a protocol and a parameter file (JSON with the values of the
+parameters at the top of the protocol, or a parameters.json of split_batch.py).
+Jobs wait in a bounded queue and every robot takes the next one when it is
+free, through an HTTP connection kept open for that robot. The log of every run
+is collected in --logs. Jobs that can not reach their robot, or find it busy,
+go back to the queue up to --retries times; a full queue rejects new jobs.
+A run is never sent twice: if the robot got it but the reply was lost, the
+robot can not be polled once the run started, or the reply is not the one of
+the API, the job fails.
+
+The robots serve the API of standin_robot.py. --standins starts that many
+local stand-ins that simulate the protocols, so no robots are needed:
+
+    python tools/dispatch.py --standins 2 --run protocols/P1a_KF_rna_extraction/p1a_KF_prekingfisher.py params.json
+    python tools/dispatch.py --robots http://ot2-1:8001 http://ot2-2:8001 --serve 8000
+
+With --serve, jobs are queued with POST /jobs ({"protocol": <path>,
+"parameters": {...}}, 429 when the queue is full) and their state is on /jobs.
+'''
+import argparse
+import http.client
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import params
+import standin_robot
+
+
+class RobotError(Exception):
+    '''The robot could not be reached or is busy, the job can be retried'''
+
+
+class RunLost(Exception):
+    '''A run was sent to the robot but the reply was lost, it may be going on'''
+
+
+class Job:
+    def __init__(self, job_id, protocol, parameters):
+        self.id = job_id
+        self.protocol = protocol
+        self.parameters = parameters
+        self.status = 'queued'
+        self.robot = None
+        self.attempts = 0
+        self.log = None
+        self.error = None
+
+    def state(self):
+        return {'id': self.id, 'protocol': self.protocol, 'parameters': self.parameters,
+                'status': self.status, 'robot': self.robot, 'attempts': self.attempts,
+                'log': self.log, 'error': self.error}
+
+
+class RobotClient:
+    '''Persistent HTTP connection to one robot'''
+
+    def __init__(self, url, timeout=30):
+        address = urlparse(url)
+        self.url = url
+        self.host = address.hostname
+        self.port = address.port or 80
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None):
+        '''
+        A GET is sent again once if the robot closed the connection kept open.
+        Other methods go on a new connection and are never sent twice: a POST
+        whose reply is lost raises RunLost, the robot may have started the run.
+        '''
+        if method != 'GET':
+            self.close()
+        for attempt in range(2 if method == 'GET' else 1):
+            if self.connection == None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                try:
+                    self.connection.connect()
+                except OSError as e:
+                    self.close()
+                    raise RobotError('%s: %s' % (self.url, e))
+            try:
+                headers = {'Content-Type': 'application/json'} if body != None else {}
+                self.connection.request(method, path, body=json.dumps(body) if body != None else None,
+                                        headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                return response.status, data
+            except (OSError, http.client.HTTPException) as e:
+                self.close()
+                if method != 'GET':
+                    raise RunLost('%s: no reply to %s %s: %s' % (self.url, method, path, e))
+                if attempt == 1:
+                    raise RobotError('%s: %s' % (self.url, e))
+
+    def close(self):
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+
+    def run(self, name, protocol, poll=0.5):
+        '''Status and log of the run of [protocol] on the robot'''
+        status, data = self.request('POST', '/runs', {'name': name, 'protocol': protocol})
+        if status == 409:
+            raise RobotError('%s is busy' % self.url)
+        if status != 201:
+            raise RobotError('%s: %d %s' % (self.url, status, data[:200]))
+        run_id = json.loads(data)['id']
+        # The run is on the robot from now on, it must not go back to the queue
+        try:
+            while True:
+                status, data = self.request('GET', '/runs/%d' % run_id)
+                state = json.loads(data)['status']
+                if state != 'running':
+                    break
+                time.sleep(poll)
+            _, log = self.request('GET', '/runs/%d/log' % run_id)
+        except RobotError as e:
+            raise RunLost('run %d: %s' % (run_id, e))
+        return state, log.decode()
+
+
+class Dispatcher:
+    def __init__(self, robots, log_folder, max_queue=20, retries=3, retry_delay=5):
+        self.robots = [RobotClient(url) for url in robots]
+        self.log_folder = log_folder
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        os.makedirs(log_folder, exist_ok=True)
+        for robot in self.robots:
+            threading.Thread(target=self.work, args=(robot,), daemon=True).start()
+
+    def submit(self, protocol, parameters={}):
+        '''The new job, None if the queue is full'''
+        with self.lock:
+            job = Job(next(self.ids), protocol, parameters)
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                return None
+            self.jobs[job.id] = job
+        return job
+
+    def work(self, robot):
+        while True:
+            job = self.queue.get()
+            try:
+                self.execute(robot, job)
+            finally:
+                self.queue.task_done()
+
+    def execute(self, robot, job):
+        try:
+            with open(job.protocol) as f:
+                source = params.apply_parameters(f.read(), job.parameters)
+        except (OSError, KeyError, SyntaxError) as e:
+            with self.lock:
+                job.status = 'failed'
+                job.error = str(e)
+            return
+        with self.lock:
+            job.status = 'running'
+            job.robot = robot.url
+            job.attempts += 1
+        try:
+            state, log = robot.run(os.path.basename(job.protocol), source)
+            path = os.path.join(self.log_folder, '%d_%s.log' % (
+                job.id, os.path.splitext(os.path.basename(job.protocol))[0]))
+            with open(path, 'w') as f:
+                f.write(log)
+        except RobotError as e:
+            with self.lock:
+                job.error = str(e)
+                job.status = 'queued' if job.attempts <= self.retries else 'failed'
+            if job.status == 'queued':
+                # Back to the queue after a while, for this or another robot
+                threading.Timer(self.retry_delay, self.queue.put, args=(job,)).start()
+            return
+        except Exception as e:
+            # Lost runs, replies that are not the API or logs that can not be
+            # written fail the job, the worker goes on with the next one
+            with self.lock:
+                job.error = '%s: %s' % (type(e).__name__, e)
+                job.status = 'failed'
+            return
+        with self.lock:
+            job.log = path
+            job.status = state
+            job.error = None if state == 'succeeded' else (log.strip().splitlines() or ['failed'])[-1]
+
+    def wait(self):
+        while True:
+            with self.lock:
+                if all(j.status in ('succeeded', 'failed') for j in self.jobs.values()):
+                    return
+            time.sleep(0.2)
+
+    def status(self):
+        with self.lock:
+            return [job.state() for job in self.jobs.values()]
+
+
+def read_parameters(path):
+    if path == None:
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+    # parameters.json of split_batch.py keeps them in 'parameters'
+    return data.get('parameters', data)
+
+
+def serve(dispatcher, port):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, data, code=200):
+            body = json.dumps(data, indent=2).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/jobs':
+                self.reply(dispatcher.status())
+            else:
+                self.reply({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            if self.path != '/jobs':
+                self.reply({'error': 'not found'}, 404)
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                request = json.loads(self.rfile.read(length))
+                protocol = request['protocol']
+                parameters = request.get('parameters', {})
+            except (ValueError, KeyError, TypeError):
+                self.reply({'error': 'expected {"protocol": <path>, "parameters": {...}}'}, 400)
+                return
+            if not os.path.isfile(protocol):
+                self.reply({'error': '%s not found' % protocol}, 400)
+                return
+            job = dispatcher.submit(protocol, parameters)
+            if job == None:
+                self.reply({'error': 'queue full'}, 429)
+            else:
+                self.reply(job.state(), 202)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    print('Dispatching on http://localhost:%d' % port)
+    server.serve_forever()
+
+
+def start_standins(number, first_port):
+    urls = []
+    for port in range(first_port, first_port + number):
+        server = standin_robot.make_server(port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls.append('http://localhost:%d' % port)
+    return urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--robots', nargs='*', default=[], help='URLs of the robots')
+    parser.add_argument('--standins', type=int, default=0, help='local stand-in robots to start')
+    parser.add_argument('--standin-port', type=int, default=8101)
+    parser.add_argument('--logs', default='dispatch_logs', help='folder for the logs of the runs')
+    parser.add_argument('--max-queue', type=int, default=20)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--retry-delay', type=float, default=5)
+    parser.add_argument('--run', nargs=2, action='append', default=[], metavar=('PROTOCOL', 'PARAMETERS'),
+                        help='run a protocol with a parameter file ("-" for none) and wait')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='queue jobs over HTTP')
+    args = parser.parse_args()
+
+    robots = args.robots + start_standins(args.standins, args.standin_port)
+    if len(robots) == 0:
+        parser.error('--robots or --standins are required')
+    dispatcher = Dispatcher(robots, args.logs, args.max_queue, args.retries, args.retry_delay)
+    for protocol, parameters in args.run:
+        if dispatcher.submit(protocol, read_parameters(None if parameters == '-' else parameters)) == None:
+            parser.error('more runs than --max-queue')
+    if args.serve:
+        serve(dispatcher, args.serve)
+        return
+    dispatcher.wait()
+    for job in dispatcher.status():
+        print('%d %s %s on %s, log %s%s' % (job['id'], job['protocol'], job['status'], job['robot'],
+                                            job['log'], ': ' + job['error'] if job['error'] else ''))
+    if any(job['status'] != 'succeeded' for job in dispatcher.status()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+'''
+Forecast of the reagents, tips and plates a schedule of runs consumes.
+
+The consumption of a run is read from its protocol with the number of samples
+of the run: the reservoir volume of every Reagent (with the 1.1 safety factors
+the protocols use) plus the dead volume of the cone of every well it fills,
+the master mix components of the MMIX recipe, the tip racks and the plates it
+loads. Protocols that declare the tips of their steps (add_step(tips=...)) are
+counted by those tips and the plates set in their pauses (add_step(plates=...)),
+for the others the tip racks are only the ones on the deck at the start. The schedule is a CSV file with a row for each day and protocol:
+
+    date,protocol,plates,samples
+    2026-10-20,P1a,2,94
+    2026-10-20,P2,2,94
+
+    python tools/forecast.py schedule.csv
+
+It prints the consumption of every day and ISO week.
+'''
+import argparse
+import ast
+import csv
+import math
+import os
+from collections import OrderedDict
+from datetime import date
+
+import params
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROTOCOLS = {
+    'P1': 'protocols/P1_KF_rna_extraction/p1_KF_prekingfisher.py',
+    'P1a': 'protocols/P1a_KF_rna_extraction/p1a_KF_prekingfisher.py',
+    'P1b': 'protocols/P1b_KF_rna_extraction/p1b_KF_prekingfisher.py',
+    'P1_GF': 'protocols/P1_GF_rna_extraction/p1_GF_rna_extraction.py',
+    'P1a_GF': 'protocols/P1a_GF_rna_extraction/p1a_GF_prekingfisher.py',
+    'P1b_GF': 'protocols/P1b_GF_rna_extraction/p1b_GF_rna_extraction.py',
+    'P2': 'protocols/P2_full_mastermix/p2_mmix.py',
+    'P2a': 'protocols/P2a_mastermix/p2a_mmix.py',
+    'P2b': 'protocols/P2b_mastermix/p2b_mmix.py',
+}
+
+# Variables of the run that are not constants: one plate set a run
+RUN_VALUES = {'sets': 1}
+
+# Liquids of the samples moved by the protocols of each stage, not reagents of
+# the stock. The Elution of P2 is the RNA extract of P1, in P1_GF it is the buffer
+SAMPLE_LIQUIDS = {
+    'P1': ['Samples', 'Sobrenadante', 'BitsToHot', 'BeatsToHot', 'MIX_HOT',
+           'Elution+magnets', 'Elution-magnets'],
+    'P2': ['Samples', 'Elution', 'Master Mix'],
+}
+
+TIPS_PER_RACK = 96
+
+
+def wells_filled(definition):
+    '''Wells of the reservoir the Reagent fills, as Reagent.__init__ counts them'''
+    volume = definition['volume']
+    if definition['num_wells'] != -1:
+        return definition['num_wells']
+    vol_well_max = definition['vol_well_max'] - definition['v_fondo']
+    wells = math.floor(volume/vol_well_max)
+    return wells + 1 if volume - wells*vol_well_max > 0 else wells
+
+
+def mmix_components(source):
+    '''Reagent names of MMIX_components in the order of the recipe'''
+    tree = ast.parse(source)
+    names = {}
+    components = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Assign) or not isinstance(node.targets[0], ast.Name):
+            continue
+        if isinstance(node.value, ast.Call) and getattr(node.value.func, 'id', None) == 'Reagent':
+            name = params.keyword(node.value, 'name')
+            if isinstance(name, ast.Constant):
+                names[node.targets[0].id] = name.value
+        elif node.targets[0].id == 'MMIX_components' and isinstance(node.value, ast.List):
+            components = [e.id for e in node.value.elts if isinstance(e, ast.Name)]
+    return [names.get(c, c) for c in components]
+
+
+def is_simulating(test):
+    return isinstance(test, ast.Call) and getattr(test.func, 'attr', None) == 'is_simulating'
+
+
+def loaded_labware(source, namespace):
+    '''
+    Labware names the protocol loads on a robot: only the first option of a
+    try/except and the branch of a real run of `if ctx.is_simulating()`.
+    '''
+    found = []
+    values = dict(namespace)
+
+    def visit(nodes):
+        for node in nodes:
+            if isinstance(node, ast.Try):
+                visit(node.body)
+            elif isinstance(node, ast.If) and is_simulating(node.test):
+                visit(node.orelse)
+            elif isinstance(node, ast.ClassDef):
+                continue
+            else:
+                if isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant) \
+                        and isinstance(node.targets[0], ast.Name):
+                    values[node.targets[0].id] = node.value.value
+                for call in ast.iter_child_nodes(node):
+                    visit([call])
+                if isinstance(node, ast.Call) and getattr(node.func, 'attr', None) == 'load_labware' \
+                        and len(node.args) > 0:
+                    arg = node.args[0]
+                    if isinstance(arg, ast.Constant):
+                        found.append(arg.value)
+                    elif isinstance(arg, ast.Name) and isinstance(values.get(arg.id), str):
+                        found.append(values[arg.id])
+
+    visit(ast.parse(source).body)
+    return found
+
+
+class StepRecorder:
+    '''Stand-in of the ProtocolRun of a protocol that keeps its add_step declarations'''
+
+    def __init__(self):
+        self.step_list = []
+
+    def add_step(self, description, **declaration):
+        self.step_list.append(dict(declaration, description=description))
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def is_run_call(node, method):
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) \
+        and getattr(node.value.func, 'attr', None) == method
+
+
+def declared_steps(source, namespace):
+    '''
+    add_step declarations of the run() of the protocol: its statements up to
+    run.init_steps, without the ProtocolRun. Statements that fail are skipped.
+    '''
+    values = dict(namespace)
+    values['run'] = StepRecorder()
+    functions = [node for node in ast.parse(source).body
+                 if isinstance(node, ast.FunctionDef) and node.name == 'run']
+    for node in functions[0].body if functions else []:
+        if is_run_call(node, 'init_steps'):
+            break
+        if isinstance(node, ast.Assign) and isinstance(node.value, ast.Call) \
+                and getattr(node.value.func, 'id', None) == 'ProtocolRun':
+            continue
+        try:
+            exec(compile(ast.Module(body=[node], type_ignores=[]), '<protocol>', 'exec'), values)
+        except Exception:
+            pass
+    return values['run'].step_list
+
+
+def run_consumption(protocol, samples):
+    '''{(kind, item): amount} of a run of [protocol] with [samples] samples'''
+    with open(os.path.join(REPO, PROTOCOLS[protocol])) as f:
+        source = f.read()
+    values = {'NUM_SAMPLES': samples}
+    namespace = params.protocol_globals(source, values)
+    consumption = {}
+
+    # Master mix components are used as the recipe says, not the whole tube
+    components = mmix_components(source)
+    recipe = namespace.get('MMIX_make', {}).get('volumes', [])
+    for definition in params.reagent_definitions(source, values, RUN_VALUES):
+        if definition['name'] in SAMPLE_LIQUIDS[protocol[:2]]:
+            continue
+        if definition['name'] in components and len(recipe) == len(components):
+            definition = dict(definition, volume=recipe[components.index(definition['name'])],
+                              num_wells=1)
+        if definition['volume'] == None or definition['v_fondo'] == None:
+            raise ValueError('%s: can not evaluate the volume of %s' % (protocol, definition['name']))
+        dead = wells_filled(definition)*definition['v_fondo']
+        key = ('reagent ml', definition['name'])
+        consumption[key] = consumption.get(key, 0) + (definition['volume'] + dead)/1000
+
+    # Tips and the plates set in the pauses as the steps declare them
+    steps = declared_steps(source, namespace)
+    declared = any(step.get('tips') for step in steps)
+    labware = loaded_labware(source, namespace)
+    racks = sorted(set(name for name in labware if 'tiprack' in name))
+    plates = [name for name in labware if 'wellplate' in name or 'pcr' in name]
+    for step in steps:
+        for mount, tips in step.get('tips', {}).items():
+            key = ('tip racks', racks[0] if len(racks) == 1 else '%s pipette' % mount)
+            consumption[key] = consumption.get(key, 0) + tips/TIPS_PER_RACK
+        if step.get('plates', 0) > 0 and len(plates) > 0:
+            # The operator sets plates of the type the protocol loads first
+            key = ('plates', plates[0])
+            consumption[key] = consumption.get(key, 0) + step['plates']
+
+    for name in labware:
+        if 'tiprack' in name and not declared:
+            # Only the racks on the deck at the start, the tip pauses refill them
+            key = ('tip racks', name)
+        elif name in plates:
+            key = ('plates', name)
+        else:
+            continue
+        consumption[key] = consumption.get(key, 0) + 1
+    return consumption
+
+
+def forecast(schedule):
+    '''Consumption of every day and ISO week of the [schedule] rows'''
+    days = OrderedDict()
+    weeks = OrderedDict()
+    cache = {}
+    for row in schedule:
+        day = date.fromisoformat(row['date'])
+        week = '%d-W%02d' % day.isocalendar()[:2]
+        key = (row['protocol'], int(row['samples']))
+        if key not in cache:
+            cache[key] = run_consumption(*key)
+        for period, totals in [(row['date'], days), (week, weeks)]:
+            totals.setdefault(period, {})
+            for item, amount in cache[key].items():
+                totals[period][item] = totals[period].get(item, 0) + amount*int(row['plates'])
+    return days, weeks
+
+
+def print_table(title, totals):
+    print(title)
+    for period, items in totals.items():
+        print('  %s' % period)
+        for (kind, item), amount in sorted(items.items()):
+            print('    %-12s %-52s %10.1f' % (kind, item, amount))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('schedule', help='CSV with date,protocol,plates,samples')
+    args = parser.parse_args()
+    with open(args.schedule) as f:
+        schedule = list(csv.DictReader(f))
+    for row in schedule:
+        if row['protocol'] not in PROTOCOLS:
+            parser.error('unknown protocol %s, expected one of %s' % (row['protocol'], ', '.join(PROTOCOLS)))
+    days, weeks = forecast(schedule)
+    print_table('Daily', days)
+    print_table('Weekly', weeks)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+'''
+Orchestrator of the plates of a batch across the robots of the lab.
+
+Every plate goes through the preparation (P1a/P1b), the KingFisher extraction
+and the master mix setup (P2/P2b). A plate is assigned to the first free robot
+able to run its next stage and the operators are told what to load where.
+Stage durations come from the step logs the protocols write, or from the
+configuration when there are no logs yet.
+
+Robots are local stand-ins that run the protocols with opentrons.simulate and
+then wait the modelled duration scaled by --time-scale, so the whole pipeline
+can be exercised without robots. The times reported are lab times: every stage
+takes its modelled duration, however long the simulation of the protocol took.
+
+    python tools/orchestrator.py --plates 4 --time-scale 0.001
+    python tools/orchestrator.py --config lab.json --serve 8000
+
+With --serve the state is published on http://localhost:<port>/status, the
+pending operator instructions on /instructions and plates are queued with a
+POST to /plates ({"plates": 2}).
+'''
+import argparse
+import csv
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROTOCOLS = os.path.join(REPO, 'protocols')
+
+# Stages in the order a plate goes through them. Duration in seconds when
+# there are no step logs of the protocols
+DEFAULT_CONFIG = {
+    'stages': [
+        {'name': 'prep', 'duration': 40*60, 'slot': 'slot 5',
+         'protocols': ['P1a_KF_rna_extraction/p1a_KF_prekingfisher.py',
+                       'P1b_KF_rna_extraction/p1b_KF_prekingfisher.py']},
+        {'name': 'kingfisher', 'duration': 25*60, 'slot': 'KingFisher deck',
+         'protocols': []},
+        {'name': 'mmix', 'duration': 20*60, 'slot': 'slot 5',
+         'protocols': ['P2_full_mastermix/p2_mmix.py',
+                       'P2b_mastermix/p2b_mmix.py']},
+    ],
+    'robots': [
+        {'name': 'ot2-1', 'stages': ['prep']},
+        {'name': 'ot2-2', 'stages': ['prep', 'mmix']},
+        {'name': 'kf-1', 'stages': ['kingfisher']},
+        {'name': 'ot2-3', 'stages': ['mmix']},
+    ],
+    # Folder with the step logs (rna_extraction_*.tsv) copied from the robots
+    'log_folder': None,
+}
+
+
+def parse_duration(text):
+    '''Seconds of a timedelta printed as H:MM:SS[.ffffff]'''
+    try:
+        h, m, s = text.split(':')
+        return int(h)*3600 + int(m)*60 + float(s)
+    except ValueError:
+        return 0
+
+
+def logged_duration(log_folder, protocol):
+    '''
+    Mean duration of the runs of [protocol] in the step logs of [log_folder].
+    The logs are grouped in a subfolder named as the protocol folder.
+    '''
+    if log_folder == None:
+        return None
+    folder = os.path.join(log_folder, os.path.basename(os.path.dirname(protocol)))
+    totals = []
+    # Only the step logs of real runs, not the validation or temperature logs
+    for path in glob.glob(os.path.join(folder, 'rna_extraction_*.tsv')):
+        with open(path) as f:
+            reader = csv.reader(f, delimiter='\t')
+            next(reader, None)
+            total = sum(parse_duration(row[-1]) for row in reader if row and row[0] == 'True')
+        if total > 0:
+            totals.append(total)
+    if len(totals) == 0:
+        return None
+    return sum(totals)/len(totals)
+
+
+class Stage:
+    def __init__(self, name, duration, slot, protocols, log_folder=None):
+        self.name = name
+        self.slot = slot
+        self.protocols = protocols
+        logged = [d for d in (logged_duration(log_folder, p) for p in protocols) if d != None]
+        self.duration = sum(logged)/len(logged) if len(logged) > 0 else duration
+
+    def protocol(self, index):
+        # Alternate the protocols of the stage (i.e. P1a and P1b) between plates
+        if len(self.protocols) == 0:
+            return None
+        return self.protocols[index % len(self.protocols)]
+
+
+class Plate:
+    def __init__(self, name, time=0):
+        self.name = name
+        self.stage = 0
+        self.robot = None
+        self.time = time  # Lab time when the plate is ready for its next stage
+        self.history = []  # (stage, robot, start, end)
+
+    def state(self, stages):
+        if self.stage >= len(stages):
+            return 'done'
+        if self.robot != None:
+            return 'running %s on %s' % (stages[self.stage].name, self.robot.name)
+        return 'waiting %s' % stages[self.stage].name
+
+
+class StandInRobot:
+    '''
+    Local robot that runs the protocol through opentrons.simulate and then
+    waits the modelled duration of the stage scaled by [time_scale].
+    '''
+
+    def __init__(self, name, stages, time_scale=0.001, simulate=True):
+        self.name = name
+        self.stages = stages
+        self.time_scale = time_scale
+        self.simulate = simulate
+        self.plate = None
+        self.time = 0  # Lab time when the robot is free
+
+    def run(self, protocol, duration):
+        '''Returns None if the run went fine or the error otherwise'''
+        if protocol != None and self.simulate:
+            path = os.path.join(PROTOCOLS, protocol)
+            code = 'import opentrons.simulate; opentrons.simulate.simulate(open(%r))' % os.path.basename(path)
+            result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(path),
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+            if result.returncode != 0:
+                return result.stdout.strip().splitlines()[-1] if result.stdout.strip() else 'failed'
+        time.sleep(duration*self.time_scale)
+        return None
+
+
+class Orchestrator:
+    def __init__(self, config, time_scale=0.001, simulate=True):
+        log_folder = config.get('log_folder')
+        self.stages = [Stage(s['name'], s['duration'], s.get('slot', ''), s.get('protocols', []),
+                             log_folder) for s in config['stages']]
+        self.robots = [StandInRobot(r['name'], r['stages'], time_scale, simulate)
+                       for r in config['robots']]
+        self.time_scale = time_scale
+        self.plates = []
+        self.instructions = []
+        self.errors = []
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.clock = 0
+
+    def now(self):
+        # Lab time of the last event, stages advance it by their modelled duration
+        return self.clock
+
+    def add_plates(self, number):
+        with self.lock:
+            for _ in range(number):
+                self.plates.append(Plate('plate-%d' % (len(self.plates)+1), self.now()))
+            self.assign()
+
+    def instruct(self, text, at):
+        self.clock = max(self.clock, at)
+        clock = datetime.utcfromtimestamp(at).strftime('%H:%M:%S')
+        self.instructions.append('%s %s' % (clock, text))
+        print('%s %s' % (clock, text))
+
+    def free_robot(self, stage):
+        # Robots dedicated to fewer stages first, to keep the others available
+        free = [r for r in self.robots if r.plate == None and stage.name in r.stages]
+        if len(free) == 0:
+            return None
+        return min(free, key=lambda r: len(r.stages))
+
+    def assign(self):
+        '''Assign waiting plates to free robots, oldest first. Called with the lock held'''
+        for index, plate in enumerate(self.plates):
+            if plate.robot != None or plate.stage >= len(self.stages):
+                continue
+            stage = self.stages[plate.stage]
+            robot = self.free_robot(stage)
+            if robot == None:
+                continue
+            protocol = stage.protocol(index)
+            plate.robot = robot
+            robot.plate = plate
+            start = max(plate.time, robot.time)
+            self.instruct('Load %s on %s %s for %s%s' % (
+                plate.name, robot.name, stage.slot, stage.name,
+                ' (%s)' % os.path.basename(protocol) if protocol != None else ''), start)
+            threading.Thread(target=self.execute, args=(plate, robot, stage, protocol, start),
+                             daemon=True).start()
+
+    def execute(self, plate, robot, stage, protocol, start):
+        error = robot.run(protocol, stage.duration)
+        with self.lock:
+            # A failed run stops the robot at once, the simulation time is not lab time
+            end = start + stage.duration if error == None else start
+            plate.history.append((stage.name, robot.name, start, end))
+            plate.time = robot.time = end
+            robot.plate = None
+            plate.robot = None
+            if error != None:
+                self.errors.append('%s %s on %s: %s' % (plate.name, stage.name, robot.name, error))
+                self.instruct('Check %s, %s failed: %s' % (robot.name, stage.name, error), end)
+                plate.stage = len(self.stages)
+            else:
+                plate.stage += 1
+                following = self.stages[plate.stage].name if plate.stage < len(self.stages) else 'storage'
+                self.instruct('Collect %s from %s and take it to %s' % (plate.name, robot.name, following),
+                              end)
+            self.assign()
+            self.changed.notify_all()
+
+    def wait(self):
+        with self.lock:
+            while any(p.stage < len(self.stages) for p in self.plates):
+                self.changed.wait()
+
+    def status(self):
+        with self.lock:
+            return {
+                'time': self.now(),
+                'plates': {p.name: p.state(self.stages) for p in self.plates},
+                'robots': {r.name: r.plate.name if r.plate != None else None for r in self.robots},
+                'stages': {s.name: s.duration for s in self.stages},
+                'errors': list(self.errors),
+            }
+
+    def report(self):
+        with self.lock:
+            done = [p for p in self.plates if len(p.history) > 0]
+            if len(done) == 0:
+                return 'No plates processed'
+            end = max(p.history[-1][3] for p in done)
+            lines = ['%d plates in %s' % (len(done), datetime.utcfromtimestamp(end).strftime('%H:%M:%S'))]
+            for robot in self.robots:
+                busy = sum(h[3]-h[2] for p in done for h in p.history if h[1] == robot.name)
+                lines.append('%s busy %d%%' % (robot.name, 100*busy/end if end > 0 else 0))
+            return '\n'.join(lines)
+
+
+def serve(orchestrator, port):
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, data, code=200):
+            body = json.dumps(data, indent=2).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/status':
+                self.reply(orchestrator.status())
+            elif self.path == '/instructions':
+                with orchestrator.lock:
+                    self.reply(list(orchestrator.instructions))
+            else:
+                self.reply({'error': 'not found'}, 404)
+
+        def do_POST(self):
+            if self.path != '/plates':
+                self.reply({'error': 'not found'}, 404)
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                number = int(json.loads(self.rfile.read(length) or b'{}').get('plates', 1))
+            except (ValueError, AttributeError):
+                self.reply({'error': 'expected {"plates": <number>}'}, 400)
+                return
+            orchestrator.add_plates(number)
+            self.reply(orchestrator.status())
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    print('Serving on http://localhost:%d' % port)
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config', help='JSON file with stages, robots and log_folder')
+    parser.add_argument('--plates', type=int, default=0, help='plates queued at the start')
+    parser.add_argument('--time-scale', type=float, default=0.001,
+                        help='real seconds waited for each second of a stage')
+    parser.add_argument('--no-simulate', action='store_true',
+                        help='only wait the modelled durations, do not simulate the protocols')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='publish the state over HTTP')
+    args = parser.parse_args()
+
+    config = DEFAULT_CONFIG
+    if args.config:
+        with open(args.config) as f:
+            config = dict(DEFAULT_CONFIG, **json.load(f))
+    orchestrator = Orchestrator(config, args.time_scale, not args.no_simulate)
+    orchestrator.add_plates(args.plates)
+    if args.serve:
+        serve(orchestrator, args.serve)
+    else:
+        orchestrator.wait()
+        print(orchestrator.report())
+        if orchestrator.errors:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
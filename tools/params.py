@@ -0,0 +1,129 @@
+'''
+Parameters of the protocols.
+
+The protocols are configured with the assignments at the top of the file
+(NUM_SAMPLES = 94, VOL_SAMPLE = 200...). These functions read them, write a
+copy of a protocol with other values and evaluate the reagent volumes they give,
+without opentrons.
+'''
+import ast
+import math
+
+
+def top_assignments(tree):
+    '''Top level assignments of the module: {name: node}'''
+    found = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 \
+                and isinstance(node.targets[0], ast.Name):
+            found.setdefault(node.targets[0].id, node)
+    return found
+
+
+def apply_parameters(source, params):
+    '''
+    Copy of the protocol [source] with the first top level assignment of every
+    name in [params] replaced by its value. Fails if a name is not assigned.
+    '''
+    tree = ast.parse(source)
+    assignments = top_assignments(tree)
+    lines = source.splitlines(True)
+    for name, value in params.items():
+        if name not in assignments:
+            raise KeyError('%s is not a parameter of the protocol' % name)
+        node = assignments[name]
+        line = lines[node.lineno-1]
+        start = node.value.col_offset
+        end = node.value.end_col_offset if node.value.end_lineno == node.lineno else len(line.rstrip('\n'))
+        lines[node.lineno-1] = line[:start] + repr(value) + line[end:]
+    return ''.join(lines)
+
+
+def protocol_globals(source, params={}):
+    '''
+    Values of the module level variables of the protocol once [params] are
+    applied. Statements that need opentrons or other modules are skipped.
+    '''
+    tree = ast.parse(apply_parameters(source, params) if params else source)
+    namespace = {'math': math}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+            continue
+        try:
+            exec(compile(ast.Module(body=[node], type_ignores=[]), '<protocol>', 'exec'), namespace)
+        except Exception:
+            pass
+    del namespace['__builtins__']
+    return namespace
+
+
+def keyword(call, name):
+    for kw in call.keywords:
+        if kw.arg == name:
+            return kw.value
+    return None
+
+
+def reagent_calls(source):
+    '''Reagent(...) calls of the protocol'''
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and node.func.id == 'Reagent':
+            yield node
+
+
+def run_locals(source, namespace):
+    '''
+    Values of the assignments inside the functions of the protocol (vol_wb = 485)
+    that can be evaluated from the module level variables, in source order.
+    '''
+    values = dict(namespace)
+    functions = [node for node in ast.parse(source).body if isinstance(node, ast.FunctionDef)]
+    assigns = [node for function in functions for node in ast.walk(function)
+               if isinstance(node, ast.Assign)]
+    for node in sorted(assigns, key=lambda n: n.lineno):
+        try:
+            exec(compile(ast.Module(body=[node], type_ignores=[]), '<protocol>', 'exec'), values)
+        except Exception:
+            pass
+    values.pop('__builtins__', None)
+    return values
+
+
+def reagent_definitions(source, params={}, local_values={}):
+    '''
+    Name, reservoir volume, v_fondo, num_wells and vol_well_max of the Reagent
+    definitions of the protocol. [local_values] sets the variables of the run
+    that are not constants (i.e. arguments of functions). Values that can not
+    be evaluated are None.
+    '''
+    namespace = run_locals(source, protocol_globals(source, params))
+    namespace.update(local_values)
+    defaults = {'num_wells': -1, 'vol_well_max': 12000}
+    definitions = []
+    for call in reagent_calls(source):
+        name = keyword(call, 'name')
+        if not isinstance(name, ast.Constant):
+            continue
+        definition = {'name': name.value}
+        for field, arg in [('volume', 'reagent_reservoir_volume'), ('v_fondo', 'v_fondo'),
+                           ('num_wells', 'num_wells'), ('vol_well_max', 'vol_well_max')]:
+            node = keyword(call, arg)
+            if node == None:
+                definition[field] = defaults.get(field)
+                continue
+            try:
+                definition[field] = eval(compile(ast.Expression(node), '<reagent>', 'eval'),
+                                         dict(namespace))
+            except Exception:
+                definition[field] = None
+        definitions.append(definition)
+    return definitions
+
+
+def reagent_volumes(source, params={}, local_values={}):
+    '''
+    {reagent name: reservoir volume in ul} of the Reagent definitions of the
+    protocol. Volumes that depend on variables of the run are None.
+    '''
+    return {d['name']: d['volume'] for d in reagent_definitions(source, params, local_values)}
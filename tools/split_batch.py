@@ -0,0 +1,174 @@
+'''
+Split a batch of samples across several robots.
+
+The samples are split by columns of 8 so that all the robots finish at about
+the same time, given the time each one takes per sample. Every plate keeps
+G12 for the negative and H12 for the positive control, so a plate holds 94
+samples at most and batches that do not fit run in several rounds.
+
+For every robot and round it writes a copy of its protocol with NUM_SAMPLES
+and VOL_SAMPLE set, the parameters and reagent fill volumes in a JSON file and
+split.json with the plate well of every sample of the batch:
+
+    python tools/split_batch.py --samples 192 --robots ot2-1:P1a ot2-2:P1b --out batch_01
+
+Results of the plates (CSV files with a 'well' column, one per plate, named
+as the plate) are merged back in the order of the batch with:
+
+    python tools/split_batch.py --merge batch_01 results/*.csv
+'''
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+
+import params
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROTOCOLS = {
+    'P1a': 'protocols/P1a_KF_rna_extraction/p1a_KF_prekingfisher.py',
+    'P1b': 'protocols/P1b_KF_rna_extraction/p1b_KF_prekingfisher.py',
+}
+
+MAX_SAMPLES = 94  # G12 and H12 are the controls
+CONTROLS = {'negative': 'G12', 'positive': 'H12'}
+
+# Time model of a run: setup + per_sample*samples, in seconds
+SETUP_TIME = 5*60
+SAMPLE_TIME = {'P1a': 25, 'P1b': 25}
+
+
+def well_name(index):
+    # Wells are filled by columns as aw_slot.wells() gives them: A1, B1... H1, A2
+    return 'ABCDEFGH'[index % 8] + str(index//8 + 1)
+
+
+class Robot:
+    def __init__(self, name, protocol, sample_time=None):
+        self.name = name
+        self.protocol = protocol
+        self.sample_time = sample_time if sample_time != None else SAMPLE_TIME[protocol]
+
+    def duration(self, samples):
+        return SETUP_TIME + self.sample_time*samples if samples > 0 else 0
+
+
+def parse_robot(text):
+    '''name:protocol[:seconds per sample]'''
+    fields = text.split(':')
+    if len(fields) < 2 or fields[1] not in PROTOCOLS:
+        raise argparse.ArgumentTypeError('expected name:%s[:seconds per sample]' % '|'.join(PROTOCOLS))
+    return Robot(fields[0], fields[1], float(fields[2]) if len(fields) > 2 else None)
+
+
+def balance(columns, robots, samples):
+    '''
+    Columns of the batch for each robot so that the last one finishes as soon
+    as possible. Each column goes to the robot that would finish it first.
+    '''
+    counts = [0 for _ in robots]
+    for column in range(columns):
+        size = min(8, samples - column*8)
+        candidates = [i for i in range(len(robots)) if counts[i]*8 + size <= MAX_SAMPLES]
+        best = min(candidates, key=lambda i: (robots[i].duration(counts[i]*8 + size), i))
+        counts[best] += 1
+    return counts
+
+
+def plan(samples, robots):
+    '''List of plates: robot, round, first and last sample of the batch (1 based)'''
+    plates = []
+    first = 0
+    # Whole columns of the batch fit in the first 11 columns of a plate
+    capacity = len(robots)*(MAX_SAMPLES//8)*8
+    rounds = math.ceil(samples/capacity)
+    for number in range(rounds):
+        # Keep the rounds even so that every round takes the same time
+        round_samples = min(capacity, math.ceil((samples - first)/(rounds - number)/8)*8,
+                            samples - first)
+        round_end = first + round_samples
+        counts = balance(math.ceil(round_samples/8), robots, round_samples)
+        for robot, cols in zip(robots, counts):
+            size = min(cols*8, round_end - first)
+            if size <= 0:
+                continue
+            plates.append({'plate': '%s_r%d' % (robot.name, number+1), 'robot': robot.name,
+                           'protocol': robot.protocol, 'round': number+1,
+                           'first_sample': first+1, 'last_sample': first+size, 'samples': size,
+                           'duration': robot.duration(size)})
+            first += size
+    return plates
+
+
+def write_plan(plates, vol_sample, out):
+    os.makedirs(out, exist_ok=True)
+    samples = {}
+    for plate in plates:
+        path = os.path.join(REPO, PROTOCOLS[plate['protocol']])
+        with open(path) as f:
+            source = f.read()
+        values = {'NUM_SAMPLES': plate['samples'], 'VOL_SAMPLE': vol_sample}
+        plate['parameters'] = values
+        plate['controls'] = CONTROLS
+        plate['fill_volumes'] = params.reagent_volumes(source, values)
+        folder = os.path.join(out, plate['plate'])
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, os.path.basename(path)), 'w') as f:
+            f.write(params.apply_parameters(source, values))
+        with open(os.path.join(folder, 'parameters.json'), 'w') as f:
+            json.dump(plate, f, indent=2)
+        for index in range(plate['samples']):
+            samples[plate['first_sample']+index] = {'plate': plate['plate'], 'well': well_name(index)}
+    with open(os.path.join(out, 'split.json'), 'w') as f:
+        json.dump({'plates': plates, 'samples': samples}, f, indent=2)
+
+
+def merge(out, result_files):
+    '''Rows of the results of every plate in the order of the batch, with a 'sample' column'''
+    with open(os.path.join(out, 'split.json')) as f:
+        split = json.load(f)
+    rows = {}
+    fields = ['sample', 'plate']
+    for path in result_files:
+        plate = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            for row in csv.DictReader(f):
+                rows[(plate, row['well'])] = row
+                fields += [k for k in row if k not in fields]
+    writer = csv.DictWriter(sys.stdout, fieldnames=fields)
+    writer.writeheader()
+    for sample in sorted(split['samples'], key=int):
+        location = split['samples'][sample]
+        row = rows.get((location['plate'], location['well']), {'well': location['well']})
+        writer.writerow(dict(row, sample=sample, plate=location['plate']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--samples', type=int, help='samples of the batch')
+    parser.add_argument('--robots', nargs='+', type=parse_robot,
+                        help='name:P1a|P1b[:seconds per sample] of every robot available')
+    parser.add_argument('--vol-sample', type=int, default=200, choices=[200, 400])
+    parser.add_argument('--out', help='folder for the protocols and the split')
+    parser.add_argument('--merge', nargs='+', metavar=('FOLDER', 'RESULTS'),
+                        help='merge the results of the plates of a split folder')
+    args = parser.parse_args()
+
+    if args.merge:
+        merge(args.merge[0], args.merge[1:])
+        return
+    if not (args.samples and args.robots and args.out):
+        parser.error('--samples, --robots and --out are required')
+    plates = plan(args.samples, args.robots)
+    write_plan(plates, args.vol_sample, args.out)
+    for plate in plates:
+        print('%s: samples %d-%d (%d) with %s, %d min' % (
+            plate['plate'], plate['first_sample'], plate['last_sample'], plate['samples'],
+            plate['protocol'], plate['duration']/60))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+'''
+Local stand-in of a robot for the dispatch service.
+
+It serves the small API the dispatcher uses and runs every protocol it gets
+with opentrons.simulate, or opentrons.execute with --execute on a robot. One
+run at a time, a new run while another is going gets 409 Conflict.
+
+    POST /runs          {"name": "p1a_KF_prekingfisher.py", "protocol": "<source>"}
+    GET  /runs/<id>     {"id": 1, "status": "running|succeeded|failed"}
+    GET  /runs/<id>/log output of the run
+
+    python tools/standin_robot.py --port 8001
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SIMULATE = 'import opentrons.simulate; opentrons.simulate.simulate(open(%r))'
+EXECUTE = 'import opentrons.execute; opentrons.execute.execute(open(%r))'
+
+
+class StandIn:
+    def __init__(self, execute=False):
+        self.command = EXECUTE if execute else SIMULATE
+        self.runs = {}
+        self.lock = threading.Lock()
+        self.busy = False
+
+    def start(self, name, protocol):
+        '''Id of the new run, None if the robot is busy'''
+        with self.lock:
+            if self.busy:
+                return None
+            self.busy = True
+            run_id = len(self.runs) + 1
+            self.runs[run_id] = {'id': run_id, 'name': name, 'status': 'running', 'log': ''}
+        threading.Thread(target=self.execute, args=(run_id, name, protocol), daemon=True).start()
+        return run_id
+
+    def execute(self, run_id, name, protocol):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, os.path.basename(name))
+            with open(path, 'w') as f:
+                f.write(protocol)
+            result = subprocess.run([sys.executable, '-c', self.command % path], cwd=folder,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+        with self.lock:
+            run = self.runs[run_id]
+            run['log'] = result.stdout
+            run['status'] = 'succeeded' if result.returncode == 0 else 'failed'
+            self.busy = False
+
+
+def make_server(port, execute=False, host='localhost'):
+    standin = StandIn(execute)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep the connection of the dispatcher open
+
+        def reply(self, data, code=200, content_type='application/json'):
+            body = data.encode() if isinstance(data, str) else json.dumps(data).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length)
+            if self.path != '/runs':
+                self.reply({'error': 'not found'}, 404)
+                return
+            try:
+                request = json.loads(body)
+                run_id = standin.start(request['name'], request['protocol'])
+            except (ValueError, KeyError):
+                self.reply({'error': 'expected {"name": ..., "protocol": ...}'}, 400)
+                return
+            if run_id == None:
+                self.reply({'error': 'busy'}, 409)
+            else:
+                self.reply({'id': run_id, 'status': 'running'}, 201)
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if len(parts) < 2 or parts[0] != 'runs' or not parts[1].isdigit() \
+                    or int(parts[1]) not in standin.runs:
+                self.reply({'error': 'not found'}, 404)
+                return
+            with standin.lock:
+                run = dict(standin.runs[int(parts[1])])
+            if len(parts) == 3 and parts[2] == 'log':
+                self.reply(run['log'], content_type='text/plain')
+            else:
+                self.reply({'id': run['id'], 'name': run['name'], 'status': run['status']})
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--host', default='localhost', help='0.0.0.0 to serve the lab network')
+    parser.add_argument('--execute', action='store_true', help='run the protocols on the robot')
+    args = parser.parse_args()
+    server = make_server(args.port, args.execute, args.host)
+    print('Robot on http://%s:%d' % (args.host, args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()